@@ -3,16 +3,21 @@ import os
 import logging
 from logging.handlers import RotatingFileHandler
 from common import constants
+from common.config_file import SimpleConfigParser
+from common.log_queue import start_queue_logging
 from common.iftt import IftttEvent
 from common.telegram import TelegramNotification
-import RPi.GPIO as GPIO
+from common.notify import NotificationDispatcher
+from common.event_writer import EventWriter
+from backend.hardware import load_hardware
 import atexit
 import signal
-from flask import Config
 
-# Find paths
-instance_path = os.path.dirname(os.path.realpath(os.path.abspath(sys.argv[0]))) + os.sep + 'instance'
-resource_path = os.path.dirname(os.path.realpath(os.path.abspath(sys.argv[0]))) + os.sep + 'resource'
+# Find paths. The instance folder can be moved with GARAGEPI_INSTANCE_PATH, for example to run against simulated hardware.
+project_path = os.path.dirname(os.path.dirname(os.path.realpath(os.path.abspath(__file__))))
+instance_path = os.environ.get('GARAGEPI_INSTANCE_PATH') or \
+                os.path.dirname(os.path.realpath(os.path.abspath(sys.argv[0]))) + os.sep + 'instance'
+resource_path = project_path + os.sep + 'resource'
 
 # Create logger
 file_handler = RotatingFileHandler(os.path.join(instance_path, 'garage_backend.log'),
@@ -23,7 +28,10 @@ file_handler.setFormatter(logging.Formatter(constants.LOGFILE_FORMAT))
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.DEBUG)
 console_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s [in %(module)s @ %(pathname)s:%(lineno)d]"))
-logger = logging.Logger("CONTROL", level=logging.DEBUG)
+# From getLogger, so the level can be changed once the config is loaded
+logger = logging.getLogger("CONTROL")
+logger.setLevel(logging.DEBUG)
+logger.propagate = False
 logger.addHandler(file_handler)
 logger.addHandler(console_handler)
 
@@ -36,18 +44,23 @@ try:
     logger.info('Loading configuration')
     config_file = os.path.join(instance_path, 'app.cfg')
     default_config_file = os.path.join(resource_path, 'default_app.cfg')
-    config = Config(instance_path)
-    config.from_pyfile(default_config_file)
-    config.from_pyfile(config_file)
-    #config = SimpleConfigParser(config_file, default_config_file)
+    # Read without Flask, which the backend doesn't otherwise need and is slow to import
+    config = SimpleConfigParser(config_file, default_config_file)
+
+    # From here on log files are written on a background thread, not by whoever logs
+    log_queue = start_queue_logging(logger, config['LOG_LEVEL'], config['LOG_RING_SIZE'])
 
     # Set up iftt events if a maker key is present
     if config['IFTTT_MAKER_KEY']:
         logger.info('Creating IFTTT events')
-        changed_event = IftttEvent(config['IFTTT_MAKER_KEY'], 'garage_door_changed', logger)
-        opened_event = IftttEvent(config['IFTTT_MAKER_KEY'], 'garage_door_opened', logger)
-        closed_event = IftttEvent(config['IFTTT_MAKER_KEY'], 'garage_door_closed', logger)
-        warning_event = IftttEvent(config['IFTTT_MAKER_KEY'], 'garage_door_warning', logger)
+        changed_event = IftttEvent(config['IFTTT_MAKER_KEY'], 'garage_door_changed', logger, config['NOTIFY_TIMEOUT'],
+                                   config['IFTTT_BASE_URL'])
+        opened_event = IftttEvent(config['IFTTT_MAKER_KEY'], 'garage_door_opened', logger, config['NOTIFY_TIMEOUT'],
+                                   config['IFTTT_BASE_URL'])
+        closed_event = IftttEvent(config['IFTTT_MAKER_KEY'], 'garage_door_closed', logger, config['NOTIFY_TIMEOUT'],
+                                   config['IFTTT_BASE_URL'])
+        warning_event = IftttEvent(config['IFTTT_MAKER_KEY'], 'garage_door_warning', logger, config['NOTIFY_TIMEOUT'],
+                                   config['IFTTT_BASE_URL'])
     else:
         logger.info('No IFTTT maker key provided. No events will be raised.')
         changed_event = None    # type: IftttEvent
@@ -56,10 +69,10 @@ try:
         warning_event = None    # type: IftttEvent
     if config['APPRISE_TELEGRAM_KEY']:
         logger.info('Creating Telegram events')
-        tg_changed_event = TelegramNotification(config['APPRISE_TELEGRAM_KEY'], config['APPRISE_TELEGRAM_CHAT_ID'], "Garage Door Changed", logger)
-        tg_opened_event = TelegramNotification(config['APPRISE_TELEGRAM_KEY'], config['APPRISE_TELEGRAM_CHAT_ID'], "Garage Door Opened", logger)
-        tg_closed_event = TelegramNotification(config['APPRISE_TELEGRAM_KEY'], config['APPRISE_TELEGRAM_CHAT_ID'], "Garage Door Closed", logger)
-        tg_warning_event = TelegramNotification(config['APPRISE_TELEGRAM_KEY'], config['APPRISE_TELEGRAM_CHAT_ID'], "Garage Door Still Open", logger)
+        tg_changed_event = TelegramNotification(config['APPRISE_TELEGRAM_KEY'], config['APPRISE_TELEGRAM_CHAT_ID'], "Garage Door Changed", logger, config['NOTIFY_TIMEOUT'])
+        tg_opened_event = TelegramNotification(config['APPRISE_TELEGRAM_KEY'], config['APPRISE_TELEGRAM_CHAT_ID'], "Garage Door Opened", logger, config['NOTIFY_TIMEOUT'])
+        tg_closed_event = TelegramNotification(config['APPRISE_TELEGRAM_KEY'], config['APPRISE_TELEGRAM_CHAT_ID'], "Garage Door Closed", logger, config['NOTIFY_TIMEOUT'])
+        tg_warning_event = TelegramNotification(config['APPRISE_TELEGRAM_KEY'], config['APPRISE_TELEGRAM_CHAT_ID'], "Garage Door Still Open", logger, config['NOTIFY_TIMEOUT'])
     else:
         logger.info('No Telegram bot key provided. No events will be raised.')
         tg_changed_event = None    # type: TelegramNotification
@@ -67,6 +80,24 @@ try:
         tg_closed_event = None     # type: TelegramNotification
         tg_warning_event = None    # type: TelegramNotification
 
+    # Notifications are sent from worker threads so slow networks don't hold up the controller
+    logger.info('Starting notification dispatcher')
+    notifier = NotificationDispatcher(logger,
+                                      config['NOTIFY_WORKERS'],
+                                      config['NOTIFY_QUEUE_SIZE'],
+                                      config['NOTIFY_MAX_RETRIES'],
+                                      config['NOTIFY_RETRY_DELAY'],
+                                      os.path.join(instance_path, 'notifications_dead_letter.log'))
+    notifier.start()
+
+    # History is written from its own thread too. The controller starts it once the database is open.
+    event_writer = EventWriter(logger, config['EVENT_COMMIT_DELAY'], config['EVENT_QUEUE_SIZE'])
+
+    # Load the real or simulated hardware layer
+    logger.info('Loading %s hardware', config['HARDWARE'])
+    hardware = load_hardware(config['HARDWARE'], config, logger)
+    GPIO = hardware.gpio
+
     # Set up GPIO using BCM numbering
     logger.info('Setting GPIO numbering')
     GPIO.setmode(GPIO.BCM)
@@ -83,6 +114,10 @@ def finalize():
     if finalized:
         logger.info('Finalizer already called. Skipping...')
         return
+    logger.info('Writing queued history')
+    event_writer.stop()
+    logger.info('Sending queued notifications')
+    notifier.stop()
     logger.info('Calling cleanup on GPIO')
     GPIO.cleanup()
     finalized = True
@@ -1,120 +1,437 @@
 import os
+import logging
+import signal
 import time
-import schedule
 import threading
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 import zmq
 import json
-from RPi import GPIO
 from . import app
-from common.db import GarageDb
-from common.struct import Struct
+from .app import GPIO
+from common.db import GarageDb, HistoryEvent
+from common.retention import RetentionEngine
+from common import metrics, protocol
+from common.protocol import StatusRecord, DoorStatus
+from common.doors import load_doors, Door
+from .telemetry import TelemetrySampler, TelemetrySnapshot
+from .publisher import StatusPublisher
+from .debounce import EdgeDebouncer
+from .scheduler import Scheduler
+from .rules import RuleEngine, Rule, load_rules
+from .relay_jobs import RelayJobRunner, RelayJob, MAX_WAIT_SECONDS
+from .recent_events import RecentEvents
 
 OPEN = "OPEN"
 CLOSED = "CLOSED"
 
+REPLY_ADDR = "inproc://garagepi-replies"
+
+# Longest trigger_relay waits for its pulse, which may be queued behind another program for the door
+RELAY_JOB_WAIT = 90.0
+
+IPC_OPERATION_SECONDS = metrics.registry.histogram('garagepi_ipc_operation_seconds',
+                                                   'Time the backend spent handling each IPC operation',
+                                                   ['operation', 'format'])
+IPC_OPERATION_ERRORS = metrics.registry.counter('garagepi_ipc_operation_errors',
+                                                'IPC operations that raised an exception', ['operation'])
+GPIO_CALLBACK_SECONDS = metrics.registry.histogram('garagepi_gpio_callback_seconds',
+                                                   'Time spent in GPIO edge callbacks and door change handling',
+                                                   ['callback'])
+
+
+class OperationQueueStats:
+    """
+    Tracks how many requests of each operation are waiting or running.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__depth = {}
+        self.__max_depth = {}
+        self.__count = {}
+
+    def enqueued(self, operation: str):
+        with self.__lock:
+            depth = self.__depth.get(operation, 0) + 1
+            self.__depth[operation] = depth
+            self.__max_depth[operation] = max(depth, self.__max_depth.get(operation, 0))
+            self.__count[operation] = self.__count.get(operation, 0) + 1
+
+    def finished(self, operation: str):
+        with self.__lock:
+            self.__depth[operation] -= 1
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {op: dict(depth=self.__depth[op], max_depth=self.__max_depth[op], count=self.__count[op])
+                    for op in self.__count}
+
+
 class GaragePiController:
     def __init__(self, port="5550"):
         self.__bind_addr = "tcp://*:%s" % port
         app.logger.info("Bind address: " + self.__bind_addr)
 
-        self.__relay_lock = threading.Lock()
-
-        self.__db = GarageDb(app.instance_path, app.resource_path)
-
-        # Get initial reed state and subscribe to events
-        GPIO.setup(app.config['REED_PIN'], GPIO.IN)
-        GPIO.add_event_detect(app.config['REED_PIN'], GPIO.BOTH, callback=self.door_opened_or_closed)
-        self.__door_state = None                            # 1 for open, 0 for closed, None for uninitialized
-        self.door_opened_or_closed(app.config['REED_PIN'])  # force update
-
-        # Set up warning timer if there's a setting
-        if app.config['DOOR_OPEN_WARNING_TIME']:
-            app.logger.info('Starting schedule to check door at {0}...'.format(app.config['DOOR_OPEN_WARNING_TIME']))
-            schedule.every().day.at(app.config['DOOR_OPEN_WARNING_TIME']).do(self.check_door_open_for_warning)
-            t = Thread(target=self.run_schedule)
-            t.start()
-        else:
-            app.logger.info('No schedule to run.')
+        self.__doors = load_doors(app.config)
+        self.__doors_by_id = {door.id: door for door in self.__doors}
+        self.__doors_by_reed_pin = {door.reed_pin: door for door in self.__doors}
+        self.__door_states = {door.id: None for door in self.__doors}   # 1 for open, 0 for closed, None for uninitialized
+        app.logger.info('Controlling doors: %s' % ', '.join(door.id for door in self.__doors))
+
+        # Operations that can block (like pulsing the relay) are handed to a worker pool so
+        # they don't hold up fast read-only ones. Maps operation name to (handler, inline).
+        self.__operations = {
+            'negotiate': (self.__negotiate, True),
+            'echo': (self.__echo, True),
+            'get_status': (self.__get_status, True),
+            'get_stats': (self.__get_stats, True),
+            'get_metrics': (self.__get_metrics, True),
+            'trigger_relay': (self.__trigger_relay, False),
+            'run_relay_program': (self.__run_relay_program, True),
+            'get_job': (self.__get_job, True),
+            'get_history': (self.__get_history, False),
+            'get_recent_events': (self.__get_recent_events, True),
+        }
+        # Handlers for operations that can also be sent in the binary format
+        self.__binary_handlers = {
+            'echo': self.__echo_binary,
+            'get_status': self.__get_status_binary,
+            'trigger_relay': self.__trigger_relay_binary,
+        }
+        self.__workers = ThreadPoolExecutor(app.config['IPC_WORKERS'])
+        self.__worker_local = threading.local()
+        self.__queue_stats = OperationQueueStats()
+
+        self.__db = GarageDb(app.instance_path, app.resource_path,
+                             app.config['DB_CACHE_SIZE_KB'], app.config['DB_MMAP_SIZE_MB'])
+
+        # Usage stats are kept up to date as events are recorded but have to be built once from older history
+        if self.__db.backfill_door_stats():
+            app.logger.info('Built door usage stats from existing history')
+
+        # The one full vacuum older files need is done here, before anything is being recorded
+        if app.config['HISTORY_VACUUM'] and not self.__db.incremental_vacuum_enabled():
+            app.logger.info('Switching history to incremental vacuum. This is a one-time full vacuum.')
+            self.__db.enable_incremental_vacuum()
+
+        # Status changes are pushed to subscribers such as the webserver's event stream
+        self.__publisher = StatusPublisher(app.logger, app.config['STATUS_PUB_PORT'])
+
+        # The newest events are kept in memory too, so recent history is read without touching the
+        # database. The lock keeps ids in the same order events are queued for writing.
+        self.__history_lock = threading.Lock()
+        self.__recent = RecentEvents(app.config['RECENT_EVENTS_SIZE'])
+        self.__recent.load(*self.__db.read_recent_events(app.config['RECENT_EVENTS_SIZE']))
+
+        # Events are queued for the writer thread, which commits them in batches and then
+        # lets the webserver know history has changed
+        app.event_writer.start(self.__db, on_commit=self.__publisher.history_changed)
+
+        # Status is rebuilt whenever the door or telemetry changes so requests just return the latest copy
+        self.__status_lock = threading.Lock()
+        self.__status = None    # type: StatusRecord
+        self.__status_snapshot = None    # type: TelemetrySnapshot
+        self.__sampler = TelemetrySampler(app.logger,
+                                          app.config['TELEMETRY_INTERVAL'],
+                                          app.config['TELEMETRY_MAX_AGE'],
+                                          on_sample=self.__telemetry_sampled,
+                                          read_cpu=app.hardware.read_cpu_temperature,
+                                          read_gpu=app.hardware.read_gpu_temperature)
+
+        # Timed jobs and door rules share one thread that sleeps until the next one is due.
+        # Rules are armed when a door opens, so this has to be ready before the doors are read.
+        self.__scheduler = Scheduler(app.logger)
+        self.__rules = RuleEngine(app.logger, self.__scheduler, load_rules(app.config), self.__door_warning)
+        if self.__rules.rules:
+            app.logger.info('Watching doors with {0} rules'.format(len(self.__rules.rules)))
+
+        # Relay programs run on the scheduler too. Each door runs one at a time, but
+        # different doors can be moved at the same time. Waits can always be as long as
+        # the crack delay, since that's what /crack asks for.
+        crack_delay = app.config['CRACK_DELAY']
+        if isinstance(crack_delay, bool) or not isinstance(crack_delay, (int, float)) or crack_delay <= 0:
+            raise ValueError('CRACK_DELAY must be a number of seconds above 0, not %r' % (crack_delay,))
+        self.__relay_jobs = RelayJobRunner(app.logger, self.__scheduler, self.__relay_on, self.__relay_off,
+                                           app.config['TRIGGER_MERGE_WINDOW'], max(MAX_WAIT_SECONDS, crack_delay))
+
+        # Lets the webserver know its cached versions are still current even when nothing changes
+        self.__scheduler.call_every(app.config['PUBLISH_HEARTBEAT'], self.__publisher.publish_versions)
+
+        # Edges from the reed switch are debounced before the door state is updated
+        self.__debouncer = EdgeDebouncer(app.logger, GPIO.input, self.door_opened_or_closed,
+                                         app.config['REED_SETTLE_MS'] / 1000.0)
+
+        # Get initial reed states and subscribe to events. One debouncer thread serves every door.
+        self.__reed_edge_seconds = GPIO_CALLBACK_SECONDS.labels('reed_edge')
+        self.__door_change_seconds = GPIO_CALLBACK_SECONDS.labels('door_change')
+        for door in self.__doors:
+            GPIO.setup(door.reed_pin, GPIO.IN)
+            GPIO.add_event_detect(door.reed_pin, GPIO.BOTH, callback=self.__reed_edge)
+            self.door_opened_or_closed(door.reed_pin)  # force update
+            self.__debouncer.watch(door.reed_pin)
+        self.__debouncer.start()
+
+        self.__sampler.start()
+
+        # Set up daily history retention if there's a setting
+        if app.config['HISTORY_RETENTION_DAYS']:
+            app.logger.info('Scheduling history retention at {0}...'.format(app.config['HISTORY_RETENTION_TIME']))
+            archive_path = os.path.join(app.instance_path, 'archive') if app.config['HISTORY_ARCHIVE'] else None
+            self.__retention = RetentionEngine(self.__db, app.logger,
+                                               app.config['HISTORY_RETENTION_DAYS'],
+                                               archive_path,
+                                               app.config['HISTORY_RETENTION_BATCH'],
+                                               on_removed=self.__recent.forget)
+            self.__scheduler.call_daily(app.config['HISTORY_RETENTION_TIME'], self.run_retention)
+
+        self.__scheduler.start()
 
     def start(self):
-        context = zmq.Context()
+        context = zmq.Context.instance()
         socket = context.socket(zmq.ROUTER)
         socket.bind(self.__bind_addr)
         socket.setsockopt(zmq.SNDTIMEO, 1000)
 
+        # Workers hand their finished replies back here since only this thread may use the ROUTER socket
+        replies = context.socket(zmq.PULL)
+        replies.bind(REPLY_ADDR)
+
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(replies, zmq.POLLIN)
+
+        # A signal such as SIGTERM can land on any thread, and then nothing interrupts the poll
+        # below so its handler never runs. Having signals written to a pipe that's polled too
+        # wakes this thread up to run it.
+        signal_wakeup = None
+        if threading.current_thread() is threading.main_thread():
+            signal_wakeup, wakeup_write = os.pipe()
+            os.set_blocking(wakeup_write, False)
+            signal.set_wakeup_fd(wakeup_write)
+            poller.register(signal_wakeup, zmq.POLLIN)
+
         app.logger.info("Entering listen loop... ")
+        # Checked once since every message would otherwise build a log record just to drop it
+        debug_enabled = app.logger.isEnabledFor(logging.DEBUG)
 
         try:
             while True:
+                events = dict(poller.poll())
+
+                if signal_wakeup is not None and events.get(signal_wakeup) == zmq.POLLIN:
+                    os.read(signal_wakeup, 512)
+
+                if events.get(replies) == zmq.POLLIN:
+                    socket.send_multipart(replies.recv_multipart())
+
+                if events.get(socket) != zmq.POLLIN: continue
+
                 msg = socket.recv_multipart()
-                app.logger.debug("Received msg: {0}".format(msg))
+                if debug_enabled: app.logger.debug("Received msg: %s", msg)
 
-                if len(msg) != 3:
+                # Clients that negotiated another format name it in a 4th frame
+                if len(msg) not in (3, 4):
                     error_msg = 'invalid message received: %s' % msg
                     app.logger.error(error_msg)
-                    reply = [msg[0], error_msg]
+                    reply = [msg[0], str.encode(error_msg)]
                     socket.send_multipart(reply)
                     continue
 
                 # Break out incoming message
                 id = msg[0]
                 operation = bytes.decode(msg[1]) if type(msg[1]) is bytes else msg[1]
-                contents = json.loads(bytes.decode(msg[2]) if type(msg[2]) is bytes else msg[2])
-
-                # Initialize the reply. Must always send back the id with ROUTER
-                reply = [id]
-
-                if operation == 'echo':
-                    # Just echo back the original contents serialized back to a string
-                    reply.append(self.__get_json_bytes(contents))
-                elif operation == 'get_status':
-                    # Get status and return
-                    reply.append(self.get_status().to_json_bytes())
-                elif operation == 'trigger_relay':
-                    # Trigger relay
-                    self.trigger_relay(contents['user_agent'], contents['login'])
-                    reply.append(b'{}')
-                else:
+                binary_version = protocol.BINARY_VERSIONS.get(msg[3]) if len(msg) == 4 else None
+                binary = binary_version is not None
+
+                if operation not in self.__operations or (binary and operation not in self.__binary_handlers):
                     app.logger.error('unknown request')
+                    socket.send_multipart([id])
+                    continue
+
+                handler, inline = self.__operations[operation]
+                if binary:
+                    handler = self.__binary_handlers[operation]
+                    contents = (msg[2], binary_version)
+                else:
+                    contents = json.loads(bytes.decode(msg[2]) if type(msg[2]) is bytes else msg[2])
 
-                socket.send_multipart(reply)
+                self.__queue_stats.enqueued(operation)
+                if inline:
+                    # Fast read-only operations are answered right away. Must always send back the id with ROUTER
+                    socket.send_multipart([id, self.__run_operation(operation, handler, contents, binary)])
+                else:
+                    self.__workers.submit(self.__run_queued_operation, id, operation, handler, contents, binary)
 
         finally:
             app.logger.info('Closing down socket')
+            self.__workers.shutdown(wait=False)
             socket.setsockopt(zmq.LINGER, 500)
             socket.close()
+            replies.close()
+            self.__publisher.close()
+
+    def __run_operation(self, operation: str, handler, contents, binary: bool=False) -> bytes:
+        start = time.perf_counter()
+        try:
+            reply = handler(contents)
+            return protocol.pack_reply(reply) if binary else reply
+        except Exception as e:
+            app.logger.exception("Exception while handling '%s'" % operation)
+            IPC_OPERATION_ERRORS.labels(operation).inc()
+            return protocol.pack_error(str(e)) if binary else self.__get_json_bytes({'error': str(e)})
+        finally:
+            self.__queue_stats.finished(operation)
+            IPC_OPERATION_SECONDS.labels(operation, 'binary' if binary else 'json').observe(time.perf_counter() - start)
+
+    def __run_queued_operation(self, id: bytes, operation: str, handler, contents, binary: bool=False):
+        reply = self.__run_operation(operation, handler, contents, binary)
+
+        # Each worker thread needs its own socket to pass replies back on
+        reply_socket = getattr(self.__worker_local, 'reply_socket', None)
+        if reply_socket is None:
+            reply_socket = zmq.Context.instance().socket(zmq.PUSH)
+            reply_socket.connect(REPLY_ADDR)
+            self.__worker_local.reply_socket = reply_socket
+        reply_socket.send_multipart([id, reply])
+
+    def __negotiate(self, contents) -> bytes:
+        # Pick the best format both sides know. Old clients never ask and keep using JSON.
+        chosen = protocol.choose_format(contents.get('formats'))
+        return self.__get_json_bytes({'format': bytes.decode(chosen),
+                                      'formats': [bytes.decode(name) for name in protocol.SUPPORTED_FORMATS]})
+
+    def __echo(self, contents) -> bytes:
+        # Just echo back the original contents serialized back to a string
+        return self.__get_json_bytes(contents)
+
+    def __get_status(self, contents) -> bytes:
+        return self.get_status().to_json_bytes()
+
+    def __get_stats(self, contents) -> bytes:
+        # Diagnostic counters for the various components
+        return self.__get_json_bytes(self.get_stats())
+
+    def __get_metrics(self, contents) -> bytes:
+        # Sent as collected rather than rendered so the webserver can merge them with its own
+        return self.__get_json_bytes(metrics.registry.collect())
+
+    @staticmethod
+    def __history_limit(contents) -> int:
+        # Falls back to the default for anything that isn't a number, and keeps pages between 1 and 500 events
+        try:
+            limit = int(contents.get('limit', 100))
+        except (TypeError, ValueError):
+            limit = 100
+        return max(1, min(limit, 500))
+
+    def __get_history(self, contents) -> bytes:
+        # Lets a dashboard on another Pi read this one's history, a page at a time like /history_data
+        limit = self.__history_limit(contents)
+        filters = [contents.get(key) for key in ('before', 'event', 'login', 'since', 'until', 'door')]
+        if not any(filters):
+            # The newest page is usually still in memory
+            entries, complete = self.__recent.since(contents.get('after'), limit)
+            if complete:
+                for entry in entries:
+                    del entry['local_timestamp']
+                next_cursor = GarageDb.make_cursor(entries[-1]) if len(entries) == limit else None
+                return self.__get_json_bytes(dict(entries=entries, next=next_cursor))
+        entries, next_cursor = self.__db.query_history(contents.get('before'), limit,
+                                                       contents.get('event'), contents.get('login'),
+                                                       contents.get('since'), contents.get('until'),
+                                                       contents.get('door'), contents.get('after'))
+        return self.__get_json_bytes(dict(entries=[dict(entry) for entry in entries], next=next_cursor))
+
+    def __get_recent_events(self, contents) -> bytes:
+        # Answered from memory. If 'complete' is false the caller has to go to the database for the rest.
+        limit = self.__history_limit(contents)
+        entries, complete = self.__recent.since(contents.get('after'), limit)
+        return self.__get_json_bytes(dict(entries=entries, last=self.__recent.last_id, complete=complete))
+
+    def __trigger_relay(self, contents) -> bytes:
+        self.trigger_relay(contents['user_agent'], contents['login'], contents.get('door'))
+        return b'{}'
+
+    def __run_relay_program(self, contents) -> bytes:
+        # Replies as soon as the program is queued. Clients follow it with get_job.
+        job, merged = self.run_relay_program(contents['user_agent'], contents['login'], contents['steps'],
+                                             contents.get('door'))
+        return self.__get_json_bytes(dict(job.to_dict(), merged=merged))
+
+    def __get_job(self, contents) -> bytes:
+        job = self.__relay_jobs.get(contents['id'])
+        if job is None:
+            raise ValueError('Unknown job %r' % contents['id'])
+        return self.__get_json_bytes(job.to_dict())
+
+    # Binary handlers are given the raw contents and the version of the format they're in
+
+    def __echo_binary(self, contents) -> bytes:
+        return contents[0]
+
+    def __get_status_binary(self, contents) -> bytes:
+        return self.get_status().pack(contents[1])
+
+    def __trigger_relay_binary(self, contents) -> bytes:
+        data, version = contents
+        if version < 2:
+            user_agent, login = protocol.unpack_strings(data, 2)
+            door_id = None
+        else:
+            user_agent, login, door_id = protocol.unpack_strings(data, 3)
+        self.trigger_relay(user_agent, login, door_id)
+        return b''
 
     def __get_json_bytes(self, contents) -> bytes:
         json_str = json.dumps(contents)
         return str.encode(json_str)
 
-    def __add_to_history(self, event: str, description: str, user_agent='SERVER', login='SERVER'):
-        self.__db.record_event(user_agent, login, event, description)
+    def __add_to_history(self, door: Door, event: str, description: str, user_agent='SERVER', login='SERVER',
+                         is_open: bool=None, is_transition: bool=False):
+        """
+        Queues an event for a door to be written. Door readings (where is_open is given) also update the usage stats.
+        """
+        history_event = HistoryEvent(user_agent, login, event, description, door.id, is_open, is_transition)
+        with self.__history_lock:
+            self.__recent.append(history_event)
+            app.event_writer.record(history_event)
+
+    def __reed_edge(self, pin: int):
+        with self.__reed_edge_seconds.time():
+            self.__debouncer.record_edge(pin)
 
     def door_opened_or_closed(self, pin_changed: int):
         """
-        Callback for monitoring the reed switch's GPIO pin.
+        Called for a door's reed switch GPIO pin once its edges have settled.
 
         :param pin_changed: pin number for the pin that changed
         :return:
         """
+        with self.__door_change_seconds.time():
+            self.__door_opened_or_closed(pin_changed)
 
+    def __door_opened_or_closed(self, pin_changed: int):
+        door = self.__doors_by_reed_pin[pin_changed]
         new_state = GPIO.input(pin_changed)
-        old_state = self.__door_state
+        old_state = self.__door_states[door.id]
         if (new_state == old_state): return
 
-        self.__door_state = new_state
+        self.__door_states[door.id] = new_state
+        self.__update_status()
+        self.__rules.door_changed(door.id, bool(new_state))
         new_state_text = "OPEN" if new_state else "CLOSED"
 
         if (old_state is not None):
-            self.__add_to_history('SensorTrip', 'Door state changed to {0}.'.format(new_state_text))
+            self.__add_to_history(door, 'SensorTrip', 'Door state changed to {0}.'.format(new_state_text),
+                                  is_open=bool(new_state), is_transition=True)
         else:
-            self.__add_to_history('StartupSensorRead', 'Door state initialized to {0}.'.format(new_state_text))
+            self.__add_to_history(door, 'StartupSensorRead', 'Door state initialized to {0}.'.format(new_state_text),
+                                  is_open=bool(new_state))
 
         # Check for IFTTT events that need to be fired
         if (old_state is not None):
-            if self.__door_state:
+            if new_state:
                 change = 'opened'
                 specific_event = app.opened_event
                 tg_specific_event = app.tg_opened_event
@@ -123,57 +440,124 @@ class GaragePiController:
                 specific_event = app.closed_event
                 tg_specific_event = app.tg_closed_event
 
-            if app.changed_event is not None: app.changed_event.trigger(change)
-            if specific_event is not None: specific_event.trigger()
-            if tg_specific_event is not None: tg_specific_event.trigger()
+            self.__notify(door, app.changed_event, change, *self.__door_detail(door))
+            self.__notify(door, specific_event, *self.__door_detail(door))
+            self.__notify(door, tg_specific_event, *self.__door_detail(door))
+
+        app.logger.info("door %s %s (pin %d is %s)", door.id, "OPENED" if new_state else "CLOSED",
+                        pin_changed, new_state)
 
-        app.logger.info("door {0} (pin {1} is {2})".format("OPENED" if new_state else "CLOSED", pin_changed, new_state))
+    def __door_detail(self, door: Door):
+        # Notifications only name the door when there's more than one so existing applets see no change
+        return (door.name,) if len(self.__doors) > 1 else ()
 
-    def get_status(self) -> Struct:
+    def get_status(self) -> StatusRecord:
         """
-        Gets the current system status
-        :return: A Struct populated with system state info
+        Gets the current system status. This is a cached snapshot and must not be modified.
+        :return: A StatusRecord populated with system state info
         """
-        data = Struct(is_open=self.__door_state)
-        data.status_text = "OPEN" if data.is_open else "CLOSED"
-        data.cpu_temp_c = self.get_cpu_temperature()
-        data.cpu_temp_f = data.cpu_temp_c * 9.0 / 5.0 + 32
-        data.gpu_temp_c = self.get_gpu_temperature()
-        data.gpu_temp_f = data.gpu_temp_c * 9.0 / 5.0 + 32
+        # Accessing the snapshot makes sure telemetry is within the staleness bound
+        snapshot = self.__sampler.snapshot
+        status = self.__status
+        if status is None or self.__status_snapshot is not snapshot:
+            status = self.__update_status(snapshot)
+        return status
+
+    def get_stats(self) -> dict:
+        return dict(operations=self.__queue_stats.stats(),
+                    debounce=self.__debouncer.stats(),
+                    telemetry=self.__sampler.stats(),
+                    publisher=dict(publish_count=self.__publisher.publish_count),
+                    logging=app.log_queue.stats(),
+                    scheduler=self.__scheduler.stats(),
+                    relay_jobs=self.__relay_jobs.stats(),
+                    rules=self.__rules.stats(),
+                    history_writer=app.event_writer.stats(),
+                    recent_events=self.__recent.stats(),
+                    notifications=app.notifier.stats())
+
+    def __telemetry_sampled(self, snapshot: TelemetrySnapshot):
+        self.__update_status(snapshot)
+
+    def __update_status(self, snapshot: TelemetrySnapshot=None) -> StatusRecord:
+        if snapshot is None:
+            snapshot = self.__sampler.snapshot
+        with self.__status_lock:
+            doors = [DoorStatus(door.id, door.name, self.__door_states[door.id]) for door in self.__doors]
+            data = StatusRecord(doors[0].is_open,
+                                snapshot.cpu_temp_c, self.__to_fahrenheit(snapshot.cpu_temp_c),
+                                snapshot.gpu_temp_c, self.__to_fahrenheit(snapshot.gpu_temp_c),
+                                doors)
+            self.__status = data
+            self.__status_snapshot = snapshot
+            self.__publisher.publish_status(data.to_json_bytes())
         return data
 
-    def get_cpu_temperature(self) -> float:
-        res = os.popen('cat /sys/class/thermal/thermal_zone0/temp').readline()
-        app.logger.debug('Checked CPU temp and got: %r' % res)
-        return float(res) / 1000.0
-
-    def get_gpu_temperature(self) -> float:
-        res = os.popen('vcgencmd measure_temp').readline()
-        app.logger.debug('Checked GPU temp and got: %r' % res)
-        return float(res.replace("temp=","").replace("'C\n",""))
-
-    def trigger_relay(self, user_agent: str, login: str):
-        """ Triggers the relay for a short period. """
-        app.logger.debug('Triggering relay for {0} ({1})'.format(login, user_agent))
-        self.__db.record_event(user_agent if user_agent else 'UNKNOWN',
-                               login if login else 'UNKNOWN',
-                               'SwitchActivated',
-                               'Door switch activated when in {0} state.'.format(self.get_status().status_text))
-
-        with self.__relay_lock:
-            # Relay triggers on low so just setting as output will trigger
-            # and closing will switch back.
-            GPIO.setup(app.config['RELAY_PIN'], GPIO.OUT)
-            time.sleep(0.5)
-            GPIO.setup(app.config['RELAY_PIN'], GPIO.IN)
-
-    def check_door_open_for_warning(self):
-        if self.__door_state and app.warning_event is not None:
-            app.warning_event.trigger('open')
-        if self.__door_state and app.tg_warning_event is not None:
-            app.tg_warning_event.trigger()
-
-    def run_schedule(self):
-        while 1:
-            schedule.run_pending()
-            time.sleep(1)
+    @staticmethod
+    def __to_fahrenheit(temp_c):
+        return None if temp_c is None else temp_c * 9.0 / 5.0 + 32
+
+    def trigger_relay(self, user_agent: str, login: str, door_id: str=None):
+        """
+        Triggers a door's relay for a short period and waits for it to finish.
+
+        :param door_id: Id of the door to move. The default (first) door if not given.
+        """
+        job, merged = self.run_relay_program(user_agent, login, [protocol.RELAY_PULSE], door_id)
+        if not job.wait(RELAY_JOB_WAIT):
+            raise RuntimeError('Relay job %d for door %s did not finish in time' % (job.id, job.door_id))
+        if job.state == 'failed':
+            raise RuntimeError(job.failure)
+
+    def run_relay_program(self, user_agent: str, login: str, steps, door_id: str=None):
+        """
+        Queues a relay program for a door and returns without waiting for it to run.
+
+        :param steps: Program as described by relay_jobs.parse_program
+        :param door_id: Id of the door to move. The default (first) door if not given.
+        :return: The RelayJob, and True if it was a duplicate merged into an earlier one
+        """
+        door = self.__doors_by_id.get(door_id) if door_id else self.__doors[0]
+        if door is None:
+            raise ValueError("Unknown door '%s'" % door_id)
+
+        app.logger.debug('Running relay program %s for door %s for %s (%s)', steps, door.id, login, user_agent)
+        return self.__relay_jobs.submit(door.id, steps, user_agent if user_agent else 'UNKNOWN',
+                                        login if login else 'UNKNOWN')
+
+    def __relay_on(self, job: RelayJob):
+        # Called on the scheduler thread at each pulse of a relay program
+        door = self.__doors_by_id[job.door_id]
+        state_text = "OPEN" if self.__door_states[door.id] else "CLOSED"
+        self.__add_to_history(door, 'SwitchActivated',
+                              'Door switch activated when in {0} state.'.format(state_text),
+                              job.user_agent, job.login)
+        # Relay triggers on low so just setting as output will trigger
+        # and closing will switch back.
+        GPIO.setup(door.relay_pin, GPIO.OUT)
+
+    def __relay_off(self, job: RelayJob):
+        GPIO.setup(self.__doors_by_id[job.door_id].relay_pin, GPIO.IN)
+
+    def __door_warning(self, door_id: str, rule: Rule):
+        # Called on the scheduler thread when a rule fires for a door that's still open
+        door = self.__doors_by_id[door_id]
+        self.__notify(door, app.warning_event, rule.message, *self.__door_detail(door))
+        # The daily check from before there were rules is sent as plain 'open', which the Telegram title already says
+        detail = self.__door_detail(door) + (() if rule.message == 'open' else (rule.message,))
+        self.__notify(door, app.tg_warning_event, *([', '.join(detail)] if detail else []))
+
+    def __notify(self, door: Door, event, *args):
+        """ Queues an IFTTT or Telegram event for a door to be sent if it's configured. """
+        if event is None: return
+        # Keyed by door so an open and the close after it can't be sent out of order
+        app.notifier.submit(event.event_name, event.trigger, *args, key=door.id)
+
+    def run_retention(self):
+        # Retention can take a while on a big history so keep it off the scheduler thread
+        Thread(target=self.__run_retention, name='HistoryRetention').start()
+
+    def __run_retention(self):
+        # Memory drops each batch's rows as they're removed. New events carry on being recorded meanwhile.
+        if self.__retention.run():
+            self.__publisher.history_changed()
@@ -0,0 +1,114 @@
+import threading
+import time
+import logging
+from collections import deque
+
+
+class EdgeDebouncer(object):
+    """
+    Filters out switch bounce on GPIO inputs.
+
+    The GPIO callback only timestamps the edge into a ring buffer. A separate
+    thread waits until a pin has been quiet for the settle window, reads the
+    pin once, and reports a change only if the level really is different from
+    the last one reported.
+    """
+
+    def __init__(self, logger: logging.Logger, read_level, on_change, settle: float=0.05, capacity: int=1024):
+        """
+        :param logger: Logger for logging purposes
+        :param read_level: Callable that reads a pin's current level
+        :param on_change: Callable invoked with the pin number once a change has settled
+        :param settle: Seconds a pin must go without edges before it's read
+        :param capacity: Most edges held before the oldest are dropped
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__read_level = read_level
+        self.__on_change = on_change
+        self.__settle = settle
+
+        # Appending to a deque is atomic so the GPIO callback never has to take a lock
+        self.__edges = deque(maxlen=capacity)
+        self.__wake = threading.Event()
+        self.__stop = False
+        self.__levels = {}      # last level reported for each watched pin
+
+        self.edge_count = 0             # edges recorded by the callback
+        self.processed_edge_count = 0   # edges taken off the ring buffer
+        self.burst_count = 0            # groups of edges that settled
+        self.transition_count = 0       # bursts that changed the level and were reported
+        self.suppressed_count = 0       # bursts that ended at the level they started at
+        self.max_burst_edges = 0
+        self.max_burst_duration = 0.0
+
+    def watch(self, pin: int):
+        """ Starts tracking a pin from its current level. """
+        self.__levels[pin] = self.__read_level(pin)
+
+    def start(self):
+        threading.Thread(target=self.__run, name='EdgeDebouncer', daemon=True).start()
+
+    def stop(self):
+        self.__stop = True
+        self.__wake.set()
+
+    def record_edge(self, pin: int):
+        """ GPIO callback. Only records the edge so it returns right away. """
+        self.__edges.append((time.monotonic(), pin))
+        self.edge_count += 1
+        self.__wake.set()
+
+    def stats(self) -> dict:
+        return dict(settle=self.__settle,
+                    edge_count=self.edge_count,
+                    dropped_edge_count=self.edge_count - self.processed_edge_count - len(self.__edges),
+                    burst_count=self.burst_count,
+                    transition_count=self.transition_count,
+                    suppressed_count=self.suppressed_count,
+                    max_burst_edges=self.max_burst_edges,
+                    max_burst_duration=self.max_burst_duration)
+
+    def __run(self):
+        pending = {}    # pin -> [first edge time, last edge time, edge count]
+        while not self.__stop:
+            timeout = None
+            if pending:
+                timeout = max(0.0, min(burst[1] for burst in pending.values()) + self.__settle - time.monotonic())
+            self.__wake.wait(timeout)
+            self.__wake.clear()
+
+            while self.__edges:
+                edge_time, pin = self.__edges.popleft()
+                self.processed_edge_count += 1
+                burst = pending.get(pin)
+                if burst is None:
+                    pending[pin] = [edge_time, edge_time, 1]
+                else:
+                    burst[1] = edge_time
+                    burst[2] += 1
+
+            now = time.monotonic()
+            for pin, burst in list(pending.items()):
+                if burst[1] + self.__settle > now: continue
+                del pending[pin]
+                try:
+                    self.__settled(pin, burst)
+                except:
+                    self.__logger.exception('Exception while handling change on pin %d' % pin)
+
+    def __settled(self, pin: int, burst):
+        first_edge, last_edge, edges = burst
+        self.burst_count += 1
+        self.max_burst_edges = max(self.max_burst_edges, edges)
+        self.max_burst_duration = max(self.max_burst_duration, last_edge - first_edge)
+
+        level = self.__read_level(pin)
+        if pin in self.__levels and level == self.__levels[pin]:
+            self.suppressed_count += 1
+            self.__logger.debug('Ignored %d edges on pin %d that settled back at %s', edges, pin, level)
+            return
+
+        self.__levels[pin] = level
+        self.transition_count += 1
+        self.__on_change(pin)
@@ -0,0 +1,30 @@
+import logging
+from collections import namedtuple
+
+# The GPIO module (or a stand-in with the same API) along with callables to read
+# the CPU and GPU temperatures. Temperature readers are None to use the Pi's own sources.
+Hardware = namedtuple('Hardware', ['gpio', 'read_cpu_temperature', 'read_gpu_temperature'])
+
+
+def load_hardware(name: str, config, logger: logging.Logger) -> Hardware:
+    """
+    Loads the hardware layer selected in the config.
+
+    :param name: 'rpi' for a real Raspberry Pi or 'sim' for simulated hardware
+    :param config: App config, used to wire up the simulated doors
+    :param logger: Logger the simulated hardware reports callback errors to
+    """
+    if name == 'sim':
+        from .sim import SimulatedGPIO, SimulatedDoor, SimulatedThermal
+        from common.doors import load_doors
+        gpio = SimulatedGPIO(logger)
+        for door in load_doors(config):
+            SimulatedDoor(gpio, door.reed_pin, door.relay_pin, config['SIM_DOOR_TRAVEL_TIME'])
+        thermal = SimulatedThermal()
+        return Hardware(gpio, thermal.read_cpu_temperature, thermal.read_gpu_temperature)
+
+    if name == 'rpi':
+        import RPi.GPIO as GPIO
+        return Hardware(GPIO, None, None)
+
+    raise ValueError("Unknown HARDWARE setting '%s'" % name)
@@ -0,0 +1,77 @@
+import threading
+import logging
+import time
+import zmq
+
+STATUS_TOPIC = b'status'
+VERSION_TOPIC = b'version'
+
+
+class StatusPublisher(object):
+    """
+    Publishes status changes on a PUB socket so the webserver can push them
+    to browsers instead of polling.
+
+    Every message also carries the current status and history versions. The
+    webserver uses them as ETags, so it can tell a browser its copy is still
+    current without asking the backend or reading the database. Versions
+    start with this process's start time so they're never reused after a
+    restart.
+    """
+
+    def __init__(self, logger: logging.Logger, port="5551"):
+        assert logger is not None
+        self.__logger = logger
+        self.__bind_addr = "tcp://*:%s" % port
+        self.__logger.info("Publish address: " + self.__bind_addr)
+
+        # Sockets aren't thread safe and we publish from the GPIO callback and sampler threads
+        self.__lock = threading.Lock()
+        self.__context = zmq.Context.instance()
+        self.__socket = self.__context.socket(zmq.PUB)
+        self.__socket.setsockopt(zmq.SNDHWM, 100)
+        self.__socket.bind(self.__bind_addr)
+
+        self.__last_status = None   # type: bytes
+        self.__epoch = b'%x' % int(time.time() * 1000)
+        self.__status_generation = 0
+        self.__history_generation = 0
+        self.publish_count = 0
+
+    def publish_status(self, status_json: bytes):
+        """ Publishes the status if it differs from the last one that was sent. """
+        with self.__lock:
+            if status_json == self.__last_status: return
+            self.__last_status = status_json
+            self.__status_generation += 1
+            self.__send([STATUS_TOPIC, status_json] + self.__versions())
+
+    def history_changed(self):
+        """ Publishes a new history version. Call it once rows are committed, not before. """
+        with self.__lock:
+            self.__history_generation += 1
+            self.__send([VERSION_TOPIC] + self.__versions())
+
+    def publish_versions(self):
+        """
+        Repeats the current versions. Subscribers can miss messages while they're
+        connecting, so they only trust versions they've heard recently.
+        """
+        with self.__lock:
+            self.__send([VERSION_TOPIC] + self.__versions())
+
+    def __versions(self) -> list:
+        return [b'%s.%d' % (self.__epoch, self.__status_generation),
+                b'%s.%d' % (self.__epoch, self.__history_generation)]
+
+    def __send(self, frames: list):
+        try:
+            self.__socket.send_multipart(frames, zmq.NOBLOCK)
+            self.publish_count += 1
+        except zmq.error.Again:
+            self.__logger.warning("Dropped status update because the publish queue is full")
+
+    def close(self):
+        with self.__lock:
+            self.__socket.setsockopt(zmq.LINGER, 0)
+            self.__socket.close()
@@ -0,0 +1,114 @@
+import threading
+from common.analytics import TIMESTAMP_FORMAT, parse_timestamp
+from common.db import HistoryEvent
+
+FIELDS = ('id', 'timestamp', 'local_timestamp', 'event', 'login', 'description', 'door')
+
+
+class RecentEvents(object):
+    """
+    Keeps the newest history events in memory so recent history, and what's
+    changed since a client last looked, can be answered without reading the
+    database. Events are kept as tuples in a fixed size ring indexed by id,
+    and the ring also hands out the ids so they match the order events are
+    queued to be written.
+    """
+
+    def __init__(self, size: int=500):
+        """
+        :param size: Most events to keep
+        """
+        assert size > 0
+        self.__size = size
+        self.__lock = threading.Lock()
+        self.__ring = [None] * size     # id % size -> tuple of FIELDS
+        self.__first_id = None          # lowest id in history, kept or not
+        self.__last_id = 0              # highest id handed out, 0 while history is empty
+
+        self.hit_count = 0
+        self.miss_count = 0
+
+    @property
+    def last_id(self) -> int:
+        return self.__last_id
+
+    def load(self, rows, first_id: int, last_id: int):
+        """
+        Replaces what's kept with rows read from the database.
+
+        :param rows: Newest rows from GarageDb.read_recent_events
+        :param first_id: Lowest id in history, or None if it's empty
+        :param last_id: Highest id ever used, so new events carry on after it
+        """
+        with self.__lock:
+            self.__ring = [None] * self.__size
+            for row in rows:
+                if row['id'] > (last_id or 0) - self.__size:
+                    self.__ring[row['id'] % self.__size] = tuple(row[field] for field in FIELDS)
+            self.__first_id = first_id
+            self.__last_id = last_id or 0
+
+    def forget(self, ids, first_id: int):
+        """
+        Drops events once they've been removed from the database.
+
+        :param ids: Ids of the removed events, which needn't be the oldest ones
+        :param first_id: Lowest id left in the database, or None if it's empty
+        """
+        with self.__lock:
+            for id in ids:
+                entry = self.__ring[id % self.__size]
+                if entry is not None and entry[0] == id:
+                    self.__ring[id % self.__size] = None
+            # Events still waiting to be written aren't in the database yet, so look at what's kept too
+            kept = [entry[0] for entry in self.__ring if entry is not None]
+            lowest = [id for id in (first_id, min(kept) if kept else None) if id is not None]
+            self.__first_id = min(lowest) if lowest else None
+
+    def append(self, event: HistoryEvent) -> int:
+        """ Keeps an event that's about to be queued for writing and sets its id. """
+        # Converting to local time once here saves every reader from doing it
+        local_timestamp = parse_timestamp(event.timestamp).strftime(TIMESTAMP_FORMAT)
+        with self.__lock:
+            self.__last_id += 1
+            event.id = self.__last_id
+            if self.__first_id is None: self.__first_id = event.id
+            self.__ring[event.id % self.__size] = (event.id, event.timestamp, local_timestamp, event.event,
+                                                    event.login, event.description, event.door)
+        return event.id
+
+    def since(self, after: int=None, limit: int=100):
+        """
+        Gets the newest events, newest first.
+
+        :param after: Only include events with ids above this one
+        :param limit: Most events to return
+        :return: Tuple of the events as dicts, and whether they're everything the database would have returned
+        """
+        with self.__lock:
+            # While history is empty it starts after the last id handed out
+            first_id = self.__first_id if self.__first_id is not None else self.__last_id + 1
+            oldest_kept = max(self.__last_id - self.__size + 1, first_id)
+            stop = oldest_kept - 1 if after is None else max(after, oldest_kept - 1)
+            # Ids whose rows were removed or never written leave gaps, so count events rather than ids
+            entries = []
+            id = self.__last_id
+            while id > stop and len(entries) < limit:
+                entry = self.__ring[id % self.__size]
+                if entry is not None: entries.append(entry)
+                id -= 1
+            # Complete if the limit was reached, everything after 'after' is kept, or everything is kept
+            complete = len(entries) == limit or (after is not None and after >= oldest_kept - 1) or \
+                oldest_kept == first_id
+            if complete:
+                self.hit_count += 1
+            else:
+                self.miss_count += 1
+        return [dict(zip(FIELDS, entry)) for entry in entries], complete
+
+    def stats(self) -> dict:
+        with self.__lock:
+            kept = self.__last_id - max(self.__last_id - self.__size + 1, self.__first_id or 1) + 1 \
+                if self.__first_id is not None else 0
+            return dict(size=self.__size, kept=kept, last_id=self.__last_id,
+                        hit_count=self.hit_count, miss_count=self.miss_count)
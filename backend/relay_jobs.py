@@ -0,0 +1,193 @@
+import collections
+import itertools
+import logging
+import threading
+import time
+from common.protocol import RELAY_PULSE
+from .scheduler import Scheduler
+
+PULSE_SECONDS = 0.5
+MAX_STEPS = 16
+MAX_WAIT_SECONDS = 60.0
+KEEP_JOBS = 100
+
+
+def parse_program(steps, max_wait: float=MAX_WAIT_SECONDS) -> tuple:
+    """
+    Checks a relay program. Each step is RELAY_PULSE to pulse the relay or a
+    number of seconds to wait, so cracking the door open is [pulse, 2, pulse].
+
+    :param max_wait: Longest wait step allowed, in seconds
+    """
+    if not steps or len(steps) > MAX_STEPS:
+        raise ValueError('A relay program needs 1 to %d steps' % MAX_STEPS)
+    program = []
+    for step in steps:
+        if step == RELAY_PULSE:
+            program.append(RELAY_PULSE)
+        elif isinstance(step, (int, float)) and not isinstance(step, bool) and 0 < step <= max_wait:
+            program.append(float(step))
+        else:
+            raise ValueError("Relay program steps must be '%s' or up to %g seconds to wait, not %r"
+                             % (RELAY_PULSE, max_wait, step))
+    return tuple(program)
+
+
+class RelayJob(object):
+    """ A relay program submitted for a door, and how far it's got. """
+
+    def __init__(self, id: int, door_id: str, steps: tuple, user_agent: str, login: str):
+        self.id = id
+        self.door_id = door_id
+        self.steps = steps
+        self.user_agent = user_agent
+        self.login = login
+        self.state = 'queued'
+        self.failure = None     # why it failed, kept apart from the 'error' IPC replies use
+        self.merged_count = 0
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.next_step = 0
+        self.submitted_monotonic = time.monotonic()
+        self.__done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self.__done.is_set()
+
+    def wait(self, timeout: float=None) -> bool:
+        """ Waits for the program to finish. Returns False if it timed out. """
+        return self.__done.wait(timeout)
+
+    def finish(self, state: str, failure: str=None):
+        self.state = state
+        self.failure = failure
+        self.finished = time.time()
+        self.__done.set()
+
+    def to_dict(self) -> dict:
+        return dict(id=self.id, door=self.door_id, steps=list(self.steps), state=self.state, failure=self.failure,
+                    merged_count=self.merged_count, submitted=self.submitted, started=self.started,
+                    finished=self.finished)
+
+
+class RelayJobRunner(object):
+    """
+    Runs relay programs on the scheduler's timers, so nothing waits in a thread
+    between steps. Each door runs one program at a time and later ones queue
+    behind it. The same program submitted again for a door within the merge
+    window is treated as a duplicate, such as a double tap, and returns the
+    first job instead of moving the door back.
+    """
+
+    def __init__(self, logger: logging.Logger, scheduler: Scheduler, pulse_on, pulse_off, merge_window: float=0.0,
+                 max_wait: float=MAX_WAIT_SECONDS):
+        """
+        :param logger: Logger for logging purposes
+        :param scheduler: Scheduler to run the steps on
+        :param pulse_on: Callable given the RelayJob that starts a pulse of its door's relay
+        :param pulse_off: Callable given the RelayJob that ends the pulse
+        :param merge_window: Seconds after a submission that the same program for the same door is merged into it
+        :param max_wait: Longest wait step a program may have, in seconds
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__scheduler = scheduler
+        self.__pulse_on = pulse_on
+        self.__pulse_off = pulse_off
+        self.__merge_window = merge_window
+        self.__max_wait = max_wait
+
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count(1)
+        self.__jobs = collections.OrderedDict()    # id -> RelayJob, oldest first
+        self.__queues = {}      # door id -> deque of RelayJob, the first of which is running
+        self.__last = {}        # door id -> RelayJob most recently submitted
+
+        self.submitted_count = 0
+        self.merged_count = 0
+        self.failed_count = 0
+
+    def submit(self, door_id: str, steps, user_agent: str, login: str):
+        """
+        Queues a relay program for a door.
+
+        :return: The RelayJob, and True if it was merged into an earlier one
+        """
+        steps = parse_program(steps, self.__max_wait)
+        with self.__lock:
+            last = self.__last.get(door_id)
+            if last is not None and last.steps == steps and \
+                    time.monotonic() - last.submitted_monotonic < self.__merge_window:
+                last.merged_count += 1
+                self.merged_count += 1
+                self.__logger.info('Merged duplicate relay program for door %s into job %d', door_id, last.id)
+                return last, True
+
+            job = RelayJob(next(self.__ids), door_id, steps, user_agent, login)
+            self.__jobs[job.id] = job
+            while len(self.__jobs) > KEEP_JOBS:
+                self.__jobs.popitem(last=False)
+            self.__last[door_id] = job
+            self.submitted_count += 1
+            queue = self.__queues.setdefault(door_id, collections.deque())
+            queue.append(job)
+            idle = len(queue) == 1
+        if idle:
+            # Steps always run on the scheduler thread, which keeps each door's relay to one caller
+            self.__scheduler.call_later(0, self.__step, job)
+        return job, False
+
+    def get(self, job_id: int) -> RelayJob:
+        """ Gets a recent job by id, or None if it's unknown or has been forgotten. """
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            queued = sum(len(queue) for queue in self.__queues.values())
+        return dict(queued=queued, submitted_count=self.submitted_count, merged_count=self.merged_count,
+                    failed_count=self.failed_count)
+
+    def __step(self, job: RelayJob):
+        if job.started is None:
+            job.state = 'running'
+            job.started = time.time()
+        if job.next_step == len(job.steps):
+            self.__finish(job, 'done')
+            return
+
+        step = job.steps[job.next_step]
+        job.next_step += 1
+        if step != RELAY_PULSE:
+            self.__scheduler.call_later(step, self.__step, job)
+            return
+        try:
+            self.__pulse_on(job)
+        except Exception as e:
+            self.__logger.exception('Relay job %d failed to pulse door %s', job.id, job.door_id)
+            self.__end_pulse(job, str(e))
+            return
+        self.__scheduler.call_later(PULSE_SECONDS, self.__end_pulse, job)
+
+    def __end_pulse(self, job: RelayJob, error: str=None):
+        try:
+            self.__pulse_off(job)
+        except Exception as e:
+            self.__logger.exception('Relay job %d failed to release door %s', job.id, job.door_id)
+            error = error or str(e)
+        if error is None:
+            self.__step(job)
+        else:
+            self.__finish(job, 'failed', error)
+
+    def __finish(self, job: RelayJob, state: str, error: str=None):
+        job.finish(state, error)
+        with self.__lock:
+            if state == 'failed': self.failed_count += 1
+            queue = self.__queues[job.door_id]
+            queue.popleft()
+            next_job = queue[0] if queue else None
+        if next_job is not None:
+            self.__step(next_job)
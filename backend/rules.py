@@ -0,0 +1,167 @@
+import datetime
+import logging
+import threading
+from .scheduler import Scheduler, parse_time_of_day, seconds_until
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+class Rule(object):
+    """
+    Says when to warn about a door that's been left open. Rules are armed for
+    a door when it opens and disarmed when it closes, so nothing is checked
+    while doors are closed.
+    """
+
+    def __init__(self, message: str, doors=None, repeat_minutes: float=None):
+        """
+        :param message: Sent with the warning, for example as the IFTTT value1
+        :param doors: Ids of the doors this applies to. All doors if not given.
+        :param repeat_minutes: Minutes between reminders while the door stays open. Warn once if not given.
+        """
+        self.message = message
+        self.doors = set(doors) if doors else None
+        self.repeat = repeat_minutes * 60 if repeat_minutes else None
+
+    def applies_to(self, door_id: str) -> bool:
+        return self.doors is None or door_id in self.doors
+
+    def first_delay(self, now: datetime.datetime) -> float:
+        """ Seconds from a door opening at the given time until the first warning. """
+        raise NotImplementedError()
+
+    def next_delay(self, now: datetime.datetime) -> float:
+        """ Seconds from a warning at the given time until the next one, or None for no more. """
+        raise NotImplementedError()
+
+
+class OpenLongerThan(Rule):
+    """ Warns once a door has been open for a number of minutes. """
+
+    def __init__(self, minutes: float, message: str=None, doors=None, repeat_minutes: float=None):
+        super().__init__(message or 'open for %g minutes' % minutes, doors, repeat_minutes)
+        self.delay = minutes * 60
+
+    def first_delay(self, now: datetime.datetime) -> float:
+        return self.delay
+
+    def next_delay(self, now: datetime.datetime) -> float:
+        return self.repeat
+
+
+class OpenDuring(Rule):
+    """
+    Warns when a door is open during a time window, such as overnight. Without
+    an end time it warns if the door is open when the clock reaches the start.
+    """
+
+    def __init__(self, start: str, end: str=None, message: str=None, doors=None, repeat_minutes: float=None):
+        super().__init__(message or ('open between %s and %s' % (start, end) if end else 'open at %s' % start),
+                         doors, repeat_minutes)
+        # Check the times up front so a typo shows up at startup rather than when a door opens
+        parse_time_of_day(start)
+        if end: parse_time_of_day(end)
+        self.start = start
+        self.end = end
+
+    def in_window(self, now: datetime.datetime) -> bool:
+        if not self.end: return False
+        start, end, time = parse_time_of_day(self.start), parse_time_of_day(self.end), now.time()
+        # Windows can run past midnight
+        return start <= time < end if start <= end else time >= start or time < end
+
+    def first_delay(self, now: datetime.datetime) -> float:
+        return 0.0 if self.in_window(now) else seconds_until(self.start, now)
+
+    def next_delay(self, now: datetime.datetime) -> float:
+        if self.repeat and self.in_window(now + datetime.timedelta(seconds=self.repeat)):
+            return self.repeat
+        # Otherwise wait for the window to come round again, which is always tomorrow
+        delay = seconds_until(self.start, now)
+        return delay + DAY_SECONDS if delay < 60 else delay
+
+
+RULE_TYPES = {
+    'open_longer_than': OpenLongerThan,
+    'open_during': OpenDuring,
+}
+
+
+def load_rules(config) -> list:
+    """
+    Reads the rules from the app config: each entry in DOOR_RULES, plus the
+    daily DOOR_OPEN_WARNING_TIME check if that's set.
+    """
+    rules = []
+    if config.get('DOOR_OPEN_WARNING_TIME'):
+        # Sent as 'open' like the check this replaced so existing applets keep working
+        rules.append(OpenDuring(config['DOOR_OPEN_WARNING_TIME'], message='open'))
+    for entry in config.get('DOOR_RULES') or []:
+        entry = dict(entry)
+        rule_type = entry.pop('type', None)
+        if rule_type not in RULE_TYPES:
+            raise ValueError("Unknown door rule type '%s'" % rule_type)
+        rules.append(RULE_TYPES[rule_type](**entry))
+    return rules
+
+
+class RuleEngine(object):
+    """
+    Arms each rule for a door when it opens and cancels them when it closes,
+    using timers on the scheduler rather than checking the doors periodically.
+    """
+
+    def __init__(self, logger: logging.Logger, scheduler: Scheduler, rules, on_warning):
+        """
+        :param logger: Logger for logging purposes
+        :param scheduler: Scheduler to set the timers on
+        :param rules: List of Rule
+        :param on_warning: Callable invoked with the door id and the Rule when a rule fires
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__scheduler = scheduler
+        self.__rules = list(rules)
+        self.__on_warning = on_warning
+        self.__lock = threading.Lock()
+        self.__armed = {}           # door id -> {rule index: Timer}
+        self.warning_count = 0
+
+    @property
+    def rules(self) -> list:
+        return self.__rules
+
+    def door_changed(self, door_id: str, is_open: bool):
+        with self.__lock:
+            timers = self.__armed.pop(door_id, {})
+            for timer in timers.values():
+                timer.cancel()
+            if not is_open: return
+
+            now = datetime.datetime.now()
+            timers = {}
+            for index, rule in enumerate(self.__rules):
+                if rule.applies_to(door_id):
+                    timers[index] = self.__scheduler.call_later(rule.first_delay(now), self.__fire, door_id, index)
+            self.__armed[door_id] = timers
+
+    def __fire(self, door_id: str, index: int):
+        rule = self.__rules[index]
+        with self.__lock:
+            timers = self.__armed.get(door_id)
+            # The door may have closed (and even opened again, arming a new timer) after
+            # this timer came due but before it ran
+            if timers is None or index not in timers or not timers[index].done: return
+            delay = rule.next_delay(datetime.datetime.now())
+            if delay is None:
+                del timers[index]
+            else:
+                timers[index] = self.__scheduler.call_later(delay, self.__fire, door_id, index)
+            self.warning_count += 1
+        self.__logger.info("Door '%s' is %s", door_id, rule.message)
+        self.__on_warning(door_id, rule)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            armed = sum(len(timers) for timers in self.__armed.values())
+        return dict(rules=len(self.__rules), armed=armed, warning_count=self.warning_count)
@@ -0,0 +1,166 @@
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class Timer(object):
+    """ A call waiting in the scheduler. Cancelling one that has already run does nothing. """
+
+    __slots__ = ('deadline', 'func', 'args', 'cancelled', 'done', 'scheduler')
+
+    def __init__(self, deadline: float, func, args, scheduler):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.done = False
+        self.scheduler = scheduler
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class Scheduler(object):
+    """
+    Runs calls at given times from a single thread.
+
+    Timers are kept in a heap ordered by deadline. The thread sleeps until the
+    earliest one is due and is woken early only when a sooner timer is added,
+    so it uses no CPU while there's nothing to run. Cancelled timers are left
+    in the heap and skipped when they come up, which keeps cancelling cheap
+    when door changes disarm many rules at once.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        """
+        :param logger: Logger for logging purposes
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__condition = threading.Condition()
+        self.__heap = []
+        self.__sequence = itertools.count()     # keeps timers with the same deadline in the order they were added
+        self.__stop = False
+        self.__cancelled_in_heap = 0
+
+        self.fired_count = 0
+        self.cancelled_count = 0
+        self.wakeup_count = 0
+        self.max_lateness = 0.0
+
+    def start(self):
+        threading.Thread(target=self.__run, name='Scheduler', daemon=True).start()
+
+    def stop(self):
+        with self.__condition:
+            self.__stop = True
+            self.__condition.notify()
+
+    def call_later(self, delay: float, func, *args) -> Timer:
+        """ Runs func(*args) after the given number of seconds. """
+        return self.call_at(time.monotonic() + delay, func, *args)
+
+    def call_at(self, deadline: float, func, *args) -> Timer:
+        """ Runs func(*args) once time.monotonic() reaches the deadline. """
+        timer = Timer(deadline, func, args, self)
+        with self.__condition:
+            heapq.heappush(self.__heap, (deadline, next(self.__sequence), timer))
+            # Only the thread's current sleep can be too long, and only if this is now the first timer
+            if self.__heap[0][2] is timer:
+                self.__condition.notify()
+        return timer
+
+    def cancel(self, timer: Timer):
+        with self.__condition:
+            if timer.cancelled or timer.done: return
+            timer.cancelled = True
+            self.__cancelled_in_heap += 1
+            self.cancelled_count += 1
+
+    def call_daily(self, at: str, func, *args) -> Timer:
+        """
+        Runs func(*args) every day at the given local time.
+
+        :param at: Time of day as HH:MM in 24 hour time
+        :return: Timer for the next run. Later runs are new timers so this can't be used to stop them.
+        """
+        def run_and_repeat():
+            # The clocks can disagree by a little so make sure the next run is tomorrow's
+            delay = seconds_until(at)
+            if delay < 60: delay += 24 * 60 * 60
+            self.call_later(delay, run_and_repeat)
+            func(*args)
+        return self.call_later(seconds_until(at), run_and_repeat)
+
+    def call_every(self, interval: float, func, *args) -> Timer:
+        """
+        Runs func(*args) every interval seconds, starting one interval from now.
+
+        :return: Timer for the next run. Later runs are new timers so this can't be used to stop them.
+        """
+        def run_and_repeat():
+            self.call_later(interval, run_and_repeat)
+            func(*args)
+        return self.call_later(interval, run_and_repeat)
+
+    def stats(self) -> dict:
+        with self.__condition:
+            pending = len(self.__heap) - self.__cancelled_in_heap
+            next_in = self.__heap[0][0] - time.monotonic() if self.__heap else None
+        return dict(pending=pending,
+                    next_in=next_in,
+                    fired_count=self.fired_count,
+                    cancelled_count=self.cancelled_count,
+                    wakeup_count=self.wakeup_count,
+                    max_lateness=self.max_lateness)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__stop:
+                    self.__drop_cancelled()
+                    if self.__heap:
+                        timeout = self.__heap[0][0] - time.monotonic()
+                        if timeout <= 0: break
+                    else:
+                        timeout = None
+                    self.__condition.wait(timeout)
+                    self.wakeup_count += 1
+                if self.__stop: return
+                deadline, sequence, timer = heapq.heappop(self.__heap)
+                timer.done = True
+
+            # Run outside the lock so the call can schedule more timers
+            self.max_lateness = max(self.max_lateness, time.monotonic() - deadline)
+            self.fired_count += 1
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                self.__logger.exception('Scheduled call %r failed' % timer.func)
+
+    def __drop_cancelled(self):
+        while self.__heap and self.__heap[0][2].cancelled:
+            heapq.heappop(self.__heap)
+            self.__cancelled_in_heap -= 1
+        # Don't let a pile of cancelled timers far in the future grow the heap forever
+        if self.__cancelled_in_heap > 64 and self.__cancelled_in_heap > len(self.__heap) // 2:
+            self.__heap = [entry for entry in self.__heap if not entry[2].cancelled]
+            heapq.heapify(self.__heap)
+            self.__cancelled_in_heap = 0
+
+
+def parse_time_of_day(value: str) -> datetime.time:
+    """ Parses HH:MM in 24 hour time. """
+    return datetime.datetime.strptime(value, '%H:%M').time()
+
+
+def seconds_until(at: str, now: datetime.datetime=None) -> float:
+    """ Seconds until the next time the local clock reads the given HH:MM, which is tomorrow if it's passed. """
+    now = now or datetime.datetime.now()
+    target = datetime.datetime.combine(now.date(), parse_time_of_day(at))
+    if target <= now:
+        target += datetime.timedelta(days=1)
+    return (target - now).total_seconds()
@@ -0,0 +1,327 @@
+"""
+Simulated Raspberry Pi hardware so the backend can run and be load tested on
+an ordinary machine. Select it with HARDWARE='sim' in the app config.
+"""
+
+import csv
+import logging
+import os
+import queue
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import random
+import threading
+import time
+
+
+class SimulatedGPIO(object):
+    """
+    Stands in for the parts of the RPi.GPIO module the backend uses.
+
+    Input levels are set with set_input(). Like RPi.GPIO, edge callbacks are
+    run one at a time on a separate thread. Exceptions they raise are logged
+    and counted, since they're controller bugs the simulation is there to find.
+    """
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, logger: logging.Logger):
+        """
+        :param logger: Logger for logging purposes
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__lock = threading.Lock()
+        self.__levels = {}
+        self.__directions = {}
+        self.__callbacks = {}
+        self.__callback_queue = queue.Queue()
+        self.__relay_listeners = []
+        self.mode = None
+
+        self.edge_count = 0
+        self.relay_activation_count = 0
+        self.callback_error_count = 0
+
+        threading.Thread(target=self.__run_callbacks, name='SimulatedGPIO', daemon=True).start()
+
+    # ---- RPi.GPIO API ----
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        with self.__lock:
+            was_output = self.__directions.get(pin) == self.OUT
+            self.__directions[pin] = direction
+            listeners = list(self.__relay_listeners)
+
+        # The relay triggers when its pin is switched to an output (driven low)
+        if direction == self.OUT and not was_output:
+            self.relay_activation_count += 1
+            for listener in listeners:
+                listener(pin)
+
+    def input(self, pin):
+        return self.__levels.get(pin, self.LOW)
+
+    def output(self, pin, value):
+        self.__levels[pin] = value
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.__lock:
+            self.__callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        with self.__lock:
+            self.__callbacks.pop(pin, None)
+
+    def cleanup(self):
+        with self.__lock:
+            self.__callbacks.clear()
+            self.__directions.clear()
+
+    # ---- Simulation controls ----
+
+    def set_input(self, pin, level):
+        """ Drives an input pin, queueing its edge callback if the level changed. """
+        with self.__lock:
+            old_level = self.__levels.get(pin, self.LOW)
+            self.__levels[pin] = level
+            if level == old_level: return
+            self.edge_count += 1
+            edge, callback = self.__callbacks.get(pin, (None, None))
+        if callback is None: return
+        if edge == self.BOTH or (edge == self.RISING and level) or (edge == self.FALLING and not level):
+            self.__callback_queue.put((callback, pin))
+
+    def add_relay_listener(self, listener):
+        """ Registers a callable that's invoked with the pin number whenever a pin is switched to output. """
+        with self.__lock:
+            self.__relay_listeners.append(listener)
+
+    def wait_for_callbacks(self):
+        """ Blocks until every queued edge callback has run. """
+        self.__callback_queue.join()
+
+    def __run_callbacks(self):
+        while True:
+            callback, pin = self.__callback_queue.get()
+            try:
+                callback(pin)
+            except Exception:
+                self.callback_error_count += 1
+                self.__logger.exception('Edge callback for pin %d failed', pin)
+            finally:
+                self.__callback_queue.task_done()
+
+
+class SimulatedDoor(object):
+    """
+    A door that reacts to the relay: each activation starts the door moving
+    and the reed switch flips once it has finished travelling.
+    """
+
+    def __init__(self, gpio: SimulatedGPIO, reed_pin: int, relay_pin: int, travel_time: float=0.0,
+                 bounce_edges: int=0):
+        """
+        :param gpio: Simulated GPIO the door is wired to
+        :param reed_pin: Pin the reed switch is on. High means open.
+        :param relay_pin: Pin that activates the opener
+        :param travel_time: Seconds between the relay triggering and the reed switch changing
+        :param bounce_edges: Extra edges to generate each time the reed switch changes
+        """
+        self.__gpio = gpio
+        self.__reed_pin = reed_pin
+        self.__relay_pin = relay_pin
+        self.__travel_time = travel_time
+        self.__bounce_edges = bounce_edges
+        gpio.add_relay_listener(self.__relay_activated)
+
+    def __relay_activated(self, pin):
+        if pin != self.__relay_pin: return
+        if self.__travel_time:
+            threading.Timer(self.__travel_time, self.toggle).start()
+        else:
+            self.toggle()
+
+    def toggle(self):
+        level = 0 if self.__gpio.input(self.__reed_pin) else 1
+        for i in range(self.__bounce_edges):
+            self.__gpio.set_input(self.__reed_pin, level if i % 2 == 0 else 1 - level)
+        self.__gpio.set_input(self.__reed_pin, level)
+
+
+class SimulatedThermal(object):
+    """ CPU and GPU temperatures that wander around a typical Pi reading. """
+
+    def __init__(self, cpu_temp_c: float=48.0, gpu_temp_c: float=47.5):
+        self.__cpu_temp_c = cpu_temp_c
+        self.__gpu_temp_c = gpu_temp_c
+
+    def read_cpu_temperature(self) -> float:
+        self.__cpu_temp_c += random.uniform(-0.5, 0.5)
+        return round(self.__cpu_temp_c, 3)
+
+    def read_gpu_temperature(self) -> float:
+        self.__gpu_temp_c += random.uniform(-0.5, 0.5)
+        return round(self.__gpu_temp_c, 1)
+
+
+class NotificationSink(object):
+    """
+    Local HTTP server that accepts and counts notification requests. Point
+    IFTTT_BASE_URL at its url to exercise notifications without the internet.
+    """
+
+    def __init__(self, delay: float=0.0, port: int=0):
+        """
+        :param delay: Seconds to wait before answering each request, to mimic a slow service
+        :param port: Port to listen on. 0 picks a free one.
+        """
+        sink = self
+        lock = threading.Lock()
+        self.request_count = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                if delay: time.sleep(delay)
+                with lock:
+                    sink.request_count += 1
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'OK')
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.__server = Server(('127.0.0.1', port), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.__server.server_address[1]
+        threading.Thread(target=self.__server.serve_forever, name='NotificationSink', daemon=True).start()
+
+    def close(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+# ---- Door event traces ----
+#
+# A trace is a list of (seconds since start, reed level) tuples.
+
+BOUNCE_WINDOW = 0.1     # edges closer together than this are treated as one movement
+
+def synthetic_trace(days: float, opens_per_day: float=6, mean_open_minutes: float=10, bounce_edges: int=0,
+                    seed: int=None):
+    """
+    Generates a trace of a door opening and closing at random.
+
+    :param days: Length of time to cover
+    :param opens_per_day: Average number of times the door is opened each day
+    :param mean_open_minutes: Average time the door stays open
+    :param bounce_edges: Extra edges added around each change to mimic a bouncing switch
+    :param seed: Seed for repeatable traces
+    """
+    rng = random.Random(seed)
+    trace = []
+    t = 0.0
+    end = days * 24 * 60 * 60
+    while True:
+        t += rng.expovariate(opens_per_day / (24 * 60 * 60))
+        if t >= end: break
+        trace.extend(_with_bounce(t, 1, bounce_edges))
+        t += rng.expovariate(1 / (mean_open_minutes * 60))
+        trace.extend(_with_bounce(t, 0, bounce_edges))
+    return trace
+
+
+def _with_bounce(t: float, level: int, bounce_edges: int):
+    edges = [(t + i * 0.002, level if i % 2 == 0 else 1 - level) for i in range(bounce_edges)]
+    edges.append((t + bounce_edges * 0.002, level))
+    return edges
+
+
+def load_trace(file_name: str):
+    """ Reads a trace from a CSV file of 'seconds,level' lines. """
+    with open(file_name, newline='') as f:
+        return [(float(row[0]), int(row[1])) for row in csv.reader(f) if row and not row[0].startswith('#')]
+
+
+def save_trace(file_name: str, trace):
+    with open(file_name, 'w', newline='') as f:
+        csv.writer(f).writerows(trace)
+
+
+def trace_from_history(rows):
+    """
+    Builds a trace from recorded history rows (with Timestamp, Event and
+    Description), oldest first, so real door activity can be replayed.
+    """
+    from common.analytics import door_state_from_event, parse_timestamp
+    trace = []
+    start = None
+    for row in rows:
+        is_open = door_state_from_event(row['Event'], row['Description'])
+        if is_open is None: continue
+        when = parse_timestamp(row['Timestamp'])
+        if start is None: start = when
+        trace.append(((when - start).total_seconds(), int(is_open)))
+    return trace
+
+
+def replay(gpio: SimulatedGPIO, pin: int, trace, speed: float=1.0, min_gap: float=0.0):
+    """
+    Plays a trace into a simulated input pin.
+
+    :param speed: How many times faster than real time to play it back
+    :param min_gap: Least real time between separate door movements, so a debouncer
+                    can still tell them apart when playing back very fast. Bounce
+                    edges within a movement are never stretched out.
+    :return: Number of edges played
+    """
+    start = time.monotonic()
+    offset = 0.0
+    last_t = None
+    for t, level in trace:
+        if min_gap and last_t is not None and t - last_t > BOUNCE_WINDOW:
+            gap = (t - last_t) / speed
+            if gap < min_gap: offset += min_gap - gap
+        last_t = t
+
+        due = start + t / speed + offset
+        now = time.monotonic()
+        if due > now: time.sleep(due - now)
+        gpio.set_input(pin, level)
+    return len(trace)
+
+
+def create_instance(instance_path: str, **settings):
+    """
+    Writes an app.cfg for running against simulated hardware. Any settings
+    given override the defaults.
+    """
+    os.makedirs(instance_path, exist_ok=True)
+    settings.setdefault('HARDWARE', 'sim')
+    settings.setdefault('SECRET_KEY', os.urandom(24))
+    with open(os.path.join(instance_path, 'app.cfg'), 'w') as f:
+        for key, value in settings.items():
+            f.write('%s = %r\n' % (key, value))
@@ -0,0 +1,116 @@
+import subprocess
+import threading
+import time
+import logging
+from collections import namedtuple
+
+CPU_TEMP_FILE = '/sys/class/thermal/thermal_zone0/temp'
+GPU_TEMP_COMMAND = ['vcgencmd', 'measure_temp']
+
+# Immutable result of a single sampling pass. Temperatures are None if they couldn't be read.
+TelemetrySnapshot = namedtuple('TelemetrySnapshot', ['cpu_temp_c', 'gpu_temp_c', 'sampled_at'])
+
+
+class TelemetrySampler(object):
+    """
+    Samples the Pi's CPU and GPU temperatures on a background thread so that
+    status requests never have to touch sysfs or fork a process.
+    """
+
+    def __init__(self, logger: logging.Logger, interval: float=5.0, max_age: float=15.0, on_sample=None,
+                 read_cpu=None, read_gpu=None):
+        """
+        :param logger: Logger for logging purposes
+        :param interval: Seconds between sampling passes
+        :param max_age: Oldest a snapshot may be before a reader forces a fresh sample
+        :param on_sample: Optional callable invoked with each new TelemetrySnapshot
+        :param read_cpu: Optional callable to read the CPU temperature instead of sysfs
+        :param read_gpu: Optional callable to read the GPU temperature instead of vcgencmd
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__interval = interval
+        self.__max_age = max_age
+        self.__on_sample = on_sample
+        if read_cpu is not None: self.read_cpu_temperature = read_cpu
+        if read_gpu is not None: self.read_gpu_temperature = read_gpu
+
+        self.__sample_lock = threading.Lock()
+        self.__stop_event = threading.Event()
+        self.__thread = None    # type: threading.Thread
+
+        self.fork_count = 0         # number of processes spawned for vcgencmd
+        self.file_read_count = 0    # number of direct sysfs reads
+        self.sample_count = 0       # number of completed sampling passes
+        self.stale_count = 0        # number of times a reader found the snapshot too old
+
+        self.__snapshot = TelemetrySnapshot(None, None, 0.0)
+
+    def start(self):
+        """ Takes an initial sample and starts the background sampling thread. """
+        self.sample()
+        self.__thread = threading.Thread(target=self.__run, name='TelemetrySampler', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop_event.set()
+
+    @property
+    def snapshot(self) -> TelemetrySnapshot:
+        """
+        Gets the latest snapshot. This only resamples inline if the sampler
+        thread has fallen behind by more than the configured max age.
+        """
+        snapshot = self.__snapshot
+        if self.__max_age and time.monotonic() - snapshot.sampled_at > self.__max_age:
+            self.stale_count += 1
+            snapshot = self.sample()
+        return snapshot
+
+    def sample(self) -> TelemetrySnapshot:
+        with self.__sample_lock:
+            snapshot = TelemetrySnapshot(self.read_cpu_temperature(),
+                                         self.read_gpu_temperature(),
+                                         time.monotonic())
+            self.__snapshot = snapshot
+            self.sample_count += 1
+        if self.__on_sample is not None:
+            self.__on_sample(snapshot)
+        return snapshot
+
+    def stats(self) -> dict:
+        snapshot = self.__snapshot
+        return dict(interval=self.__interval,
+                    max_age=self.__max_age,
+                    age=time.monotonic() - snapshot.sampled_at,
+                    sample_count=self.sample_count,
+                    stale_count=self.stale_count,
+                    fork_count=self.fork_count,
+                    file_read_count=self.file_read_count)
+
+    def read_cpu_temperature(self):
+        try:
+            with open(CPU_TEMP_FILE) as f:
+                res = f.readline()
+            self.file_read_count += 1
+            return float(res) / 1000.0
+        except (OSError, ValueError) as e:
+            self.__logger.warning('Unable to read CPU temperature: %s', e)
+            return self.__snapshot.cpu_temp_c
+
+    def read_gpu_temperature(self):
+        try:
+            self.fork_count += 1
+            res = subprocess.run(GPU_TEMP_COMMAND, stdout=subprocess.PIPE, universal_newlines=True,
+                                 timeout=self.__interval or None).stdout
+            return float(res.replace("temp=", "").replace("'C", "").strip())
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            self.__logger.warning('Unable to read GPU temperature: %s', e)
+            return self.__snapshot.gpu_temp_c
+
+    def __run(self):
+        while not self.__stop_event.wait(self.__interval):
+            try:
+                self.sample()
+            except:
+                self.__logger.exception('Exception while sampling telemetry')
@@ -0,0 +1,65 @@
+# Compares the old open-per-call database access with GarageDb's reused connections.
+#
+# Run from the project root:  python3 -m benchmarks.db_connections [iterations]
+
+import os
+import sys
+import tempfile
+import time
+from sqlite3 import dbapi2 as sqlite3
+from common.db import GarageDb
+
+resource_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource')
+
+
+def per_call_connections(instance_path: str, iterations: int):
+    """ What each request used to do: run the schema script, then open and close a connection per call. """
+    db_file = os.path.join(instance_path, 'history.db')
+
+    def connect():
+        rv = sqlite3.connect(db_file)
+        rv.row_factory = sqlite3.Row
+        return rv
+
+    for i in range(iterations):
+        conn = connect()
+        with open(os.path.join(resource_path, 'schema.sql')) as f:
+            conn.cursor().executescript(f.read())
+        conn.commit()
+        conn.close()
+
+        conn = connect()
+        conn.execute('insert into entries (UserAgent, Login, Event, Description) values (?, ?, ?, ?)',
+                     ['bench', 'bench', 'SensorTrip', 'Door state changed to OPEN.'])
+        conn.commit()
+        conn.close()
+
+        conn = connect()
+        conn.execute('select datetime(timestamp, \'localtime\') as timestamp, event, description '
+                     'from entries order by timestamp desc').fetchmany(500)
+        conn.close()
+
+
+def reused_connections(instance_path: str, iterations: int):
+    for i in range(iterations):
+        db = GarageDb(instance_path, resource_path)
+        db.record_event('bench', 'bench', 'SensorTrip', 'Door state changed to OPEN.')
+        db.read_history()
+
+
+def run(iterations: int) -> dict:
+    results = {}
+    for name, func in (('per_call_connections', per_call_connections), ('reused_connections', reused_connections)):
+        with tempfile.TemporaryDirectory() as instance_path:
+            start = time.perf_counter()
+            func(instance_path, iterations)
+            elapsed = time.perf_counter() - start
+        results[name] = dict(iterations=iterations, total_s=elapsed, per_request_ms=elapsed / iterations * 1000)
+    return results
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for name, result in run(iterations).items():
+        print('%-22s %8.3f ms per request (%d requests in %.2f s)' %
+              (name, result['per_request_ms'], result['iterations'], result['total_s']))
@@ -0,0 +1,119 @@
+# Measures the fleet pages against several backends running on this machine. Each backend is a
+# separate process on simulated hardware with its own instance folder, IPC port and history.
+#
+# Run from the project root, for example for five backends:
+#   python3 -m benchmarks.fleet --nodes 5
+#
+# Status and history are timed with every backend answering, then again with one backend
+# paused (SIGSTOP) to show that a hung node costs one FLEET_TIMEOUT rather than holding up
+# the others. Asking the backends one after another is timed too for comparison.
+
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from backend import sim
+from benchmarks.suite import free_port, percentiles, populate
+from common.db import GarageDb
+from webserver.client_api import GaragePiClient
+from webserver.fleet import Fleet
+
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_backends(count: int, history_rows: int) -> list:
+    backends = []
+    for i in range(count):
+        instance_path = tempfile.mkdtemp(prefix='garagepi-fleet-%d-' % i)
+        port = free_port()
+        sim.create_instance(instance_path, IPC_PORT=port, STATUS_PUB_PORT=free_port())
+        db = GarageDb(instance_path, os.path.join(project_path, 'resource'))
+        populate(db, history_rows)
+        db.close()
+        log = open(os.path.join(instance_path, 'backend_console.log'), 'w')
+        process = subprocess.Popen([sys.executable, 'start_backend.py'], cwd=project_path,
+                                   env=dict(os.environ, GARAGEPI_INSTANCE_PATH=instance_path),
+                                   stdout=log, stderr=subprocess.STDOUT)
+        backends.append(dict(name='site%d' % i, host='localhost', port=port, process=process))
+    return backends
+
+
+def wait_for_backends(logger: logging.Logger, backends: list, timeout: float=30.0):
+    deadline = time.monotonic() + timeout
+    for backend in backends:
+        client = GaragePiClient(logger, backend['port'], binary=False, timeout=500)
+        try:
+            while client.echo('ping') != 'ping':
+                if time.monotonic() > deadline: raise RuntimeError('Backend %s did not start' % backend['name'])
+        finally:
+            client.close()
+
+
+def time_calls(func, iterations: int) -> dict:
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GaragePi fleet fan-out benchmark')
+    parser.add_argument('--nodes', type=int, default=4, help='backends to start')
+    parser.add_argument('--iterations', type=int, default=50, help='requests to time for each case')
+    parser.add_argument('--timeout', type=float, default=0.5, help='seconds to wait for each backend')
+    parser.add_argument('--history-rows', type=int, default=2000, help='rows of history in each backend')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('fleet')
+    logging.basicConfig(level=logging.ERROR)
+    backends = start_backends(args.nodes, args.history_rows)
+    fleet = None
+    try:
+        wait_for_backends(logger, backends)
+        # The status cache is turned off so every request goes to the backends
+        fleet = Fleet(logger, backends, timeout=args.timeout, status_ttl=0)
+
+        def sequential():
+            for node in fleet.nodes: node.call('get_status')
+
+        def check_history():
+            page = fleet.history(limit=100)
+            assert len(page['entries']) == 100, page['missing']
+
+        print('%-28s %8s %8s %8s %8s' % ('case', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        results = [('status, one at a time', time_calls(sequential, args.iterations)),
+                   ('status, fanned out', time_calls(fleet.statuses, args.iterations)),
+                   ('history, merged', time_calls(check_history, args.iterations))]
+
+        # A paused process keeps its socket open but never answers, like a hung Pi
+        stalled = backends[-1]['process']
+        os.kill(stalled.pid, signal.SIGSTOP)
+        try:
+            results.append(('status, one node hung', time_calls(fleet.statuses, max(args.iterations // 10, 3))))
+            stale = [node['name'] for node in fleet.statuses() if node['stale']]
+            results.append(('history, one node hung', time_calls(lambda: fleet.history(limit=100),
+                                                                 max(args.iterations // 10, 3))))
+        finally:
+            os.kill(stalled.pid, signal.SIGCONT)
+
+        for name, summary in results:
+            print('%-28s %8.1f %8.1f %8.1f %8.1f' % (name, summary['p50_ms'], summary['p90_ms'],
+                                                     summary['p99_ms'], summary['max_ms']))
+        print()
+        print('Shown as stale while hung: %s' % ', '.join(stale))
+    finally:
+        if fleet is not None: fleet.close()
+        for backend in backends:
+            backend['process'].terminate()
+            backend['process'].wait(10)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
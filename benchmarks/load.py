@@ -0,0 +1,402 @@
+# End-to-end load test. Starts the backend on simulated hardware and the webserver as separate
+# processes, then has many dashboard sessions use the site at once: logging in, keeping the
+# status stream open (or polling /query_status when the webserver turns the stream away, as the
+# page does), viewing history, downloading CSV and now and then triggering the door.
+#
+# By default the webserver runs the way setup.sh deploys it: start_webserver.fcgi behind
+# lighttpd, with one FastCGI process. That needs lighttpd and flup installed. --server dev uses
+# Flask's threaded development server instead, which doesn't say much about a real Pi.
+#
+# Run from the project root, for example for 20 sessions over two minutes:
+#   python3 -m benchmarks.load --users 20 --duration 120
+#
+# The report shows throughput, latency percentiles and error rates for each kind of request,
+# how many status streams were open or turned away, how often the webserver couldn't get an
+# answer from the backend, and the CPU and memory each process used. Raise --users until
+# requests start timing out to find what one Pi can serve.
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from backend import sim
+from benchmarks.suite import free_port, percentiles, populate
+from common.db import GarageDb
+
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+USERNAME = 'loadtest'
+PASSWORD = 'loadtest'
+
+# Relative weights of what a session does between think times. Status is watched separately.
+ACTIONS = [
+    ('dashboard', 6),
+    ('history', 8),
+    ('full_history', 5),
+    ('download', 2),
+    ('trigger', 1),
+]
+
+# How the dashboard page watches status: polling interval, and how long before it tries the stream again
+POLL_INTERVAL = 1.5
+STREAM_RETRY = 30.0
+# Longer than the status stream's keep-alive, so an idle stream isn't taken for a dead one
+STREAM_READ_TIMEOUT = 30.0
+
+DEV_WEBSERVER_SCRIPT = """
+from webserver.garage import app
+import logging
+logging.getLogger('werkzeug').setLevel(logging.ERROR)
+app.logger.setLevel(logging.WARNING)
+app.run(host='127.0.0.1', port=%d, threaded=True, use_reloader=False)
+"""
+
+# The server block setup.sh adds to lighttpd.conf, on its own port
+LIGHTTPD_CONFIG = """
+server.document-root = "%(instance_path)s"
+server.port = %(port)d
+server.bind = "127.0.0.1"
+server.errorlog = "%(instance_path)s/lighttpd_error.log"
+server.modules = ("mod_alias", "mod_fastcgi")
+server.stream-response-body = 2
+
+fastcgi.server = ("/" =>
+    ((
+        "socket" => "%(instance_path)s/garage-fcgi.sock",
+        "bin-path" => "%(python)s %(project_path)s/start_webserver.fcgi",
+        "bin-environment" => ("GARAGEPI_INSTANCE_PATH" => "%(instance_path)s", "PYTHONPATH" => "%(project_path)s"),
+        "check-local" => "disable",
+        "max-procs" => 1,
+        "fix-root-scriptname" => "enable",
+    ))
+)
+
+alias.url += ("/static/" => "%(project_path)s/webserver/static/")
+"""
+
+
+class ProcessMonitor(object):
+    """ Samples a process's CPU use and resident memory from /proc once a second. """
+
+    def __init__(self, pid: int):
+        self.__pid = pid
+        self.__ticks = os.sysconf('SC_CLK_TCK')
+        self.__page_size = os.sysconf('SC_PAGE_SIZE')
+        self.__stop = threading.Event()
+        self.cpu_percent = []
+        self.rss_mb = []
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def __read(self):
+        with open('/proc/%d/stat' % self.__pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / self.__ticks
+        return cpu_seconds, int(fields[21]) * self.__page_size / (1024 * 1024)
+
+    def __run(self):
+        try:
+            last_cpu, rss = self.__read()
+            last_time = time.monotonic()
+            while not self.__stop.wait(1.0):
+                cpu, rss = self.__read()
+                now = time.monotonic()
+                self.cpu_percent.append((cpu - last_cpu) / (now - last_time) * 100)
+                self.rss_mb.append(rss)
+                last_cpu, last_time = cpu, now
+        except (OSError, ValueError):
+            pass
+
+    def summary(self) -> dict:
+        if not self.cpu_percent: return dict(cpu_mean_pct=None, cpu_max_pct=None, rss_max_mb=None)
+        return dict(cpu_mean_pct=sum(self.cpu_percent) / len(self.cpu_percent),
+                    cpu_max_pct=max(self.cpu_percent),
+                    rss_max_mb=max(self.rss_mb))
+
+
+class Results(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.timeouts = {}
+        self.backend_timeouts = 0
+        self.streams_open = 0
+        self.max_streams_open = 0
+        self.streams_refused = 0
+
+    def record(self, action: str, latency: float, error: bool=False, timeout: bool=False):
+        with self.__lock:
+            if timeout:
+                self.timeouts[action] = self.timeouts.get(action, 0) + 1
+            elif error:
+                self.errors[action] = self.errors.get(action, 0) + 1
+            else:
+                self.latencies.setdefault(action, []).append(latency)
+
+    def backend_timed_out(self):
+        with self.__lock:
+            self.backend_timeouts += 1
+
+    def stream_opened(self):
+        with self.__lock:
+            self.streams_open += 1
+            self.max_streams_open = max(self.max_streams_open, self.streams_open)
+
+    def stream_closed(self):
+        with self.__lock:
+            self.streams_open -= 1
+
+    def stream_refused(self):
+        with self.__lock:
+            self.streams_refused += 1
+
+
+class Session(object):
+    """ One person with the dashboard open. """
+
+    def __init__(self, base_url: str, results: Results, think_time: float, timeout: float):
+        self.__base_url = base_url
+        self.__results = results
+        self.__think_time = think_time
+        self.__timeout = timeout
+        self.__http = requests.Session()
+        self.__status_http = requests.Session()
+        self.__rng = random.Random()
+
+    def run(self, stop_at: float):
+        self.__request('login', 'post', '/login', data=dict(username=USERNAME, password=PASSWORD))
+        # The open dashboard keeps watching status while the person clicks around
+        self.__status_http.cookies = self.__http.cookies.copy()
+        threading.Thread(target=self.watch_status, args=(stop_at,), daemon=True).start()
+        names = [name for name, weight in ACTIONS]
+        weights = [weight for name, weight in ACTIONS]
+        while time.monotonic() < stop_at:
+            action = self.__rng.choices(names, weights)[0]
+            getattr(self, action)()
+            time.sleep(self.__rng.expovariate(1 / self.__think_time))
+        self.__http.close()
+
+    def watch_status(self, stop_at: float):
+        """ Does what the dashboard's script does: use the stream, and poll while it can't. """
+        while time.monotonic() < stop_at:
+            if self.__stream_status(stop_at): continue
+            retry_at = min(stop_at, time.monotonic() + STREAM_RETRY)
+            while time.monotonic() < retry_at:
+                self.query_status()
+                time.sleep(POLL_INTERVAL)
+        self.__status_http.close()
+
+    def __stream_status(self, stop_at: float) -> bool:
+        """ Holds the status stream open until stop_at. Returns False if it was refused or dropped. """
+        start = time.perf_counter()
+        try:
+            response = self.__status_http.get(self.__base_url + '/status_stream', stream=True,
+                                              timeout=(self.__timeout, STREAM_READ_TIMEOUT))
+        except requests.RequestException as e:
+            self.__results.record('status_stream', time.perf_counter() - start,
+                                  timeout=isinstance(e, requests.Timeout), error=True)
+            return False
+        opened = False
+        try:
+            if response.status_code != 200:
+                self.__results.record('status_stream', time.perf_counter() - start, error=True)
+                return False
+            for line in response.iter_lines(decode_unicode=True):
+                if line == 'event: busy':
+                    self.__results.stream_refused()
+                    return False
+                if not opened and line == '':
+                    # The first message wasn't a refusal. Time to get it counts like other requests' latency.
+                    self.__results.record('status_stream', time.perf_counter() - start)
+                    self.__results.stream_opened()
+                    opened = True
+                if time.monotonic() >= stop_at: return True
+            return False
+        except requests.RequestException:
+            self.__results.record('stream_dropped', time.perf_counter() - start, error=True)
+            return False
+        finally:
+            if opened: self.__results.stream_closed()
+            response.close()
+
+    def __request(self, action: str, method: str, path: str, stream: bool=False, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.__http.request(method, self.__base_url + path, timeout=self.__timeout,
+                                           allow_redirects=False, stream=stream, **kwargs)
+            if stream:
+                for chunk in response.iter_content(64 * 1024): pass
+            else:
+                response.content
+        except requests.Timeout:
+            self.__results.record(action, time.perf_counter() - start, timeout=True)
+            return None
+        except requests.RequestException:
+            self.__results.record(action, time.perf_counter() - start, error=True)
+            return None
+        self.__results.record(action, time.perf_counter() - start, error=response.status_code >= 400)
+        if response.status_code == 503: self.__results.backend_timed_out()
+        return response
+
+    def query_status(self):
+        response = self.__request('query_status', 'get', '/query_status')
+        # The webserver answers {} when GaragePiClient gave up waiting on the backend
+        if response is not None and response.status_code == 200 and response.json() == {}:
+            self.__results.backend_timed_out()
+
+    def dashboard(self):
+        self.__request('dashboard', 'get', '/')
+
+    def history(self):
+        self.__request('history', 'get', '/history')
+
+    def full_history(self):
+        # The page shell, then the first page of rows the way the page's script loads them
+        self.__request('full_history', 'get', '/full_history')
+        self.__request('history_data', 'get', '/history_data?limit=100')
+
+    def download(self):
+        self.__request('download', 'get', '/download', stream=True)
+
+    def trigger(self):
+        self.__request('trigger', 'post', '/trigger')
+
+
+def wait_for_port(port: int, timeout: float=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get('http://127.0.0.1:%d/login' % port, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError('Webserver did not start on port %d' % port)
+
+
+def start_webserver(server: str, port: int, instance_path: str, env: dict, log) -> subprocess.Popen:
+    """ Starts the webserver the given way and returns the process to stop afterwards. """
+    if server == 'dev':
+        return subprocess.Popen([sys.executable, '-c', DEV_WEBSERVER_SCRIPT % port], cwd=project_path, env=env,
+                                stdout=log, stderr=subprocess.STDOUT)
+
+    lighttpd = shutil.which('lighttpd') or '/usr/sbin/lighttpd'
+    if not os.path.exists(lighttpd):
+        raise RuntimeError('lighttpd is needed to test the deployed webserver. Install it or use --server dev.')
+    config_file = os.path.join(instance_path, 'lighttpd.conf')
+    with open(config_file, 'w') as f:
+        f.write(LIGHTTPD_CONFIG % dict(instance_path=instance_path, port=port, python=sys.executable,
+                                       project_path=project_path))
+    # -D keeps lighttpd in the foreground so it can be stopped like the other processes
+    return subprocess.Popen([lighttpd, '-D', '-f', config_file], cwd=project_path, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def fastcgi_pid(lighttpd_pid: int, timeout: float=10.0) -> int:
+    """ Finds the webserver process lighttpd started, which is the one doing the work. """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with open('/proc/%d/task/%d/children' % (lighttpd_pid, lighttpd_pid)) as f:
+            children = f.read().split()
+        if children: return int(children[0])
+        time.sleep(0.2)
+    raise RuntimeError('lighttpd did not start the webserver')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GaragePi end-to-end load test')
+    parser.add_argument('--users', type=int, default=100, help='dashboard sessions to run at once')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run for after ramp up')
+    parser.add_argument('--ramp-up', type=float, default=10, help='seconds over which sessions start')
+    parser.add_argument('--think-time', type=float, default=2.0, help='mean seconds between requests per session')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds before a request counts as timed out')
+    parser.add_argument('--history-rows', type=int, default=10000, help='rows of history to start with')
+    parser.add_argument('--server', choices=['fcgi', 'dev'], default='fcgi',
+                        help='fcgi to run the webserver behind lighttpd as deployed, dev for the Flask dev server')
+    args = parser.parse_args()
+
+    sink = sim.NotificationSink()
+    instance_path = tempfile.mkdtemp(prefix='garagepi-load-')
+    web_port = free_port()
+    sim.create_instance(instance_path, IPC_PORT=free_port(), STATUS_PUB_PORT=free_port(),
+                        USERNAME=USERNAME, PASSWORD=PASSWORD, IFTTT_MAKER_KEY='load', IFTTT_BASE_URL=sink.url)
+    db = GarageDb(instance_path, os.path.join(project_path, 'resource'))
+    populate(db, args.history_rows)
+    db.close()
+
+    env = dict(os.environ, GARAGEPI_INSTANCE_PATH=instance_path)
+    backend_log = open(os.path.join(instance_path, 'backend_console.log'), 'w')
+    web_log = open(os.path.join(instance_path, 'webserver_console.log'), 'w')
+    backend = subprocess.Popen([sys.executable, 'start_backend.py'], cwd=project_path, env=env,
+                               stdout=backend_log, stderr=subprocess.STDOUT)
+    webserver = start_webserver(args.server, web_port, instance_path, env, web_log)
+    try:
+        wait_for_port(web_port)
+        print('Running %d sessions for %ds against %s on the %s server (logs in %s)' %
+              (args.users, args.duration, 'http://127.0.0.1:%d' % web_port, args.server, instance_path))
+
+        web_pid = webserver.pid if args.server == 'dev' else fastcgi_pid(webserver.pid)
+        monitors = dict(backend=ProcessMonitor(backend.pid), webserver=ProcessMonitor(web_pid))
+        results = Results()
+        start = time.monotonic()
+        stop_at = start + args.ramp_up + args.duration
+        threads = []
+        for i in range(args.users):
+            session = Session('http://127.0.0.1:%d' % web_port, results, args.think_time, args.timeout)
+            thread = threading.Thread(target=session.run, args=(stop_at,), daemon=True)
+            thread.start()
+            threads.append(thread)
+            time.sleep(args.ramp_up / args.users)
+        for thread in threads:
+            thread.join(args.timeout * 2 + stop_at - time.monotonic())
+        elapsed = time.monotonic() - start
+        for monitor in monitors.values(): monitor.stop()
+
+        report(results, elapsed, monitors)
+    finally:
+        for process in (webserver, backend):
+            process.terminate()
+            process.wait(10)
+        sink.close()
+
+
+def report(results: Results, elapsed: float, monitors: dict):
+    total = ok = 0
+    print()
+    print('%-14s %8s %8s %8s %8s %8s %8s %8s' % ('request', 'ok', 'errors', 'timeouts', 'req/s', 'p50 ms',
+                                                'p90 ms', 'p99 ms'))
+    for action in sorted(set(results.latencies) | set(results.errors) | set(results.timeouts)):
+        latencies = results.latencies.get(action, [])
+        errors = results.errors.get(action, 0)
+        timeouts = results.timeouts.get(action, 0)
+        summary = percentiles(latencies) if latencies else dict(p50_ms=0, p90_ms=0, p99_ms=0)
+        count = len(latencies) + errors + timeouts
+        total += count
+        ok += len(latencies)
+        print('%-14s %8d %8d %8d %8.1f %8.1f %8.1f %8.1f' % (action, len(latencies), errors, timeouts,
+                                                            count / elapsed, summary['p50_ms'],
+                                                            summary['p90_ms'], summary['p99_ms']))
+    print()
+    print('Throughput: %.1f requests/s, %.2f%% failed' % (total / elapsed, (total - ok) / total * 100 if total else 0))
+    print('Status streams: at most %d open at once, %d turned away to polling' %
+          (results.max_streams_open, results.streams_refused))
+    print('Backend timeouts seen by the webserver: %d' % results.backend_timeouts)
+    for name, monitor in monitors.items():
+        summary = monitor.summary()
+        if summary['cpu_mean_pct'] is None: continue
+        print('%-10s CPU mean %.1f%%, max %.1f%%, peak RSS %.1f MB' %
+              (name, summary['cpu_mean_pct'], summary['cpu_max_pct'], summary['rss_max_mb']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
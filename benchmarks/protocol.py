@@ -0,0 +1,97 @@
+# Compares the JSON and binary message formats: encoded size and the time to encode and decode
+# each message the way the controller and GaragePiClient do.
+#
+# Run from the project root:  python3 -m benchmarks.protocol [iterations]
+
+import json
+import sys
+import time
+
+from common import protocol
+from common.protocol import StatusRecord, DoorStatus
+from common.struct import Struct
+
+
+def status_json():
+    status = StatusRecord(True, 48.312, 118.9616, 47.2, 116.96, [DoorStatus('garage', 'Garage', True)])
+    encoded = status.to_json_bytes()
+    def encode():
+        return status.to_json_bytes()
+    def decode():
+        return StatusRecord.from_dict(json.loads(bytes.decode(encoded)))
+    return encoded, encode, decode
+
+
+def status_binary():
+    status = StatusRecord(True, 48.312, 118.9616, 47.2, 116.96, [DoorStatus('garage', 'Garage', True)])
+    encoded = protocol.pack_reply(status.pack())
+    def encode():
+        return protocol.pack_reply(status.pack())
+    def decode():
+        return StatusRecord.unpack(protocol.unpack_reply(encoded))
+    return encoded, encode, decode
+
+
+def trigger_json():
+    data = Struct(user_agent='Mozilla/5.0 (Linux; Android 14) Chrome/126.0', login='admin', door='garage')
+    encoded = data.to_json_bytes()
+    def encode():
+        return data.to_json_bytes()
+    def decode():
+        contents = json.loads(bytes.decode(encoded))
+        return contents['user_agent'], contents['login'], contents.get('door')
+    return encoded, encode, decode
+
+
+def trigger_binary():
+    user_agent, login, door = 'Mozilla/5.0 (Linux; Android 14) Chrome/126.0', 'admin', 'garage'
+    encoded = protocol.pack_strings(user_agent, login, door)
+    def encode():
+        return protocol.pack_strings(user_agent, login, door)
+    def decode():
+        return protocol.unpack_strings(encoded, 3)
+    return encoded, encode, decode
+
+
+def echo_json():
+    encoded = str.encode(json.dumps({'message': 'Hello from the webserver'}))
+    def encode():
+        return str.encode(json.dumps({'message': 'Hello from the webserver'}))
+    def decode():
+        return json.loads(bytes.decode(encoded))['message']
+    return encoded, encode, decode
+
+
+def echo_binary():
+    encoded = protocol.pack_strings('Hello from the webserver')
+    def encode():
+        return protocol.pack_strings('Hello from the webserver')
+    def decode():
+        return protocol.unpack_strings(encoded, 1)[0]
+    return encoded, encode, decode
+
+
+def time_per_call(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for i in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def run(iterations: int) -> dict:
+    results = {}
+    for name, setup in (('status_json', status_json), ('status_binary', status_binary),
+                        ('trigger_relay_json', trigger_json), ('trigger_relay_binary', trigger_binary),
+                        ('echo_json', echo_json), ('echo_binary', echo_binary)):
+        encoded, encode, decode = setup()
+        results[name] = dict(size_bytes=len(encoded),
+                             encode_us=time_per_call(encode, iterations),
+                             decode_us=time_per_call(decode, iterations))
+    return results
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%-22s %10s %10s %10s' % ('message', 'bytes', 'encode us', 'decode us'))
+    for name, result in run(iterations).items():
+        print('%-22s %10d %10.2f %10.2f' % (name, result['size_bytes'], result['encode_us'], result['decode_us']))
@@ -0,0 +1,82 @@
+# Replays door activity into the backend running on simulated hardware, faster than real time,
+# to stress door_opened_or_closed, the history writes and notifications.
+#
+# Run from the project root, for example to play 90 days of bouncy door activity:
+#   python3 -m benchmarks.replay --days 90 --bounce 4 --notify
+# or a recorded trace of 'seconds,level' lines:
+#   python3 -m benchmarks.replay --trace door_trace.csv --speed 100000
+
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from backend import sim
+from common.db import GarageDb
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--days', type=float, default=30, help='days of synthetic activity to generate')
+    parser.add_argument('--opens-per-day', type=float, default=6)
+    parser.add_argument('--bounce', type=int, default=0, help='extra bounce edges around each change')
+    parser.add_argument('--trace', help='replay this trace file instead of generating one')
+    parser.add_argument('--speed', type=float, default=1e6, help='times faster than real time')
+    parser.add_argument('--min-gap', type=float, default=0.02,
+                        help='least real seconds between door movements so the debouncer can separate them')
+    parser.add_argument('--settle-ms', type=float, default=5, help='REED_SETTLE_MS for the run')
+    parser.add_argument('--notify', action='store_true', help='send IFTTT events to a local stand-in')
+    parser.add_argument('--notify-delay', type=float, default=0.0, help='seconds the stand-in takes to answer')
+    parser.add_argument('--instance', help='instance folder to use instead of a temporary one')
+    args = parser.parse_args()
+
+    trace = sim.load_trace(args.trace) if args.trace else \
+        sim.synthetic_trace(args.days, args.opens_per_day, bounce_edges=args.bounce, seed=1)
+
+    sink = sim.NotificationSink(args.notify_delay) if args.notify else None
+    instance_path = args.instance or tempfile.mkdtemp(prefix='garagepi-replay-')
+    settings = dict(REED_SETTLE_MS=args.settle_ms, TELEMETRY_INTERVAL=1, IPC_PORT=free_port(), STATUS_PUB_PORT=free_port())
+    if sink is not None:
+        settings.update(IFTTT_MAKER_KEY='replay', IFTTT_BASE_URL=sink.url, NOTIFY_QUEUE_SIZE=100000)
+    sim.create_instance(instance_path, **settings)
+    os.environ['GARAGEPI_INSTANCE_PATH'] = instance_path
+
+    from backend import app
+    from backend.controller import GaragePiController
+    app.logger.setLevel('WARNING')
+    controller = GaragePiController(app.config['IPC_PORT'])
+    db = GarageDb(app.instance_path, app.resource_path)
+    app.event_writer.flush()
+    rows_before = db.get_connection().execute('select count(*) from entries').fetchone()[0]
+
+    print('Replaying %d edges into %s' % (len(trace), instance_path))
+    start = time.perf_counter()
+    sim.replay(app.GPIO, app.config['REED_PIN'], trace, args.speed, args.min_gap)
+    app.GPIO.wait_for_callbacks()
+    time.sleep(args.settle_ms / 1000.0 * 2 + 0.05)
+    # Events can still be waiting in the history writer, so count rows once they're committed
+    app.event_writer.flush()
+    elapsed = time.perf_counter() - start
+
+    rows = db.get_connection().execute('select count(*) from entries').fetchone()[0] - rows_before
+    stats = controller.get_stats()
+    print('Played %d edges in %.2f s (%.0f edges/s)' % (len(trace), elapsed, len(trace) / elapsed))
+    print('Recorded %d history rows (%.0f rows/s)' % (rows, rows / elapsed))
+    print('Debounce: %r' % stats['debounce'])
+    print('Edge callback errors: %d' % app.GPIO.callback_error_count)
+    if sink is not None:
+        app.notifier.stop(timeout=60)
+        print('Notifications: %r, received by stand-in: %d' % (app.notifier.stats(), sink.request_count))
+        sink.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+# Measures how long the backend and webserver take to start from cold, so slow imports that
+# creep into startup show up. Both run on simulated hardware with IFTTT and Telegram configured,
+# which is the slowest setup.
+#
+# Run from the project root:
+#   python3 -m benchmarks.startup [--runs 5] [--top 12]
+#
+# For the backend it reports the time from launching start_backend.py until the first reply
+# over IPC. For the webserver it reports the time to import webserver.garage and to answer a
+# first request. Each is followed by the packages that took longest to import, as reported by
+# python -X importtime, counting each package with everything it pulled in.
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from backend import sim
+from benchmarks.suite import free_port
+from webserver.client_api import GaragePiClient
+
+project_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+project_packages = ('backend', 'common', 'webserver', 'benchmarks')
+
+WEBSERVER_SCRIPT = """
+import json, time
+start = time.perf_counter()
+from webserver.garage import app
+imported = time.perf_counter()
+app.test_client().get('/login')
+print(json.dumps(dict(import_ms=(imported - start) * 1000, first_response_ms=(time.perf_counter() - start) * 1000)))
+"""
+
+
+def parse_importtime(output: str) -> dict:
+    """
+    Gets the cumulative microseconds of each package from -X importtime output. Packages
+    that import each other are both counted, so the times don't add up to the total.
+    """
+    totals = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or line.startswith('import time: self'): continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        # Our own modules are what's being started, so list what they pull in instead
+        if '.' in name or name in project_packages: continue
+        totals[name] = int(cumulative_us)
+    return totals
+
+
+def time_backend(env: dict, port: int, timeout: float=30.0):
+    logger = logging.getLogger('startup')
+    logger.setLevel(logging.ERROR)      # expect timeouts until the backend is up
+    # The backend logs to the console too, so a pipe could fill up and stall it while we're waiting
+    with tempfile.TemporaryFile('w+') as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-X', 'importtime', 'start_backend.py'], cwd=project_path,
+                                   env=env, stdout=subprocess.DEVNULL, stderr=stderr)
+        client = GaragePiClient(logger, port, binary=False, timeout=50)
+        try:
+            while client.echo('ping') != 'ping':
+                if time.perf_counter() - start > timeout: raise RuntimeError('Backend did not answer')
+            ready_ms = (time.perf_counter() - start) * 1000
+        finally:
+            client.close()
+            process.terminate()
+            process.wait(10)
+        stderr.seek(0)
+        return ready_ms, parse_importtime(stderr.read())
+
+
+def time_webserver(env: dict):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', WEBSERVER_SCRIPT], cwd=project_path, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, parse_importtime(result.stderr)
+
+
+def print_imports(imports: list, top: int):
+    # Median across runs of each import's cumulative time
+    names = set(name for run in imports for name in run)
+    medians = sorted(((statistics.median(run.get(name, 0) for run in imports), name) for name in names), reverse=True)
+    for us, name in medians[:top]:
+        print('    %-40s %8.1f ms' % (name, us / 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GaragePi cold start timing')
+    parser.add_argument('--runs', type=int, default=5, help='times to start each process')
+    parser.add_argument('--top', type=int, default=12, help='slowest imports to list')
+    args = parser.parse_args()
+
+    instance_path = tempfile.mkdtemp(prefix='garagepi-startup-')
+    port = free_port()
+    sim.create_instance(instance_path, IPC_PORT=port, STATUS_PUB_PORT=free_port(),
+                        IFTTT_MAKER_KEY='startup', APPRISE_TELEGRAM_KEY='startup', APPRISE_TELEGRAM_CHAT_ID='1')
+    env = dict(os.environ, GARAGEPI_INSTANCE_PATH=instance_path)
+
+    backend_ready, backend_imports = [], []
+    web_import, web_first, web_imports = [], [], []
+    for i in range(args.runs):
+        ready_ms, imports = time_backend(env, port)
+        backend_ready.append(ready_ms)
+        backend_imports.append(imports)
+        timings, imports = time_webserver(env)
+        web_import.append(timings['import_ms'])
+        web_first.append(timings['first_response_ms'])
+        web_imports.append(imports)
+
+    print('Median of %d runs' % args.runs)
+    print()
+    print('Backend: first IPC reply %.1f ms after launch' % statistics.median(backend_ready))
+    print_imports(backend_imports, args.top)
+    print()
+    print('Webserver: imported in %.1f ms, first response %.1f ms' % (statistics.median(web_import),
+                                                                     statistics.median(web_first)))
+    print_imports(web_imports, args.top)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
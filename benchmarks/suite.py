@@ -0,0 +1,364 @@
+# Microbenchmarks for the controller, IPC (in both message formats) and database hot paths. Everything runs offline: the
+# backend uses the simulated GPIO and temperature readers, and notifications go to a local sink.
+#
+# Run from the project root:
+#   python3 -m benchmarks.suite              run and compare with the baseline saved on this machine
+#   python3 -m benchmarks.suite --save       run and save the results as the new baseline
+#   python3 -m benchmarks.suite --quick      skip the million row history reads
+#
+# Results depend on the machine, so no baseline is checked in. Save one on the target Pi first.
+# After that, comparing exits with status 1 if any latency (*_ms) grew, or any throughput
+# (*_per_s) fell, by more than the tolerance.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from logging.handlers import RotatingFileHandler
+from threading import Thread
+
+from backend import sim
+from backend.recent_events import RecentEvents
+from backend.scheduler import Scheduler
+from common.db import GarageDb, HistoryEvent, INSERT_EVENT_AT
+from common import constants
+from common.doors import DEFAULT_DOOR_ID
+from common.event_writer import EventWriter
+from common.log_queue import start_queue_logging
+from common.protocol import StatusRecord
+from common.struct import Struct
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(samples) -> dict:
+    """ Summarises a list of latencies in seconds as milliseconds. """
+    samples = sorted(samples)
+    def at(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000
+    return dict(count=len(samples), p50_ms=at(0.50), p90_ms=at(0.90), p99_ms=at(0.99), max_ms=samples[-1] * 1000)
+
+
+def time_calls(func, iterations: int) -> list:
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+# ---- IPC ----
+
+def bench_ipc(iterations: int, relay_iterations: int) -> dict:
+    """ Round trips through GaragePiClient to a GaragePiController running its real ROUTER loop. """
+    sink = sim.NotificationSink()
+    instance_path = tempfile.mkdtemp(prefix='garagepi-bench-')
+    sim.create_instance(instance_path, IPC_PORT=free_port(), STATUS_PUB_PORT=free_port(),
+                        IFTTT_MAKER_KEY='bench', IFTTT_BASE_URL=sink.url, REED_SETTLE_MS=5)
+    os.environ['GARAGEPI_INSTANCE_PATH'] = instance_path
+
+    from backend import app
+    from backend.controller import GaragePiController
+    from webserver.client_api import GaragePiClient
+
+    # Logging every message would be most of what's measured
+    app.logger.setLevel(logging.WARNING)
+    controller = GaragePiController(app.config['IPC_PORT'])
+    Thread(target=controller.start, name='BenchController', daemon=True).start()
+
+    logger = logging.getLogger('benchmark')
+    logger.setLevel(logging.WARNING)
+    results = {}
+    for name, binary in (('json', False), ('binary', True)):
+        client = GaragePiClient(logger, app.config['IPC_PORT'], binary=binary)
+        for i in range(50):
+            client.echo('warm up')
+        executed, merged = time_triggers(client, relay_iterations, app.config['TRIGGER_MERGE_WINDOW'])
+        results[name] = dict(echo=percentiles(time_calls(lambda: client.echo('benchmark'), iterations)),
+                             get_status=percentiles(time_calls(client.get_status, iterations)),
+                             trigger_relay=percentiles(executed),
+                             trigger_relay_merged=percentiles(merged))
+        client.close()
+    app.notifier.stop(timeout=10)
+    sink.close()
+    return results
+
+
+def time_triggers(client, count: int, merge_window: float):
+    """
+    Times triggers that pulse the relay, waiting out the merge window before each, and
+    a double tap right after each one, which the backend merges into the first.
+
+    :return: Tuple of the executed and merged samples
+    """
+    executed, merged = [], []
+    for i in range(count):
+        time.sleep(merge_window)
+        for samples in (executed, merged):
+            start = time.perf_counter()
+            client.trigger_relay('benchmark', 'benchmark')
+            samples.append(time.perf_counter() - start)
+    return executed, merged
+
+
+# ---- Database ----
+
+def populate(db: GarageDb, rows: int):
+    """ Fills history with door events a minute apart. """
+    start = datetime.utcnow() - timedelta(minutes=rows)
+    def entries():
+        for i in range(rows):
+            state = 'OPEN' if i % 2 == 0 else 'CLOSED'
+            yield ((start + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S'), 'SERVER', 'SERVER',
+                   'SensorTrip', 'Door state changed to %s.' % state, DEFAULT_DOOR_ID)
+    conn = db.get_connection()
+    with conn:
+        conn.executemany(INSERT_EVENT_AT, entries())
+
+
+def bench_record_event(resource_path: str, iterations: int) -> dict:
+    with tempfile.TemporaryDirectory() as instance_path:
+        db = GarageDb(instance_path, resource_path)
+        db.record_event('benchmark', 'benchmark', 'SwitchActivated', 'warm up')
+        start = time.perf_counter()
+        for i in range(iterations):
+            db.record_event('benchmark', 'benchmark', 'SwitchActivated', 'Door switch activated when in CLOSED state.')
+        elapsed = time.perf_counter() - start
+        db.close()
+    return dict(count=iterations, events_per_s=iterations / elapsed, mean_ms=elapsed / iterations * 1000)
+
+
+def bench_event_writer(resource_path: str, iterations: int) -> dict:
+    """
+    Queues events for the writer thread the way the controller does. Times each call on the
+    recording thread, and the rate events are committed including the final flush.
+    """
+    with tempfile.TemporaryDirectory() as instance_path:
+        db = GarageDb(instance_path, resource_path)
+        writer = EventWriter(logging.getLogger('bench'))
+        writer.start(db)
+        def record():
+            writer.record(HistoryEvent('benchmark', 'benchmark', 'SwitchActivated',
+                                       'Door switch activated when in CLOSED state.'))
+        start = time.perf_counter()
+        samples = time_calls(record, iterations)
+        writer.flush()
+        elapsed = time.perf_counter() - start
+        stats = writer.stats()
+        writer.stop()
+    summary = percentiles(samples)
+    return dict(count=iterations, events_per_s=iterations / elapsed, record_p50_ms=summary['p50_ms'],
+                record_p99_ms=summary['p99_ms'], batches=stats['batch_count'])
+
+
+def bench_history_reads(resource_path: str, rows: int, repeats: int) -> dict:
+    with tempfile.TemporaryDirectory() as instance_path:
+        db = GarageDb(instance_path, resource_path)
+        populate(db, rows)
+        db.read_history()
+        # The newest page as /history_data gets it from the database and from the backend's memory
+        recent = RecentEvents()
+        recent.load(*db.read_recent_events(500))
+        results = dict(read_history=percentiles(time_calls(db.read_history, max(repeats, 20))),
+                       read_full_history=percentiles(time_calls(db.read_full_history, repeats)),
+                       query_history_page=percentiles(time_calls(lambda: db.query_history(limit=100),
+                                                                 max(repeats, 20))),
+                       recent_events_page=percentiles(time_calls(lambda: recent.since(limit=100), max(repeats, 20))))
+        results['read_full_history']['rows_per_s'] = rows / (results['read_full_history']['p50_ms'] / 1000)
+        db.close()
+    return results
+
+
+# ---- Serialization ----
+
+def bench_struct_json(iterations: int) -> dict:
+    status = Struct(is_open=True, status_text='OPEN', cpu_temp_c=48.312, cpu_temp_f=118.9616,
+                    gpu_temp_c=47.2, gpu_temp_f=116.96)
+    start = time.perf_counter()
+    for i in range(iterations):
+        status.to_json_bytes()
+    elapsed = time.perf_counter() - start
+    return dict(count=iterations, calls_per_s=iterations / elapsed, mean_us=elapsed / iterations * 1e6)
+
+
+def bench_status_pack(iterations: int) -> dict:
+    status = StatusRecord(True, 48.312, 118.9616, 47.2, 116.96)
+    start = time.perf_counter()
+    for i in range(iterations):
+        status.pack()
+    elapsed = time.perf_counter() - start
+    return dict(count=iterations, calls_per_s=iterations / elapsed, mean_us=elapsed / iterations * 1e6)
+
+
+# ---- Scheduler ----
+
+def bench_scheduler(timers: int) -> dict:
+    """
+    Arms and cancels timers the way door rules are, then times how late a batch
+    of timers due together fires, and counts wakeups while nothing is due.
+    """
+    scheduler = Scheduler(logging.getLogger('bench'))
+    scheduler.start()
+
+    # Far off timers, like a rule armed when a door opens and cancelled when it closes
+    start = time.perf_counter()
+    armed = [scheduler.call_later(3600 + i, lambda: None) for i in range(timers)]
+    arm_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    for timer in armed: timer.cancel()
+    cancel_elapsed = time.perf_counter() - start
+
+    lateness = []
+    def fired(deadline):
+        lateness.append(time.monotonic() - deadline)
+    first = time.monotonic() + 0.1
+    for i in range(timers):
+        deadline = first + i * 0.0002
+        scheduler.call_at(deadline, fired, deadline)
+    time.sleep(0.2 + timers * 0.0002)
+
+    # Nothing is due now so the thread should stay asleep
+    wakeups = scheduler.wakeup_count
+    time.sleep(0.5)
+    idle_wakeups = scheduler.wakeup_count - wakeups
+    scheduler.stop()
+
+    summary = percentiles(lateness) if lateness else {}
+    return dict(count=timers, fired=len(lateness),
+                arm_us=arm_elapsed / timers * 1e6, cancel_us=cancel_elapsed / timers * 1e6,
+                lateness_p50_ms=summary.get('p50_ms'), lateness_p99_ms=summary.get('p99_ms'),
+                idle_wakeups=idle_wakeups)
+
+
+# ---- Logging ----
+
+def bench_logging(iterations: int) -> dict:
+    """
+    Times the controller's per-message debug line on the thread that logs it, writing
+    to a rotating log file and the console like the backend does: straight to the
+    handlers, through the queue, and through the queue keeping DEBUG in a ring.
+    """
+    msg = [b'\x00\x80\x00\x41\xa7', b'get_status', b'', b'bin2']
+    results = {}
+    for name in ('direct', 'queued', 'ring'):
+        log_dir = tempfile.mkdtemp(prefix='garagepi-bench-log-')
+        logger = logging.Logger('bench-' + name, level=logging.DEBUG)
+        file_handler = RotatingFileHandler(os.path.join(log_dir, 'bench.log'), constants.LOGFILE_MODE,
+                                           constants.LOGFILE_MAXSIZE, constants.LOGFILE_BACKUP_COUNT)
+        file_handler.setFormatter(logging.Formatter(constants.LOGFILE_FORMAT))
+        logger.addHandler(file_handler)
+        console = open(os.devnull, 'w')
+        logger.addHandler(logging.StreamHandler(console))
+
+        queue_logging = None
+        if name != 'direct':
+            if name == 'ring':
+                queue_logging = start_queue_logging(logger, logging.INFO, 1000)
+            else:
+                queue_logging = start_queue_logging(logger)
+        samples = time_calls(lambda: logger.debug("Received msg: %s", msg), iterations)
+        start = time.perf_counter()
+        if queue_logging is not None: queue_logging.stop()
+        drain_elapsed = time.perf_counter() - start
+        for handler in logger.handlers: handler.close()
+        file_handler.close()
+        console.close()
+
+        summary = percentiles(samples)
+        results[name] = dict(count=iterations, mean_us=sum(samples) / iterations * 1e6,
+                             p99_us=summary['p99_ms'] * 1000, max_us=summary['max_ms'] * 1000,
+                             drain_ms=drain_elapsed * 1000)
+    return results
+
+
+def run(quick: bool=False, iterations: int=2000) -> dict:
+    resource_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource')
+    results = dict(ipc=bench_ipc(iterations, relay_iterations=5),
+                   record_event=bench_record_event(resource_path, iterations),
+                   event_writer=bench_event_writer(resource_path, iterations),
+                   history_10k=bench_history_reads(resource_path, 10000, repeats=10),
+                   struct_to_json_bytes=bench_struct_json(iterations * 50),
+                   status_record_pack=bench_status_pack(iterations * 50),
+                   scheduler=bench_scheduler(500),
+                   logging=bench_logging(iterations * 5))
+    if not quick:
+        results['history_1m'] = bench_history_reads(resource_path, 1000000, repeats=2)
+    return results
+
+
+def flatten(results: dict, prefix: str='') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """ Lists the measurements that got worse than the baseline by more than the tolerance. """
+    regressions = []
+    old = flatten(baseline['results'])
+    for key, value in flatten(results).items():
+        # Measurements can be None, such as lateness when no timer fired
+        if value is None or key not in old or not old[key]: continue
+        if key.endswith('_ms') or key.endswith('_us'):
+            change = value / old[key] - 1
+        elif key.endswith('_per_s'):
+            change = old[key] / value - 1
+        else:
+            continue
+        if change > tolerance:
+            regressions.append((key, old[key], value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GaragePi microbenchmarks')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='baseline file to compare with or save to')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='fraction worse than baseline that fails')
+    parser.add_argument('--quick', action='store_true', help='skip the million row history reads')
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    results = run(args.quick, args.iterations)
+    for key, value in sorted(flatten(results).items()):
+        print('%-45s %12s' % (key, 'n/a') if value is None else '%-45s %12.3f' % (key, value))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(created=datetime.now().isoformat(timespec='seconds'), machine=platform.node(),
+                           python=platform.python_version(), results=results), f, indent=2, sort_keys=True)
+        print('Saved baseline to %s' % args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s. Run with --save to create one.' % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for key, old, new, change in regressions:
+        print('REGRESSION %-35s %12.3f -> %12.3f (%+.0f%%)' % (key, old, new, change * 100))
+    if regressions: return 1
+    print('No regressions against baseline from %s (%s)' % (baseline['created'], baseline['machine']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
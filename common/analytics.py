@@ -0,0 +1,147 @@
+from datetime import datetime, timedelta, timezone
+from common.doors import DEFAULT_DOOR_ID
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+LONGEST_OPEN_COUNT = 10
+
+
+def door_state_from_event(event: str, description: str):
+    """
+    Works out the door state recorded by a history row.
+
+    :return: True for open, False for closed, or None if the row isn't a door reading
+    """
+    if event not in ('SensorTrip', 'StartupSensorRead') or not description: return None
+    if description.endswith('OPEN.'): return True
+    if description.endswith('CLOSED.'): return False
+    return None
+
+
+def parse_timestamp(timestamp: str) -> datetime:
+    """ Converts a stored UTC timestamp to a local, timezone aware datetime. """
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).astimezone()
+
+
+def utc_timestamp() -> str:
+    """ Gets the current time in the format sqlite's current_timestamp uses. """
+    return datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+
+
+def split_by_day(start: datetime, end: datetime):
+    """ Yields (local day, seconds) for each local day the given span covers. """
+    while start < end:
+        next_midnight = (start + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+        next_midnight = next_midnight.replace(tzinfo=None).astimezone()
+        stop = min(end, next_midnight)
+        yield start.strftime('%Y-%m-%d'), int((stop - start).total_seconds())
+        start = stop
+
+
+class DoorAnalytics:
+    """
+    Keeps running door usage totals in the door_stats tables. Each door reading
+    updates them with a handful of keyed writes, so reading the stats never
+    has to scan history. Totals cover all doors; whether each door is open is
+    tracked separately so doors moving at the same time don't mix up spans.
+
+    These only issue statements on the given connection. Callers own the
+    transaction so the totals stay in step with the rows in entries.
+    """
+
+    @staticmethod
+    def record(conn, timestamp: str, is_open: bool, is_transition: bool, door: str=DEFAULT_DOOR_ID):
+        """
+        Folds a door reading into the totals.
+
+        :param conn: Connection with an open transaction
+        :param timestamp: UTC timestamp of the reading
+        :param is_open: Whether the door was open
+        :param is_transition: True for a sensor trip, False for a reading taken at startup
+        :param door: Id of the door the reading is for
+        """
+        row = conn.execute('select OpenSince from door_open_since where Door = ?', [door]).fetchone()
+        open_since = row[0] if row else None
+        when = parse_timestamp(timestamp)
+
+        if is_open:
+            if is_transition:
+                conn.execute('update door_stats set OpenCount = OpenCount + 1 where ID = 1')
+                conn.execute('insert or ignore into door_stats_hourly (Hour) values (?)', [when.hour])
+                conn.execute('update door_stats_hourly set Opens = Opens + 1 where Hour = ?', [when.hour])
+                DoorAnalytics.__add_daily(conn, when.strftime('%Y-%m-%d'), opens=1)
+            if open_since is None:
+                conn.execute('insert into door_open_since (Door, OpenSince) values (?, ?)', [door, timestamp])
+        elif open_since is not None:
+            start = parse_timestamp(open_since)
+            seconds = int((when - start).total_seconds())
+            nights = 0
+            for day, day_seconds in split_by_day(start, when):
+                DoorAnalytics.__add_daily(conn, day, open_seconds=day_seconds)
+                nights += 1
+            conn.execute('update door_stats set TotalOpenSeconds = TotalOpenSeconds + ?, '
+                         'NightsLeftOpen = NightsLeftOpen + ? where ID = 1',
+                         [seconds, max(nights - 1, 0)])
+            conn.execute('delete from door_open_since where Door = ?', [door])
+            DoorAnalytics.__add_longest(conn, open_since, seconds)
+
+    @staticmethod
+    def __add_daily(conn, day: str, opens: int=0, open_seconds: int=0):
+        conn.execute('insert or ignore into door_stats_daily (Day) values (?)', [day])
+        conn.execute('update door_stats_daily set Opens = Opens + ?, OpenSeconds = OpenSeconds + ? where Day = ?',
+                     [opens, open_seconds, day])
+
+    @staticmethod
+    def __add_longest(conn, start: str, seconds: int):
+        conn.execute('insert into door_stats_longest (Start, Seconds) values (?, ?)', [start, seconds])
+        conn.execute('delete from door_stats_longest where rowid not in '
+                     '(select rowid from door_stats_longest order by Seconds desc limit ?)',
+                     [LONGEST_OPEN_COUNT])
+
+    @staticmethod
+    def read(conn, days: int=30) -> dict:
+        """ Reads the totals. This touches a fixed number of rows no matter how long the history is. """
+        row = conn.execute('select OpenCount, TotalOpenSeconds, NightsLeftOpen from door_stats where ID = 1').fetchone()
+        open_doors = {door: since for door, since in conn.execute('select Door, OpenSince from door_open_since')}
+        hourly = [0] * 24
+        for hour in conn.execute('select Hour, Opens from door_stats_hourly'):
+            hourly[hour[0]] = hour[1]
+        daily = conn.execute('select Day as day, Opens as opens, OpenSeconds as open_seconds '
+                             'from door_stats_daily order by Day desc limit ?', [days]).fetchall()
+        longest = conn.execute('select Start as start, Seconds as seconds '
+                               'from door_stats_longest order by Seconds desc').fetchall()
+
+        # The open_since figures are for whichever door has been open longest
+        open_count = row['OpenCount']
+        open_since = min(open_doors.values()) if open_doors else None
+        open_for = None
+        if open_since is not None:
+            open_for = int((datetime.now(timezone.utc) - parse_timestamp(open_since)).total_seconds())
+        return dict(open_count=open_count,
+                    total_open_seconds=row['TotalOpenSeconds'],
+                    average_open_seconds=row['TotalOpenSeconds'] / open_count if open_count else None,
+                    nights_left_open=row['NightsLeftOpen'],
+                    open_since=open_since,
+                    open_for_seconds=open_for,
+                    open_doors=open_doors,
+                    opens_by_hour=hourly,
+                    daily=[dict(day) for day in daily],
+                    longest_open=[dict(period) for period in longest])
+
+    @staticmethod
+    def backfill(conn, rows):
+        """
+        Builds the totals from existing history. Daily rollups of archived
+        history seed the per-day counts, then the given rows are replayed.
+
+        :param conn: Connection with an open transaction
+        :param rows: Rows from entries with Timestamp, Event, Description and Door, oldest first
+        """
+        conn.execute('insert or ignore into door_stats_daily (Day, Opens, OpenSeconds) '
+                     'select Day, Opens, OpenSeconds from daily_door_rollups')
+        conn.execute('update door_stats set OpenCount = OpenCount + (select coalesce(sum(Opens), 0) from daily_door_rollups), '
+                     'TotalOpenSeconds = TotalOpenSeconds + (select coalesce(sum(OpenSeconds), 0) from daily_door_rollups) '
+                     'where ID = 1')
+        for row in rows:
+            is_open = door_state_from_event(row['Event'], row['Description'])
+            if is_open is None: continue
+            DoorAnalytics.record(conn, row['Timestamp'], is_open, row['Event'] == 'SensorTrip', row['Door'])
@@ -1,7 +1,5 @@
-import configparser
-import itertools
 import os
-import imp
+import types
 
 class SimpleConfigParser(dict):
     """
@@ -22,7 +20,7 @@ class SimpleConfigParser(dict):
             self.__read_file(cfgFile)
 
     def __read_file(self, file_name):
-        d = imp.new_module('config')
+        d = types.ModuleType('config')
         d.__file__ = file_name
         with open(file_name) as config_file:
             exec(compile(config_file.read(), file_name, 'exec'), d.__dict__)
@@ -1,40 +1,402 @@
 import os
+import threading
+from functools import wraps
 from sqlite3 import dbapi2 as sqlite3
+from common import metrics
+from common.analytics import DoorAnalytics, utc_timestamp
+from common.doors import DEFAULT_DOOR_ID
+
+# Scripts that upgrade the database from one version to the next. The schema file
+# brings a new database to version 1 and MIGRATIONS[n] takes it from version n + 1
+# to n + 2. The current version is kept in sqlite's user_version pragma.
+MIGRATIONS = [
+    # 2: Indexes for reading history newest first, optionally by event type
+    """
+    create index if not exists entries_timestamp on entries (Timestamp, ID);
+    create index if not exists entries_event_timestamp on entries (Event, Timestamp, ID);
+    """,
+    # 3: Daily summaries of history that has aged out of the entries table
+    """
+    create table if not exists meta (
+      Key text primary key,
+      Value text
+    );
+    create table if not exists daily_rollups (
+      Day text,
+      Event text,
+      Count integer not null default 0,
+      primary key (Day, Event)
+    );
+    create table if not exists daily_door_rollups (
+      Day text primary key,
+      Opens integer not null default 0,
+      Closes integer not null default 0,
+      OpenSeconds integer not null default 0
+    );
+    """,
+    # 4: Running door usage totals, kept up to date as events are recorded
+    """
+    create table if not exists door_stats (
+      ID integer primary key check (ID = 1),
+      OpenCount integer not null default 0,
+      TotalOpenSeconds integer not null default 0,
+      NightsLeftOpen integer not null default 0,
+      OpenSince datetime
+    );
+    insert or ignore into door_stats (ID) values (1);
+    create table if not exists door_stats_hourly (
+      Hour integer primary key,
+      Opens integer not null default 0
+    );
+    create table if not exists door_stats_daily (
+      Day text primary key,
+      Opens integer not null default 0,
+      OpenSeconds integer not null default 0
+    );
+    create table if not exists door_stats_longest (
+      Start datetime,
+      Seconds integer
+    );
+    """,
+    # 5: Doors. Existing history belongs to the default door (common.doors.DEFAULT_DOOR_ID).
+    """
+    alter table entries add column Door text not null default 'garage';
+    create index if not exists entries_door_timestamp on entries (Door, Timestamp, ID);
+    create table if not exists door_open_since (
+      Door text primary key,
+      OpenSince datetime not null
+    );
+    insert or ignore into door_open_since (Door, OpenSince)
+      select 'garage', OpenSince from door_stats where ID = 1 and OpenSince is not null;
+    update door_stats set OpenSince = null;
+    """,
+]
+
+INSERT_EVENT = 'insert into entries (UserAgent, Login, Event, Description, Door) values (?, ?, ?, ?, ?)'
+INSERT_EVENT_AT = 'insert into entries (Timestamp, UserAgent, Login, Event, Description, Door) ' \
+                  'values (?, ?, ?, ?, ?, ?)'
+INSERT_EVENT_WITH_ID = 'insert into entries (ID, Timestamp, UserAgent, Login, Event, Description, Door) ' \
+                       'values (?, ?, ?, ?, ?, ?, ?)'
+SELECT_HISTORY = 'select datetime(timestamp, \'localtime\') as timestamp, event, description, door from entries ' \
+                 'order by entries.Timestamp desc, entries.ID desc'
+SELECT_RECENT_HISTORY = SELECT_HISTORY + ' limit ?'
+
+# Schema setup only needs to happen once per database file in each process
+_initialized_files = set()
+_initialized_lock = threading.Lock()
+
+DB_CALL_SECONDS = metrics.registry.histogram('garagepi_db_call_seconds', 'Time spent in GarageDb calls', ['call'])
+
+
+class HistoryEvent(object):
+    """ An event waiting to be written to history. Door readings (where is_open is given) also update the usage stats. """
+
+    __slots__ = ('id', 'timestamp', 'user_agent', 'login', 'event', 'description', 'door', 'is_open', 'is_transition')
+
+    def __init__(self, user_agent: str, login: str, event: str, description: str, door: str=DEFAULT_DOOR_ID,
+                 is_open: bool=None, is_transition: bool=False, timestamp: str=None):
+        """
+        :param timestamp: UTC time of the event. Now if not given, so it's when the event happened, not when it's written.
+        """
+        self.id = None      # picked by the database unless the writer sets it
+        self.timestamp = timestamp or utc_timestamp()
+        self.user_agent = user_agent
+        self.login = login
+        self.event = event
+        self.description = description
+        self.door = door
+        self.is_open = is_open
+        self.is_transition = is_transition
+
+
+def _timed(call: str):
+    """ Records how long the decorated method takes under the given call name. """
+    def decorator(func):
+        histogram = DB_CALL_SECONDS.labels(call)
+        @wraps(func)
+        def timed(*args, **kwargs):
+            with histogram.time():
+                return func(*args, **kwargs)
+        return timed
+    return decorator
+
 
 class GarageDb:
-    def __init__(self, instance_path, resource_path):
+    def __init__(self, instance_path, resource_path, cache_size_kib=2048, mmap_size_mib=16):
+        """
+        :param instance_path: Folder holding the database file
+        :param resource_path: Folder holding the schema script
+        :param cache_size_kib: Page cache size for each connection in KiB
+        :param mmap_size_mib: How much of the database file to memory map in MiB
+        """
         self.db_file = os.path.join(instance_path, 'history.db')
         self.init_file = os.path.join(resource_path, 'schema.sql')
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size_mib = mmap_size_mib
+
+        # Connections are kept open and reused, one for each thread that uses them
+        self.__local = threading.local()
 
-        # Run init script to ensure database structure
+        with _initialized_lock:
+            if self.db_file not in _initialized_files:
+                self.__migrate()
+                _initialized_files.add(self.db_file)
+
+    def __migrate(self):
+        conn = sqlite3.connect(self.db_file, isolation_level=None)
+        try:
+            # Only takes effect on a new file, before the first table is created. It lets retention
+            # give space back in small steps, where older files need a full vacuum first.
+            conn.execute('pragma auto_vacuum = incremental')
+            # Take the write lock before checking the version so the backend and
+            # webserver can't both try to apply the same migration
+            conn.execute('begin immediate')
+            version = conn.execute('pragma user_version').fetchone()[0]
+
+            scripts = MIGRATIONS[max(version - 1, 0):]
+            if version == 0:
+                # Run init script to ensure database structure
+                with open(self.init_file, mode='r') as f:
+                    scripts.insert(0, f.read())
+
+            for script in scripts:
+                for statement in self.__split_statements(script):
+                    conn.execute(statement)
+                version += 1
+                conn.execute('pragma user_version = %d' % version)
+            conn.execute('commit')
+
+            # WAL lets readers carry on while the backend is writing. This setting is stored in the file.
+            conn.execute('pragma journal_mode = wal')
+        finally:
+            conn.close()
+
+    def incremental_vacuum_enabled(self) -> bool:
+        return self.get_connection().execute('pragma auto_vacuum').fetchone()[0] == 2
+
+    def enable_incremental_vacuum(self):
+        """
+        Switches a database made before incremental vacuum was used over to it. This is a full
+        vacuum that locks the whole file while it's rewritten, so only do it while nothing is writing.
+        """
         conn = self.get_connection()
-        with open(self.init_file, mode='r') as f:
-            conn.cursor().executescript(f.read())
-        conn.commit()
-        conn.close()
+        conn.execute('pragma auto_vacuum = incremental')
+        conn.execute('vacuum')
+
+    @staticmethod
+    def __split_statements(script: str):
+        statement = ''
+        for line in script.splitlines(keepends=True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                yield statement
+                statement = ''
+        if statement.strip() and not statement.strip().startswith('--'):
+            yield statement
 
     def get_connection(self):
-        rv = sqlite3.connect(self.db_file)
-        rv.row_factory = sqlite3.Row
+        """ Gets this thread's connection, opening it if necessary. """
+        rv = getattr(self.__local, 'conn', None)
+        if rv is None:
+            rv = sqlite3.connect(self.db_file, cached_statements=32)
+            rv.row_factory = sqlite3.Row
+            rv.execute('pragma synchronous = normal')
+            rv.execute('pragma cache_size = %d' % -self.cache_size_kib)
+            rv.execute('pragma mmap_size = %d' % (self.mmap_size_mib * 1024 * 1024))
+            self.__local.conn = rv
         return rv
 
-    def record_event(self, user_agent: str, login: str, event: str, description: str):
+    def close(self):
+        """ Closes this thread's connection if it has one. """
+        conn = getattr(self.__local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.__local.conn = None
+
+    @_timed('record_event')
+    def record_event(self, user_agent: str, login: str, event: str, description: str, door: str=DEFAULT_DOOR_ID):
         conn = self.get_connection()
-        conn.execute('insert into entries (UserAgent, Login, Event, Description) values (?, ?, ?, ?)',
-                     [user_agent, login, event, description])
+        conn.execute(INSERT_EVENT, [user_agent, login, event, description, door])
         conn.commit()
-        conn.close()
 
+    @_timed('record_events')
+    def record_events(self, events):
+        """
+        Records several events in order in one transaction, so there's one commit for them all.
+
+        :param events: List of HistoryEvent
+        """
+        conn = self.get_connection()
+        with conn:
+            for event in events:
+                if event.id is None:
+                    conn.execute(INSERT_EVENT_AT, [event.timestamp, event.user_agent, event.login, event.event,
+                                                   event.description, event.door])
+                else:
+                    conn.execute(INSERT_EVENT_WITH_ID, [event.id, event.timestamp, event.user_agent, event.login,
+                                                        event.event, event.description, event.door])
+                if event.is_open is not None:
+                    DoorAnalytics.record(conn, event.timestamp, event.is_open, event.is_transition, event.door)
+
+    @_timed('read_door_stats')
+    def read_door_stats(self) -> dict:
+        return DoorAnalytics.read(self.get_connection())
+
+    def backfill_door_stats(self) -> bool:
+        """
+        Builds the door usage stats from existing history the first time it's called.
+
+        :return: True if a backfill was done
+        """
+        conn = self.get_connection()
+        with conn:
+            # Taking the write lock first makes sure only one process does this
+            conn.execute('insert or ignore into meta (Key, Value) values (\'door_stats_backfilled\', 0)')
+            if self.get_meta('door_stats_backfilled') != '0': return False
+            rows = conn.execute('select Timestamp, Event, Description, Door from entries '
+                                'where Event in (\'SensorTrip\', \'StartupSensorRead\') order by Timestamp, ID')
+            DoorAnalytics.backfill(conn, rows)
+            conn.execute('update meta set Value = 1 where Key = \'door_stats_backfilled\'')
+        return True
+
+    @_timed('read_history')
     def read_history(self):
         conn = self.get_connection()
-        cur = conn.execute('select datetime(timestamp, \'localtime\') as timestamp, event, description from entries order by timestamp desc')
-        records = cur.fetchmany(500)
-        conn.close()
-        return records
-    
+        return conn.execute(SELECT_RECENT_HISTORY, [500]).fetchall()
+
+    @_timed('read_recent_events')
+    def read_recent_events(self, limit: int):
+        """
+        Reads the newest events by id, with both UTC and local timestamps.
+
+        :return: Tuple of the rows newest first, the lowest id in history (None if it's empty), and the
+                 highest id ever used (0 if none has), which stays put even once the rows are removed
+        """
+        conn = self.get_connection()
+        rows = conn.execute('select ID as id, Timestamp as timestamp, '
+                            'datetime(Timestamp, \'localtime\') as local_timestamp, Event as event, Login as login, Description as description, Door as door '
+                            'from entries order by ID desc limit ?', [limit]).fetchall()
+        first_id, last_id = conn.execute('select min(ID), max(ID) from entries').fetchone()
+        # Ids aren't reused, so carry on from the last one handed out even if its row is gone
+        sequence = conn.execute('select seq from sqlite_sequence where name = \'entries\'').fetchone()
+        last_id = max(last_id or 0, sequence[0] if sequence else 0)
+        return rows, first_id, last_id
+
+    @_timed('read_full_history')
     def read_full_history(self):
         conn = self.get_connection()
-        cur = conn.execute('select datetime(timestamp, \'localtime\') as timestamp, event, description from entries order by timestamp desc')
-        records = cur.fetchall()
-        conn.close()
-        return records
+        return conn.execute(SELECT_HISTORY).fetchall()
+
+    @_timed('query_history')
+    def query_history(self, before: str=None, limit: int=100, event: str=None, login: str=None,
+                      since: str=None, until: str=None, door: str=None, after: int=None):
+        """
+        Reads a page of history, newest first. Pages are found by seeking the
+        index so each one costs the same no matter how far back it is.
+
+        :param before: Cursor returned with the previous page, or None for the first page
+        :param limit: Most rows to return
+        :param event: Only include rows with this event type
+        :param login: Only include rows for this login
+        :param since: Only include rows at or after this local date/time (YYYY-MM-DD[ HH:MM:SS])
+        :param until: Only include rows before this local date/time
+        :param door: Only include rows for this door id
+        :param after: Only include rows with ids above this one, to get what's been added since
+        :return: Tuple of the rows and the cursor for the next page (None if this is the last page)
+        """
+        columns = 'ID as id, Timestamp as timestamp, Event as event, Login as login, Description as description, ' \
+                  'Door as door'
+        return self.__query_history_page(columns, before, limit, event, login, since, until, door, after)
+
+    def iter_history(self, since: str=None, until: str=None, page_size: int=1000):
+        """
+        Generates every row of history in the given range, newest first, with
+        local timestamps. Rows are read a page at a time so memory use stays
+        flat and no read transaction is held open between pages.
+        """
+        columns = 'ID as id, Timestamp as timestamp, datetime(Timestamp, \'localtime\') as local_timestamp, ' \
+                  'Event as event, Description as description, Door as door'
+        cursor = None
+        while True:
+            records, cursor = self.__query_history_page(columns, cursor, page_size, None, None, since, until)
+            yield from records
+            if cursor is None: return
+
+    @_timed('history_page')
+    def __query_history_page(self, columns: str, before: str, limit: int, event: str, login: str,
+                             since: str, until: str, door: str=None, after: int=None):
+        clauses = []
+        params = []
+        if before:
+            timestamp, id = self.parse_cursor(before)
+            clauses.append('(Timestamp, ID) < (?, ?)')
+            params += [timestamp, id]
+        if event:
+            clauses.append('Event = ?')
+            params.append(event)
+        if login:
+            clauses.append('Login = ?')
+            params.append(login)
+        if door:
+            clauses.append('Door = ?')
+            params.append(door)
+        if after is not None:
+            clauses.append('ID > ?')
+            params.append(after)
+        if since:
+            clauses.append('Timestamp >= datetime(?, \'utc\')')
+            params.append(since)
+        if until:
+            clauses.append('Timestamp < datetime(?, \'utc\')')
+            params.append(until)
+
+        sql = 'select %s from entries' % columns
+        if clauses:
+            sql += ' where ' + ' and '.join(clauses)
+        sql += ' order by Timestamp desc, ID desc limit ?'
+        params.append(limit)
+
+        records = self.get_connection().execute(sql, params).fetchall()
+        next_cursor = self.make_cursor(records[-1]) if records and len(records) == limit else None
+        return records, next_cursor
+
+    @_timed('read_rollups')
+    def read_rollups(self, before_day: str=None, limit: int=30):
+        """
+        Reads daily summaries of archived history, newest day first.
+
+        :param before_day: Only include days before this one (YYYY-MM-DD), for paging
+        :param limit: Most days to return
+        :return: List of dicts with the day, door counts, open time, and a count for each event type
+        """
+        conn = self.get_connection()
+        days = conn.execute('select Day as day, Opens as opens, Closes as closes, OpenSeconds as open_seconds '
+                            'from daily_door_rollups where Day < ? order by Day desc limit ?',
+                            [before_day or '9999-12-31', limit]).fetchall()
+        rollups = [dict(day) for day in days]
+        if not rollups: return rollups
+
+        by_day = {rollup['day']: rollup for rollup in rollups}
+        for rollup in rollups:
+            rollup['events'] = {}
+        for row in conn.execute('select Day, Event, Count from daily_rollups where Day between ? and ?',
+                                [rollups[-1]['day'], rollups[0]['day']]):
+            if row['Day'] in by_day:
+                by_day[row['Day']]['events'][row['Event']] = row['Count']
+        return rollups
+
+    def get_meta(self, key: str, default=None):
+        row = self.get_connection().execute('select Value from meta where Key = ?', [key]).fetchone()
+        return default if row is None else row[0]
+
+    @staticmethod
+    def make_cursor(record) -> str:
+        return '%s|%d' % (record['timestamp'], record['id'])
+
+    @staticmethod
+    def parse_cursor(cursor: str):
+        """ Splits a cursor from make_cursor into its timestamp and id. Raises ValueError if it's malformed. """
+        timestamp, sep, id = cursor.rpartition('|')
+        if not sep or not timestamp:
+            raise ValueError('Malformed history cursor %r' % cursor)
+        return timestamp, int(id)
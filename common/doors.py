@@ -0,0 +1,28 @@
+from collections import namedtuple
+
+# History recorded before doors had ids, and setups without a DOORS list, use this id
+DEFAULT_DOOR_ID = 'garage'
+
+Door = namedtuple('Door', ['id', 'name', 'reed_pin', 'relay_pin'])
+
+
+def load_doors(config) -> list:
+    """
+    Reads the doors from the app config. Without a DOORS list there's a
+    single door on REED_PIN and RELAY_PIN.
+
+    :return: List of Door, with the default door first
+    """
+    entries = config.get('DOORS') or [dict(id=DEFAULT_DOOR_ID, name='Garage',
+                                           reed_pin=config['REED_PIN'], relay_pin=config['RELAY_PIN'])]
+    doors = []
+    for entry in entries:
+        door = Door(str(entry['id']), entry.get('name') or str(entry['id']), entry['reed_pin'], entry['relay_pin'])
+        for other in doors:
+            if door.id == other.id:
+                raise ValueError("Door id '%s' is used more than once" % door.id)
+            used_pins = {other.reed_pin, other.relay_pin}
+            if door.reed_pin in used_pins or door.relay_pin in used_pins:
+                raise ValueError("Door '%s' shares a pin with door '%s'" % (door.id, other.id))
+        doors.append(door)
+    return doors
@@ -0,0 +1,160 @@
+import logging
+import queue
+import threading
+import time
+from common import metrics
+from common.db import GarageDb, HistoryEvent
+
+BATCH_SIZE = metrics.registry.histogram('garagepi_event_batch_size', 'Events written in each history commit',
+                                        buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+ENQUEUE_BLOCKED = metrics.registry.counter('garagepi_event_enqueue_blocked',
+                                           'Events whose caller had to wait for room in the history queue')
+
+MAX_BATCH = 256
+WRITE_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+
+
+class EventWriter(object):
+    """
+    Writes history from one thread so callers (like the GPIO callback) only queue
+    events and never wait on the SD card.
+
+    Events that arrive close together are written in one transaction, so they
+    share a single commit. The writer waits up to max_delay after the first
+    event for others to join it. If the queue fills up, callers wait for room
+    rather than losing history.
+    """
+
+    def __init__(self, logger: logging.Logger, max_delay=0.05, queue_size=1000):
+        """
+        :param logger: Logger for logging purposes
+        :param max_delay: Most seconds an event waits for others to be committed with it
+        :param queue_size: Most events waiting to be written before callers have to wait
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__max_delay = max_delay
+        self.__queue = queue.Queue(queue_size)
+        self.__thread = None    # type: threading.Thread
+        self.__db = None        # type: GarageDb
+        self.__on_commit = None
+        # Held while writing so events written directly after stopping don't race the last batch
+        self.__write_lock = threading.Lock()
+        # Held while queueing and while stopping, so nothing is queued behind the writer's stop marker
+        self.__state_lock = threading.Lock()
+        self.__stopped = False
+
+        self.committed_count = 0
+        self.batch_count = 0
+        self.max_batch = 0
+        self.blocked_count = 0
+        self.failed_count = 0
+
+    def start(self, db: GarageDb, on_commit=None):
+        """
+        :param db: Database to write to. The writer thread uses its own connection.
+        :param on_commit: Callable invoked after each commit, for example to tell readers history has changed
+        """
+        assert self.__thread is None, 'EventWriter can only be started once'
+        self.__db = db
+        self.__on_commit = on_commit
+        self.__thread = threading.Thread(target=self.__run, name='EventWriter', daemon=True)
+        self.__thread.start()
+
+    def record(self, event: HistoryEvent):
+        """ Queues an event to be written, waiting for room if the queue is full. """
+        with self.__state_lock:
+            running = self.__thread is not None and not self.__stopped
+            if running:
+                self.__put(event)
+        if not running:
+            # Nothing is left to write it, such as a door changing during shutdown
+            self.__write([event])
+
+    def flush(self, timeout: float=None) -> bool:
+        """ Waits until every event queued so far has been written. Returns False if it timed out. """
+        done = threading.Event()
+        with self.__state_lock:
+            if self.__thread is None or self.__stopped: return True
+            self.__queue.put(done)
+        return done.wait(timeout)
+
+    def stop(self, timeout=10.0):
+        """ Writes what's queued and stops the writer, waiting up to the given number of seconds. """
+        with self.__state_lock:
+            if self.__thread is None or self.__stopped: return
+            self.__logger.info('Writing %d queued history events', self.__queue.qsize())
+            self.__stopped = True
+            self.__queue.put(None)
+        self.__thread.join(timeout)
+
+    def __put(self, event: HistoryEvent):
+        try:
+            self.__queue.put_nowait(event)
+        except queue.Full:
+            self.blocked_count += 1
+            ENQUEUE_BLOCKED.inc()
+            # A burst can block many callers in a row so don't log every one
+            if self.blocked_count % 100 == 1:
+                self.__logger.warning('History queue is full. Waiting for the writer to catch up.')
+            # The writer doesn't need the state lock to make room
+            self.__queue.put(event)
+
+    def stats(self) -> dict:
+        return dict(queued=self.__queue.qsize(), committed_count=self.committed_count,
+                    batch_count=self.batch_count, max_batch=self.max_batch,
+                    blocked_count=self.blocked_count, failed_count=self.failed_count)
+
+    def __run(self):
+        running = True
+        while running:
+            batch, markers = [], []
+            item = self.__queue.get()
+            deadline = time.monotonic() + self.__max_delay
+            while True:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                if not running or len(batch) >= MAX_BATCH: break
+                # Take whatever else is waiting, then give later events until the deadline to join
+                try:
+                    item = self.__queue.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or markers: break
+                    try:
+                        item = self.__queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+
+            if batch: self.__write(batch)
+            for marker in markers:
+                marker.set()
+        self.__db.close()
+
+    def __write(self, batch: list):
+        with self.__write_lock:
+            for attempt in range(WRITE_ATTEMPTS):
+                try:
+                    self.__db.record_events(batch)
+                    break
+                except Exception:
+                    self.__logger.exception('Attempt %d to write %d history events failed', attempt + 1, len(batch))
+                    if attempt + 1 < WRITE_ATTEMPTS: time.sleep(RETRY_DELAY)
+            else:
+                self.failed_count += len(batch)
+                for event in batch:
+                    self.__logger.error('Lost history event: %s %s %s %s', event.timestamp, event.door, event.event,
+                                        event.description)
+                return
+
+            self.committed_count += len(batch)
+            self.batch_count += 1
+            self.max_batch = max(self.max_batch, len(batch))
+        BATCH_SIZE.observe(len(batch))
+        if self.__on_commit is not None:
+            self.__on_commit()
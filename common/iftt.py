@@ -1,5 +1,18 @@
-import requests
 import logging
+import threading
+
+# Sessions keep connections to IFTTT alive between triggers. They aren't
+# guaranteed to be thread safe so each thread gets its own.
+_sessions = threading.local()
+
+def _get_session():
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        # requests is slow to import so it's left until the first notification is sent
+        import requests
+        session = requests.Session()
+        _sessions.session = session
+    return session
 
 class IftttEvent:
 
@@ -7,11 +20,14 @@ class IftttEvent:
     event_name = ''
     logger = None
 
-    def __init__(self, maker_key: str, event_name: str, logger: logging.Logger):
+    def __init__(self, maker_key: str, event_name: str, logger: logging.Logger, timeout: float=10,
+                 base_url: str='https://maker.ifttt.com'):
         """
         :param maker_key: The authenticating maker key
         :param event_name: The name of the event to trigger
         :param logger: Logger for logging purposes
+        :param timeout: Seconds to wait for IFTTT to respond
+        :param base_url: Address of the Maker service, which can be changed to point at a local stand-in
         """
         if logger is None:
             raise Exception("Logger is missing!")
@@ -25,11 +41,13 @@ class IftttEvent:
         self.maker_key = maker_key
         self.event_name = event_name
         self.logger = logger
+        self.timeout = timeout
+        self.base_url = base_url
 
     def trigger(self, value1: str=None, value2: str=None, value3: str=None):
-        url = 'https://maker.ifttt.com/trigger/{0}/with/key/{1}'.format(self.event_name, self.maker_key)
+        url = '{0}/trigger/{1}/with/key/{2}'.format(self.base_url, self.event_name, self.maker_key)
 
-        self.logger.info("Sending IFTTT trigger for %s with values %r %r %r" % (self.event_name, value1, value2, value3))
+        self.logger.info("Sending IFTTT trigger for %s with values %r %r %r", self.event_name, value1, value2, value3)
 
         if value1 or value2 or value3:
             data = {}
@@ -37,10 +55,11 @@ class IftttEvent:
             if value2: data['value2'] = value2
             if value3: data['value3'] = value3
 
-            r = requests.post(url, json=data)
+            r = _get_session().post(url, json=data, timeout=self.timeout)
         else:
-            r = requests.post(url)
+            r = _get_session().post(url, timeout=self.timeout)
 
-        self.logger.info("IFTTT response for {0}: {1}".format(self.event_name, r.text))
+        self.logger.info("IFTTT response for %s: %s", self.event_name, r.text)
+        r.raise_for_status()
 
         return r.text
@@ -0,0 +1,146 @@
+"""
+Moves log formatting and file writes off the threads that log.
+
+Loggers get a single handler that puts records on a queue. One background
+thread takes them off and passes them to the real handlers, so a slow SD card
+never holds up the IPC loop or a GPIO callback. Records are queued as they
+are, so %-style arguments are only formatted on that thread. Arguments should
+therefore not be changed after they're logged.
+
+Optionally, DEBUG records can be kept in a ring in memory instead of being
+written, and only written out when an error is logged, to show what led up to
+it.
+"""
+
+import atexit
+import collections
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+QUEUE_SIZE = 10000
+
+
+class LazyQueueHandler(QueueHandler):
+    """ Queues records without formatting them, dropping them if the writer has fallen too far behind. """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped_count = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock handler formats here, on the logging thread, so records can be pickled
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Passes records at or above pass_level to its targets and keeps the last few
+    below it in memory. An error writes out the kept records before itself.
+    """
+
+    def __init__(self, capacity: int, targets, pass_level=logging.INFO, flush_level=logging.ERROR):
+        """
+        :param capacity: Most records to keep
+        :param targets: Handlers to write records to
+        :param pass_level: Records at this level or above are written right away
+        :param flush_level: Records at this level or above also write out the kept records
+        """
+        super().__init__()
+        self.__ring = collections.deque(maxlen=capacity)
+        self.__targets = list(targets)
+        self.__pass_level = pass_level
+        self.__flush_level = flush_level
+        self.flush_count = 0
+
+    def emit(self, record: logging.LogRecord):
+        if record.levelno < self.__pass_level:
+            self.__ring.append(record)
+            return
+        if record.levelno >= self.__flush_level and self.__ring:
+            self.flush_count += 1
+            while self.__ring:
+                self.__write(self.__ring.popleft())
+        self.__write(record)
+
+    def __write(self, record: logging.LogRecord):
+        for handler in self.__targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def close(self):
+        for handler in self.__targets:
+            handler.close()
+        super().close()
+
+
+class QueueLogging(object):
+    """ A logger's queue and the thread writing it out. Made by start_queue_logging. """
+
+    def __init__(self, handler: LazyQueueHandler, listener: QueueListener):
+        self.__handler = handler
+        self.__listener = listener
+        self.__lock = threading.Lock()
+        self.__stopped = False
+
+    def stop(self):
+        """ Writes out everything queued so far and stops the thread. Safe to call more than once. """
+        with self.__lock:
+            if self.__stopped: return
+            self.__stopped = True
+        self.__listener.stop()
+
+    def stats(self) -> dict:
+        return dict(queued=self.__handler.queue.qsize(), dropped_count=self.__handler.dropped_count)
+
+
+def _level_number(level) -> int:
+    """ Turns a level given as a number or a name in any case, like 'info', into its number. """
+    if isinstance(level, int) and not isinstance(level, bool):
+        return level
+    if isinstance(level, str):
+        number = logging.getLevelName(level.strip().upper())
+        # Unknown names come back as the string 'Level NAME'
+        if isinstance(number, int):
+            return number
+    raise ValueError("Unknown log level %r. Use a name like 'INFO' or 'DEBUG'." % (level,))
+
+
+def start_queue_logging(logger: logging.Logger, level=logging.DEBUG, ring_size: int=0) -> QueueLogging:
+    """
+    Moves a logger's handlers behind a queue and starts the thread that writes them.
+    The queue is written out when the process exits.
+
+    :param logger: Logger whose handlers to move. It has to come from logging.getLogger for its level to change.
+    :param level: Lowest level written to the handlers, as a number or a name like 'INFO'
+    :param ring_size: If more than 0, records below the level are kept in a ring of this many and only written on errors
+    :raises ValueError: If the level isn't a known level
+    """
+    level = _level_number(level)
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    if ring_size > 0:
+        # Everything reaches the ring, which only passes on records at the level or above
+        logger.setLevel(logging.DEBUG)
+        handlers = [RingBufferHandler(ring_size, handlers, pass_level=level)]
+    else:
+        logger.setLevel(level)
+
+    log_queue = queue.Queue(QUEUE_SIZE)
+    queue_handler = LazyQueueHandler(log_queue)
+    logger.addHandler(queue_handler)
+    # Each handler checks its own level, as it would if it were still on the logger
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    queue_logging = QueueLogging(queue_handler, listener)
+    atexit.register(queue_logging.stop)
+    return queue_logging
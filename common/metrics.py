@@ -0,0 +1,206 @@
+"""
+Counters and latency histograms, exposed in the Prometheus text format.
+
+Each process records into the module's registry. The backend sends what it
+collected to the webserver over IPC, which renders both under one /metrics
+page with a process label telling them apart.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+# Seconds. Fine enough at the low end for IPC and sqlite calls, long enough for slow notifications.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Timer(object):
+    __slots__ = ('__observe', '__start')
+
+    def __init__(self, observe):
+        self.__observe = observe
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.__observe(time.perf_counter() - self.__start)
+
+
+class _Metric(object):
+    def __init__(self, name: str, help: str, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """ Gets the series for the given label values. Keep the result to skip the lookup on hot paths. """
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            assert len(values) == len(self.label_names), 'Expected labels %s' % (self.label_names,)
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _label_dict(self, values) -> dict:
+        return dict(zip(self.label_names, values))
+
+
+class _CounterChild(object):
+    __slots__ = ('__lock', 'value')
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    @property
+    def family_name(self) -> str:
+        # The text format names counter families after their samples
+        return self.name + '_total'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def collect(self) -> list:
+        return [[self.name + '_total', self._label_dict(values), child.value]
+                for values, child in list(self._children.items())]
+
+
+class _HistogramChild(object):
+    __slots__ = ('__lock', '__buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.__lock = threading.Lock()
+        self.__buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect_left(self.__buckets, value)
+        with self.__lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> _Timer:
+        """ Context manager that observes how long its block took. """
+        return _Timer(self.observe)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    @property
+    def family_name(self) -> str:
+        return self.name
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self, *label_values) -> _Timer:
+        return self.labels(*label_values).time()
+
+    def collect(self) -> list:
+        samples = []
+        for values, child in list(self._children.items()):
+            labels = self._label_dict(values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                samples.append([self.name + '_bucket', dict(labels, le=_format_value(bound)), cumulative])
+            samples.append([self.name + '_sum', labels, child.sum])
+            samples.append([self.name + '_count', labels, child.count])
+        return samples
+
+
+class Registry(object):
+    """ The metrics a process records. Registering the same name again returns the existing metric. """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics = {}
+
+    def counter(self, name: str, help: str, label_names=()) -> Counter:
+        return self.__register(Counter, name, help, label_names)
+
+    def histogram(self, name: str, help: str, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.__register(Histogram, name, help, label_names, buckets=buckets)
+
+    def __register(self, cls, name: str, help: str, label_names, **kwargs):
+        with self.__lock:
+            metric = self.__metrics.get(name)
+            if metric is None:
+                metric = self.__metrics[name] = cls(name, help, label_names, **kwargs)
+                # Metrics without labels are reported as zero until first used
+                if not metric.label_names: metric.labels()
+            assert isinstance(metric, cls) and metric.label_names == tuple(label_names), \
+                'Metric %s registered twice with different types or labels' % name
+            return metric
+
+    def collect(self) -> list:
+        """ Gets every metric as plain lists and dicts so they can be sent as JSON. """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        return [dict(name=metric.family_name, type=metric.type, help=metric.help, samples=metric.collect())
+                for metric in metrics]
+
+
+registry = Registry()
+
+
+def render(sources) -> str:
+    """
+    Formats collected metrics as Prometheus text.
+
+    :param sources: List of (process name, collected metrics) pairs. Metrics with the same
+                    name from different processes are listed together under a process label.
+    """
+    families = {}
+    for process, collected in sources:
+        for family in collected:
+            merged = families.setdefault(family['name'], dict(family, samples=[]))
+            for name, labels, value in family['samples']:
+                merged['samples'].append((name, dict(labels, process=process), value))
+
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append('# HELP %s %s' % (name, family['help'].replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE %s %s' % (name, family['type']))
+        for sample, labels, value in family['samples']:
+            label_text = ','.join('%s="%s"' % (key, _escape(labels[key])) for key in sorted(labels))
+            lines.append('%s{%s} %s' % (sample, label_text, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value) -> str:
+    if value == float('inf'): return '+Inf'
+    if isinstance(value, float): return repr(value)
+    return str(value)
@@ -0,0 +1,136 @@
+import json
+import logging
+import queue
+import threading
+import time
+from common import metrics
+
+SEND_SECONDS = metrics.registry.histogram('garagepi_notification_send_seconds',
+                                          'Time taken by each attempt to send a notification', ['name', 'result'])
+QUEUE_SECONDS = metrics.registry.histogram('garagepi_notification_queue_seconds',
+                                           'Time notifications waited in the queue before a worker took them')
+NOTIFICATIONS = metrics.registry.counter('garagepi_notifications', 'Notifications by outcome', ['name', 'outcome'])
+
+
+class NotificationDispatcher(object):
+    """
+    Sends notifications from a small pool of worker threads so that callers
+    (like the GPIO callback) only have to queue them up. Each worker has its
+    own queue, and notifications with the same key always go to the same
+    worker, so they're sent in the order they were submitted.
+
+    Failed sends are retried with exponential backoff. Notifications that
+    still fail, or that don't fit in the queue, are written to a dead-letter log.
+    """
+
+    def __init__(self, logger: logging.Logger, workers=2, queue_size=64, max_retries=4, retry_delay=2.0,
+                 dead_letter_file=None):
+        """
+        :param logger: Logger for logging purposes
+        :param workers: Number of threads sending notifications
+        :param queue_size: Most notifications that can be waiting for each worker
+        :param max_retries: Times a failed notification is retried before giving up
+        :param retry_delay: Seconds to wait before the first retry. Doubles with each retry.
+        :param dead_letter_file: File that notifications that couldn't be sent are appended to
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__worker_count = workers
+        self.__max_retries = max_retries
+        self.__retry_delay = retry_delay
+        self.__dead_letter_file = dead_letter_file
+
+        self.__queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.__stop_event = threading.Event()
+        self.__dead_letter_lock = threading.Lock()
+        self.__workers = []     # type: list[threading.Thread]
+
+        self.sent_count = 0
+        self.retry_count = 0
+        self.dead_letter_count = 0
+
+    def start(self):
+        for i in range(self.__worker_count):
+            t = threading.Thread(target=self.__run, args=(self.__queues[i],), name='NotificationWorker-%d' % i,
+                                 daemon=True)
+            t.start()
+            self.__workers.append(t)
+
+    def stop(self, timeout=5.0):
+        """ Lets the workers finish what's queued, waiting up to the given number of seconds. """
+        self.__stop_event.set()
+        for q in self.__queues[:len(self.__workers)]:
+            try:
+                q.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        for t in self.__workers:
+            t.join(timeout)
+        self.__workers = []
+
+    def submit(self, name: str, send, *args, key: str=None) -> bool:
+        """
+        Queues a notification without blocking.
+
+        :param name: Description of the notification used in logs
+        :param send: Callable that sends the notification and raises on failure
+        :param args: Arguments passed to the callable
+        :param key: Notifications with the same key are sent in order, such as those for one door. Defaults to name.
+        :return: True if queued, False if the queue was full
+        """
+        q = self.__queues[hash(key or name) % len(self.__queues)]
+        try:
+            q.put_nowait((name, send, args, time.perf_counter()))
+            return True
+        except queue.Full:
+            self.__dead_letter(name, args, 'queue full')
+            return False
+
+    def stats(self) -> dict:
+        return dict(queued=sum(q.qsize() for q in self.__queues),
+                    sent_count=self.sent_count,
+                    retry_count=self.retry_count,
+                    dead_letter_count=self.dead_letter_count)
+
+    def __run(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is None: return
+            name, send, args, queued_at = item
+            QUEUE_SECONDS.observe(time.perf_counter() - queued_at)
+            self.__send(name, send, args)
+
+    def __send(self, name: str, send, args):
+        delay = self.__retry_delay
+        for attempt in range(self.__max_retries + 1):
+            if attempt:
+                # Don't hold up shutdown waiting to retry
+                if self.__stop_event.wait(delay): break
+                delay *= 2
+                self.retry_count += 1
+                NOTIFICATIONS.labels(name, 'retried').inc()
+            start = time.perf_counter()
+            try:
+                send(*args)
+                SEND_SECONDS.labels(name, 'ok').observe(time.perf_counter() - start)
+                NOTIFICATIONS.labels(name, 'sent').inc()
+                self.sent_count += 1
+                return
+            except Exception as e:
+                SEND_SECONDS.labels(name, 'error').observe(time.perf_counter() - start)
+                self.__logger.warning("Attempt %d to send %s failed: %s", attempt + 1, name, e)
+                error = e
+        self.__dead_letter(name, args, str(error))
+
+    def __dead_letter(self, name: str, args, reason: str):
+        self.dead_letter_count += 1
+        NOTIFICATIONS.labels(name, 'dead_lettered').inc()
+        self.__logger.error("Giving up on %s: %s", name, reason)
+        if not self.__dead_letter_file: return
+        entry = dict(time=time.strftime('%Y-%m-%d %H:%M:%S'), name=name, args=[repr(a) for a in args], reason=reason)
+        with self.__dead_letter_lock:
+            try:
+                with open(self.__dead_letter_file, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+            except OSError:
+                self.__logger.exception('Unable to write to dead-letter log')
@@ -0,0 +1,186 @@
+"""
+Message formats used between the webserver and the backend.
+
+Requests are [operation, contents] with an optional third frame naming the
+format the contents and the reply are encoded in. Without it both sides use
+JSON, which is all older clients know. Clients ask the backend which formats
+it speaks with the 'negotiate' operation before sending anything else.
+
+The binary formats pack each message into a fixed struct layout. Their
+replies start with a byte saying whether the operation succeeded; if it
+didn't the rest is the error message. Version 2 adds the door list to the
+status and a door id to trigger_relay.
+"""
+
+import json
+import math
+import struct
+
+FORMAT_JSON = b'json'
+FORMAT_BINARY_V1 = b'bin1'
+FORMAT_BINARY = b'bin2'
+BINARY_VERSIONS = {FORMAT_BINARY_V1: 1, FORMAT_BINARY: 2}
+SUPPORTED_FORMATS = (FORMAT_BINARY, FORMAT_BINARY_V1, FORMAT_JSON)   # most preferred first
+
+REPLY_OK = b'\x00'
+REPLY_ERROR = b'\x01'
+
+# Step of a relay program that pulses the relay. The other steps are seconds to wait.
+RELAY_PULSE = 'pulse'
+
+_STATUS_LAYOUT = struct.Struct('<?dddd')
+_DOOR_COUNT = struct.Struct('<B')
+_DOOR_STATE = struct.Struct('<?')
+_STRING_LENGTH = struct.Struct('<H')
+
+
+class ProtocolError(Exception):
+    """ Raised when a message can't be decoded or the other side reports an error. """
+    pass
+
+
+class DoorStatus(object):
+    """ Whether one door is open. """
+
+    __slots__ = ('id', 'name', 'is_open')
+
+    def __init__(self, id: str, name: str, is_open: bool):
+        self.id = id
+        self.name = name
+        self.is_open = bool(is_open)
+
+    @property
+    def status_text(self) -> str:
+        return "OPEN" if self.is_open else "CLOSED"
+
+    def to_dict(self) -> dict:
+        return dict(id=self.id, name=self.name, is_open=self.is_open, status_text=self.status_text)
+
+    def __repr__(self):
+        return 'DoorStatus(id=%r, name=%r, is_open=%r)' % (self.id, self.name, self.is_open)
+
+
+class StatusRecord(object):
+    """
+    Door and system status as sent to clients. Instances are shared so must not be modified.
+
+    is_open is for the default (first) door, which is all clients from before
+    there could be several doors know about. doors has every door in order.
+    """
+
+    __slots__ = ('is_open', 'cpu_temp_c', 'cpu_temp_f', 'gpu_temp_c', 'gpu_temp_f', 'doors')
+
+    def __init__(self, is_open: bool, cpu_temp_c: float=None, cpu_temp_f: float=None,
+                 gpu_temp_c: float=None, gpu_temp_f: float=None, doors=()):
+        self.is_open = bool(is_open)
+        self.cpu_temp_c = cpu_temp_c
+        self.cpu_temp_f = cpu_temp_f
+        self.gpu_temp_c = gpu_temp_c
+        self.gpu_temp_f = gpu_temp_f
+        self.doors = tuple(doors)
+
+    @property
+    def status_text(self) -> str:
+        return "OPEN" if self.is_open else "CLOSED"
+
+    def to_dict(self) -> dict:
+        return dict(is_open=self.is_open, status_text=self.status_text,
+                    cpu_temp_c=self.cpu_temp_c, cpu_temp_f=self.cpu_temp_f,
+                    gpu_temp_c=self.gpu_temp_c, gpu_temp_f=self.gpu_temp_f,
+                    doors=[door.to_dict() for door in self.doors])
+
+    def to_json_bytes(self) -> bytes:
+        return str.encode(json.dumps(self.to_dict(), sort_keys=True))
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        doors = [DoorStatus(door['id'], door['name'], door['is_open']) for door in data.get('doors', [])]
+        return cls(data['is_open'], data.get('cpu_temp_c'), data.get('cpu_temp_f'),
+                   data.get('gpu_temp_c'), data.get('gpu_temp_f'), doors)
+
+    def pack(self, version: int=2) -> bytes:
+        # Unknown temperatures travel as NaN
+        data = _STATUS_LAYOUT.pack(self.is_open, *[math.nan if value is None else value
+                                                   for value in (self.cpu_temp_c, self.cpu_temp_f,
+                                                                 self.gpu_temp_c, self.gpu_temp_f)])
+        if version < 2: return data
+        parts = [data, _DOOR_COUNT.pack(len(self.doors))]
+        for door in self.doors:
+            parts.append(_DOOR_STATE.pack(door.is_open))
+            parts.append(pack_strings(door.id, door.name))
+        return b''.join(parts)
+
+    @classmethod
+    def unpack(cls, data: bytes, version: int=2):
+        try:
+            values = _STATUS_LAYOUT.unpack_from(data)
+            doors = []
+            if version >= 2:
+                offset = _STATUS_LAYOUT.size
+                count, = _DOOR_COUNT.unpack_from(data, offset)
+                offset += _DOOR_COUNT.size
+                for i in range(count):
+                    is_open, = _DOOR_STATE.unpack_from(data, offset)
+                    offset += _DOOR_STATE.size
+                    (id, name), offset = _unpack_strings_from(data, offset, 2)
+                    doors.append(DoorStatus(id, name, is_open))
+        except struct.error as e:
+            raise ProtocolError('Bad status message: %s' % e)
+        return cls(values[0], *[None if math.isnan(value) else value for value in values[1:]], doors=doors)
+
+    def __eq__(self, other):
+        return isinstance(other, StatusRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return 'StatusRecord(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+
+
+def pack_strings(*values: str) -> bytes:
+    """ Packs strings as UTF-8, each preceded by its length. """
+    parts = []
+    for value in values:
+        encoded = str.encode(value or '')
+        parts.append(_STRING_LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    return b''.join(parts)
+
+
+def unpack_strings(data: bytes, count: int) -> list:
+    return _unpack_strings_from(data, 0, count)[0]
+
+
+def _unpack_strings_from(data: bytes, offset: int, count: int):
+    values = []
+    try:
+        for i in range(count):
+            length, = _STRING_LENGTH.unpack_from(data, offset)
+            offset += _STRING_LENGTH.size
+            if offset + length > len(data): raise ProtocolError('String runs past the end of the message')
+            values.append(bytes.decode(data[offset:offset + length]))
+            offset += length
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ProtocolError('Bad string in message: %s' % e)
+    return values, offset
+
+
+def pack_reply(body: bytes) -> bytes:
+    return REPLY_OK + body
+
+
+def pack_error(message: str) -> bytes:
+    return REPLY_ERROR + str.encode(message)
+
+
+def unpack_reply(data: bytes) -> bytes:
+    """ Returns the body of a binary reply, raising ProtocolError if it reports an error. """
+    if data[:1] == REPLY_OK: return data[1:]
+    if data[:1] == REPLY_ERROR: raise ProtocolError(bytes.decode(data[1:], errors='replace'))
+    raise ProtocolError('Unrecognised reply')
+
+
+def choose_format(offered) -> bytes:
+    """ Picks the format to use from those a client offered. JSON is used if nothing else matches. """
+    offered = [str.encode(name) if type(name) is str else name for name in offered or []]
+    for name in SUPPORTED_FORMATS:
+        if name in offered: return name
+    return FORMAT_JSON
@@ -0,0 +1,165 @@
+import csv
+import gzip
+import json
+import logging
+import os
+import time
+from common.db import GarageDb
+from common.analytics import door_state_from_event, parse_timestamp, split_by_day
+from common.doors import DEFAULT_DOOR_ID
+
+OPEN_SINCE_KEY = 'retention_open_since'
+
+
+class RetentionEngine(object):
+    """
+    Moves history older than a given age out of the entries table and into
+    daily rollups, optionally archiving the raw rows to gzipped CSV files first.
+
+    Rows are processed in small batches, each in its own short transaction,
+    so the controller can keep recording events while this runs.
+    """
+
+    def __init__(self, db: GarageDb, logger: logging.Logger, max_age_days: int, archive_path: str=None,
+                 batch_size: int=500, pause: float=0.1, on_removed=None):
+        """
+        :param db: Database to trim
+        :param logger: Logger for logging purposes
+        :param max_age_days: Rows older than this many days are rolled up and removed
+        :param archive_path: Folder to write raw rows to before removing them. Not archived if None.
+        :param batch_size: Rows handled in each transaction
+        :param pause: Seconds to wait between batches so other writers can get in
+        :param on_removed: Callable invoked after each batch with the ids removed and the lowest id left in history
+                           (None if it's empty), so copies of history elsewhere can drop the same rows
+        """
+        assert logger is not None
+        self.__db = db
+        self.__logger = logger
+        self.__max_age_days = max_age_days
+        self.__archive_path = archive_path
+        self.__batch_size = batch_size
+        self.__pause = pause
+        self.__on_removed = on_removed
+        self.__incremental_vacuum = False
+
+    def run(self) -> int:
+        """
+        Rolls up and removes everything that's too old.
+
+        :return: Number of rows removed
+        """
+        self.__logger.info('Starting history retention for rows older than %d days', self.__max_age_days)
+        self.__incremental_vacuum = self.__db.incremental_vacuum_enabled()
+        if not self.__incremental_vacuum:
+            self.__logger.info('Space freed by retention is reused but the history file won\'t shrink. '
+                               'Set HISTORY_VACUUM to switch it over to incremental vacuum at the next start.')
+
+        total = 0
+        while True:
+            count = self.run_batch()
+            if not count: break
+            total += count
+            time.sleep(self.__pause)
+
+        self.__logger.info('History retention finished. Removed %d rows.', total)
+        return total
+
+    def run_batch(self) -> int:
+        conn = self.__db.get_connection()
+        rows = conn.execute('select ID, Timestamp, datetime(Timestamp, \'localtime\') as LocalTimestamp, '
+                            'UserAgent, Login, Event, Description, Door from entries '
+                            'where Timestamp < datetime(\'now\', ?) order by Timestamp, ID limit ?',
+                            ['-%d days' % self.__max_age_days, self.__batch_size]).fetchall()
+        if not rows: return 0
+
+        # Archive first so rows are never lost. If we stop before the delete below, the
+        # next run archives them again, so archives can hold duplicates but never gaps.
+        if self.__archive_path:
+            self.__archive(rows)
+
+        event_counts, door_totals, open_since = self.__summarize(rows, self.__load_open_since())
+
+        with conn:
+            for (day, event), count in event_counts.items():
+                conn.execute('insert or ignore into daily_rollups (Day, Event) values (?, ?)', [day, event])
+                conn.execute('update daily_rollups set Count = Count + ? where Day = ? and Event = ?',
+                             [count, day, event])
+            for day, (opens, closes, open_seconds) in door_totals.items():
+                conn.execute('insert or ignore into daily_door_rollups (Day) values (?)', [day])
+                conn.execute('update daily_door_rollups set Opens = Opens + ?, Closes = Closes + ?, '
+                             'OpenSeconds = OpenSeconds + ? where Day = ?',
+                             [opens, closes, open_seconds, day])
+            conn.execute('insert or replace into meta (Key, Value) values (?, ?)',
+                         [OPEN_SINCE_KEY, json.dumps(open_since)])
+            conn.executemany('delete from entries where ID = ?', [[row['ID']] for row in rows])
+            first_id = conn.execute('select min(ID) from entries').fetchone()[0]
+        # Rows are picked by age, and a clock set back can give a newer id an older timestamp,
+        # so pass on exactly which ids went rather than the highest one
+        if self.__on_removed is not None:
+            self.__on_removed([row['ID'] for row in rows], first_id)
+
+        # Give back a few pages at a time rather than vacuuming the whole file
+        if self.__incremental_vacuum:
+            conn.execute('pragma incremental_vacuum(%d)' % self.__batch_size)
+        return len(rows)
+
+    def __load_open_since(self) -> dict:
+        value = self.__db.get_meta(OPEN_SINCE_KEY)
+        if not value: return {}
+        # Before doors had ids this was a single timestamp for the only door
+        if not value.startswith('{'): return {DEFAULT_DOOR_ID: value}
+        return json.loads(value)
+
+    @staticmethod
+    def __summarize(rows, open_since: dict):
+        """
+        Totals up a batch of rows, oldest first.
+
+        :param open_since: Timestamps each door open at the end of earlier batches was seen opening, by door id
+        :return: Tuple of event counts by (day, event), door totals by day, and the open_since to carry forward
+        """
+        open_since = dict(open_since)
+        event_counts = {}
+        door_totals = {}
+
+        def add_door_totals(day, opens=0, closes=0, open_seconds=0):
+            totals = door_totals.get(day, (0, 0, 0))
+            door_totals[day] = (totals[0] + opens, totals[1] + closes, totals[2] + open_seconds)
+
+        for row in rows:
+            day = row['LocalTimestamp'][:10]
+            event_counts[(day, row['Event'])] = event_counts.get((day, row['Event']), 0) + 1
+            add_door_totals(day)
+
+            is_open = door_state_from_event(row['Event'], row['Description'])
+            if is_open is None: continue
+            if row['Event'] == 'SensorTrip':
+                add_door_totals(day, opens=int(is_open), closes=int(not is_open))
+            door = row['Door']
+            if is_open and door not in open_since:
+                open_since[door] = row['Timestamp']
+            elif not is_open and door in open_since:
+                for open_day, seconds in split_by_day(parse_timestamp(open_since.pop(door)),
+                                                      parse_timestamp(row['Timestamp'])):
+                    add_door_totals(open_day, open_seconds=seconds)
+
+        return event_counts, door_totals, open_since
+
+    def __archive(self, rows):
+        """ Appends rows to a gzipped CSV file for each local month. """
+        os.makedirs(self.__archive_path, exist_ok=True)
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row['LocalTimestamp'][:7], []).append(row)
+
+        for month, month_rows in by_month.items():
+            file_name = os.path.join(self.__archive_path, 'history-%s.csv.gz' % month)
+            is_new = not os.path.exists(file_name)
+            # Each append adds another gzip member, which gzip readers handle transparently
+            with gzip.open(file_name, 'at', newline='') as f:
+                wr = csv.writer(f, quoting=csv.QUOTE_ALL)
+                if is_new:
+                    wr.writerow(["ID", "Time", "UserAgent", "Login", "Event", "Description", "Door"])
+                for row in month_rows:
+                    wr.writerow([row['ID'], row['LocalTimestamp'], row['UserAgent'], row['Login'],
+                                 row['Event'], row['Description'], row['Door']])
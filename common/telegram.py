@@ -1,16 +1,18 @@
-import apprise
 import logging
+import threading
 
 class TelegramNotification:
     telegram_key = ''
     telegram_chat_id = ''
 
-    def __init__(self,telegram_key: str, telegram_chat_id: str, event_name: str, logger: logging.Logger):
+    def __init__(self,telegram_key: str, telegram_chat_id: str, event_name: str, logger: logging.Logger,
+                 timeout: float=10):
         """
         :param telegram_key: The telegram bot key
         :param telegram_chat_id: The telegram chat ID to send the message to
         :param event_name: The name of the event to trigger
         :param logger: Logger for logging purposes
+        :param timeout: Seconds to wait when connecting to and reading from Telegram
         """
         if logger is None:
             raise Exception("Logger is missing!")
@@ -28,9 +30,23 @@ class TelegramNotification:
         self.telegram_chat_id = telegram_chat_id
         self.event_name = event_name
         self.logger = logger
-    
-    def trigger(self):
+        self.timeout = timeout
+        self.__apobj = None
+        self.__lock = threading.Lock()
+
+    def trigger(self, detail: str=None):
+        """
+        :param detail: Added to the message, such as which door it's about
+        """
         self.logger.info('Triggering Telegram notification')
-        apobj = apprise.Apprise()
-        apobj.add("tgram://%s/%s" % (self.telegram_key,self.telegram_chat_id))
-        apobj.notify(body=self.event_name)
+        with self.__lock:
+            # Build the Apprise object once and reuse it along with its connections
+            if self.__apobj is None:
+                # Apprise is slow to import, so it's left until the first notification is sent
+                import apprise
+                self.__apobj = apprise.Apprise()
+                self.__apobj.add("tgram://%s/%s?cto=%s&rto=%s" % (self.telegram_key, self.telegram_chat_id,
+                                                                  self.timeout, self.timeout))
+            body = '%s: %s' % (self.event_name, detail) if detail else self.event_name
+            if not self.__apobj.notify(body=body):
+                raise Exception("Telegram notification failed")
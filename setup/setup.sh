@@ -98,11 +98,15 @@ if [ ! $? -eq 0 ] ; then
   sudo bash -c "cat >> /etc/lighttpd/lighttpd.conf << EOF
 
 # BEGIN GaragePi SERVER
+# Pass responses through as they're generated so the status stream isn't buffered
+server.stream-response-body = 2
+
 fastcgi.server = (\"/\" =>
     ((
         \"socket\" => \"/tmp/garage-fcgi.sock\",
         \"bin-path\" => \"${DIR}/start_webserver.fcgi\",
         \"check-local\" => \"disable\",
+        # One webserver process is enough. It answers requests on several threads (WEB_THREADS).
         \"max-procs\" => 1,
         \"fix-root-scriptname\" => \"enable\",
     ))
@@ -114,6 +118,12 @@ alias.url += (
 #END OF GaragePi SERVER
 EOF"
 
+elif ! grep -q 'server.stream-response-body' /etc/lighttpd/lighttpd.conf ; then
+
+  # Installs from before the status stream buffer its responses, so add the setting to their server config
+  echo -e "\nLetting lighttpd stream responses..."
+  sudo sed -i "/# BEGIN GaragePi SERVER/a # Pass responses through as they're generated so the status stream isn't buffered\nserver.stream-response-body = 2\n" /etc/lighttpd/lighttpd.conf
+
 fi
 
 # Start the garagepi service
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+import unittest
+from common.db import GarageDb, HistoryEvent
+
+RESOURCE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource')
+
+
+class QueryHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.instance_path = tempfile.mkdtemp()
+        self.db = GarageDb(self.instance_path, RESOURCE_PATH)
+        self.db.record_events([HistoryEvent('test', None, 'SensorTrip', str(i), timestamp='2020-01-01 12:00:%02d' % i)
+                               for i in range(5)])
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.instance_path)
+
+    def test_pages(self):
+        entries, next_cursor = self.db.query_history(None, 3)
+        self.assertEqual([entry['id'] for entry in entries], [5, 4, 3])
+        self.assertEqual(next_cursor, '2020-01-01 12:00:02|3')
+
+        entries, next_cursor = self.db.query_history(next_cursor, 3)
+        self.assertEqual([entry['id'] for entry in entries], [2, 1])
+        self.assertIsNone(next_cursor)
+
+    def test_zero_limit(self):
+        self.assertEqual(self.db.query_history(None, 0), ([], None))
+
+    def test_malformed_cursor(self):
+        for cursor in ('abc', '|3', '2020-01-01 12:00:00|x'):
+            with self.assertRaises(ValueError):
+                self.db.query_history(cursor, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+import unittest
+from unittest import mock
+from common import event_writer
+from common.db import HistoryEvent
+from common.event_writer import EventWriter
+
+
+class FakeDb(object):
+    """ Keeps each batch it's asked to write. Writes can be held up until released, or made to fail. """
+
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+        self.fail = False
+        self.release = threading.Event()
+        self.release.set()
+        self.writing = threading.Event()
+
+    def record_events(self, events):
+        self.writing.set()
+        self.release.wait(5)
+        if self.fail: raise IOError('disk went away')
+        self.batches.append([event.description for event in events])
+
+    def close(self):
+        self.closed = True
+
+
+def make_event(description: str) -> HistoryEvent:
+    return HistoryEvent('test', None, 'SensorTrip', description)
+
+
+class EventWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('EventWriterTest')
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+        self.db = FakeDb()
+        self.commits = 0
+
+    def on_commit(self):
+        self.commits += 1
+
+    def start(self, **kwargs) -> EventWriter:
+        writer = EventWriter(self.logger, **kwargs)
+        writer.start(self.db, self.on_commit)
+        self.addCleanup(writer.stop)
+        return writer
+
+    def test_events_close_together_share_a_commit(self):
+        writer = self.start(max_delay=0.5)
+        for i in range(5): writer.record(make_event(str(i)))
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(self.db.batches, [['0', '1', '2', '3', '4']])
+        self.assertEqual((writer.committed_count, writer.batch_count, writer.max_batch), (5, 1, 5))
+        self.assertEqual(self.commits, 1)
+
+    def test_events_after_deadline_get_their_own_commit(self):
+        writer = self.start(max_delay=0.01)
+        writer.record(make_event('a'))
+        time.sleep(0.2)
+        writer.record(make_event('b'))
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(self.db.batches, [['a'], ['b']])
+        self.assertEqual(writer.batch_count, 2)
+
+    def test_batches_are_capped(self):
+        writer = self.start(max_delay=0.5)
+        # Hold up the first write so the rest pile up in the queue
+        self.db.release.clear()
+        writer.record(make_event('first'))
+        self.assertTrue(self.db.writing.wait(5))
+        count = event_writer.MAX_BATCH + 10
+        for i in range(count): writer.record(make_event(str(i)))
+        self.db.release.set()
+        self.assertTrue(writer.flush(5))
+
+        self.assertEqual([len(batch) for batch in self.db.batches], [1, event_writer.MAX_BATCH, 10])
+        self.assertEqual(sum(self.db.batches, []), ['first'] + [str(i) for i in range(count)])
+        self.assertEqual(writer.max_batch, event_writer.MAX_BATCH)
+
+    def test_flush_does_not_wait_for_deadline(self):
+        writer = self.start(max_delay=5)
+        writer.record(make_event('a'))
+        started = time.monotonic()
+        self.assertTrue(writer.flush(5))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.db.batches, [['a']])
+
+    def test_flush_waits_for_earlier_events(self):
+        writer = self.start(max_delay=0.5)
+        self.db.release.clear()
+        writer.record(make_event('a'))
+        self.assertTrue(self.db.writing.wait(5))
+        writer.record(make_event('b'))
+        self.assertFalse(writer.flush(0.1))
+        self.db.release.set()
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(self.db.batches, [['a'], ['b']])
+
+    def test_flush_with_nothing_queued(self):
+        writer = self.start()
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(self.db.batches, [])
+
+    def test_stop_writes_queued_events(self):
+        writer = self.start(max_delay=5)
+        for i in range(3): writer.record(make_event(str(i)))
+        writer.stop()
+        self.assertEqual(self.db.batches, [['0', '1', '2']])
+        self.assertTrue(self.db.closed)
+
+    def test_record_after_stop_writes_directly(self):
+        writer = self.start()
+        writer.stop()
+        writer.record(make_event('late'))
+        self.assertEqual(self.db.batches, [['late']])
+        self.assertTrue(writer.flush(5))
+
+    def test_failed_writes_are_counted(self):
+        writer = self.start()
+        self.db.fail = True
+        with mock.patch.object(event_writer, 'RETRY_DELAY', 0):
+            writer.record(make_event('a'))
+            writer.record(make_event('b'))
+            self.assertTrue(writer.flush(5))
+        self.assertEqual(writer.failed_count, 2)
+        self.assertEqual(writer.committed_count, 0)
+        self.assertEqual(self.commits, 0)
+
+    def test_full_queue_waits_for_room(self):
+        writer = self.start(max_delay=0, queue_size=2)
+        self.db.release.clear()
+        writer.record(make_event('a'))
+        self.assertTrue(self.db.writing.wait(5))
+        threading.Timer(0.2, self.db.release.set).start()
+        for i in range(4): writer.record(make_event(str(i)))
+        self.assertTrue(writer.flush(5))
+        self.assertGreater(writer.blocked_count, 0)
+        self.assertEqual(sum(self.db.batches, []), ['a', '0', '1', '2', '3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
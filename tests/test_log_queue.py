@@ -0,0 +1,55 @@
+import logging
+import unittest
+from common.log_queue import start_queue_logging
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record: logging.LogRecord):
+        self.messages.append(record.getMessage())
+
+
+class StartQueueLoggingTest(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('StartQueueLoggingTest.%s' % self._testMethodName)
+        self.logger.propagate = False
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+
+    def log_all(self, level, ring_size: int=0) -> list:
+        queue_logging = start_queue_logging(self.logger, level, ring_size)
+        self.logger.debug('debug')
+        self.logger.info('info')
+        self.logger.warning('warning')
+        queue_logging.stop()
+        return self.handler.messages
+
+    def test_level_name_in_any_case(self):
+        self.assertEqual(self.log_all('info'), ['info', 'warning'])
+
+    def test_level_number(self):
+        self.assertEqual(self.log_all(logging.WARNING), ['warning'])
+
+    def test_ring_level_name(self):
+        self.assertEqual(self.log_all(' Warning ', ring_size=10), ['warning'])
+
+    def test_ring_writes_records_below_level_on_error(self):
+        queue_logging = start_queue_logging(self.logger, 'warning', 10)
+        self.logger.debug('debug')
+        self.logger.error('error')
+        queue_logging.stop()
+        self.assertEqual(self.handler.messages, ['debug', 'error'])
+
+    def test_unknown_level(self):
+        for level in ('infoo', '', None, True):
+            with self.assertRaises(ValueError):
+                start_queue_logging(self.logger, level)
+        # The logger's handlers are left alone
+        self.assertEqual(self.logger.handlers, [self.handler])
+
+
+if __name__ == '__main__':
+    unittest.main()
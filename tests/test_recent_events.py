@@ -0,0 +1,271 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from backend.recent_events import RecentEvents
+from common.db import GarageDb, HistoryEvent
+from common.retention import RetentionEngine
+
+RESOURCE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resource')
+
+
+def make_event(description='') -> HistoryEvent:
+    return HistoryEvent('test', None, 'SensorTrip', description, timestamp='2020-01-01 12:00:00')
+
+
+def make_row(id: int) -> dict:
+    return dict(id=id, timestamp='2020-01-01 12:00:00', local_timestamp='2020-01-01 12:00:00', event='SensorTrip',
+                login=None, description=str(id), door='main')
+
+
+def ids(entries) -> list:
+    return [entry['id'] for entry in entries]
+
+
+class RecentEventsTest(unittest.TestCase):
+    def test_empty(self):
+        recent = RecentEvents(size=5)
+        self.assertEqual(recent.since(), ([], True))
+        self.assertEqual(recent.since(after=3), ([], True))
+        self.assertEqual(recent.stats()['kept'], 0)
+
+    def test_append_assigns_ids(self):
+        recent = RecentEvents(size=5)
+        events = [make_event() for _ in range(3)]
+        self.assertEqual([recent.append(event) for event in events], [1, 2, 3])
+        self.assertEqual([event.id for event in events], [1, 2, 3])
+        self.assertEqual(recent.last_id, 3)
+
+    def test_append_carries_on_from_load(self):
+        recent = RecentEvents(size=5)
+        recent.load([make_row(id) for id in (9, 8)], 1, 9)
+        self.assertEqual(recent.append(make_event()), 10)
+
+    def test_append_after_history_emptied(self):
+        # Everything was removed but ids up to 40 were used, so new ones mustn't start again at 1
+        recent = RecentEvents(size=5)
+        recent.load([], None, 40)
+        self.assertEqual(recent.since(), ([], True))
+        self.assertEqual(recent.append(make_event()), 41)
+        self.assertEqual(ids(recent.since()[0]), [41])
+
+    def test_all_kept(self):
+        recent = RecentEvents(size=10)
+        for _ in range(4): recent.append(make_event())
+        entries, complete = recent.since()
+        self.assertEqual(ids(entries), [4, 3, 2, 1])
+        self.assertTrue(complete)
+
+    def test_limit(self):
+        recent = RecentEvents(size=10)
+        for _ in range(8): recent.append(make_event())
+        entries, complete = recent.since(limit=3)
+        self.assertEqual(ids(entries), [8, 7, 6])
+        self.assertTrue(complete)
+
+    def test_older_history_not_kept(self):
+        recent = RecentEvents(size=5)
+        recent.load([make_row(id) for id in range(20, 10, -1)], 1, 20)
+        self.assertEqual(recent.stats()['kept'], 5)
+
+        # The limit is met from what's kept
+        entries, complete = recent.since(limit=5)
+        self.assertEqual(ids(entries), [20, 19, 18, 17, 16])
+        self.assertTrue(complete)
+
+        # The database has older events that would be needed to reach the limit
+        entries, complete = recent.since(limit=8)
+        self.assertEqual(ids(entries), [20, 19, 18, 17, 16])
+        self.assertFalse(complete)
+
+    def test_after(self):
+        recent = RecentEvents(size=5)
+        recent.load([make_row(id) for id in range(20, 10, -1)], 1, 20)
+
+        entries, complete = recent.since(after=17)
+        self.assertEqual(ids(entries), [20, 19, 18])
+        self.assertTrue(complete)
+
+        # Everything after 15 is kept, even though 15 itself isn't
+        entries, complete = recent.since(after=15)
+        self.assertEqual(ids(entries), [20, 19, 18, 17, 16])
+        self.assertTrue(complete)
+
+        entries, complete = recent.since(after=14)
+        self.assertEqual(ids(entries), [20, 19, 18, 17, 16])
+        self.assertFalse(complete)
+
+        self.assertEqual(recent.since(after=20), ([], True))
+
+    def test_after_with_limit(self):
+        recent = RecentEvents(size=5)
+        recent.load([make_row(id) for id in range(20, 10, -1)], 1, 20)
+
+        entries, complete = recent.since(after=10, limit=2)
+        self.assertEqual(ids(entries), [20, 19])
+        self.assertTrue(complete)
+
+        entries, complete = recent.since(after=17, limit=2)
+        self.assertEqual(ids(entries), [20, 19])
+        self.assertTrue(complete)
+
+    def test_gaps(self):
+        # 18 and 15 were never written, so the database returns older rows in their place
+        recent = RecentEvents(size=10)
+        recent.load([make_row(id) for id in (20, 19, 17, 16, 14, 13)], 1, 20)
+
+        entries, complete = recent.since(limit=4)
+        self.assertEqual(ids(entries), [20, 19, 17, 16])
+        self.assertTrue(complete)
+
+        # 10 and below aren't kept, so filling the limit would need the database
+        entries, complete = recent.since(limit=8)
+        self.assertEqual(ids(entries), [20, 19, 17, 16, 14, 13])
+        self.assertFalse(complete)
+
+        entries, complete = recent.since(after=15, limit=4)
+        self.assertEqual(ids(entries), [20, 19, 17, 16])
+        self.assertTrue(complete)
+
+    def test_gaps_all_kept(self):
+        recent = RecentEvents(size=10)
+        recent.load([make_row(id) for id in (6, 4, 1)], 1, 6)
+        entries, complete = recent.since(limit=5)
+        self.assertEqual(ids(entries), [6, 4, 1])
+        self.assertTrue(complete)
+
+    def test_forget(self):
+        recent = RecentEvents(size=10)
+        for _ in range(6): recent.append(make_event())
+        recent.forget([1, 2, 3], 4)
+
+        entries, complete = recent.since()
+        self.assertEqual(ids(entries), [6, 5, 4])
+        self.assertTrue(complete)
+        self.assertEqual(recent.stats()['kept'], 3)
+
+        # Forgetting what's already gone changes nothing
+        recent.forget([2], 4)
+        self.assertEqual(ids(recent.since()[0]), [6, 5, 4])
+
+        recent.forget([4, 5, 6], None)
+        self.assertEqual(recent.since(), ([], True))
+        self.assertEqual(recent.append(make_event()), 7)
+        self.assertEqual(ids(recent.since()[0]), [7])
+
+    def test_forget_newer_than_kept_rows(self):
+        # A clock set back gave 5 an older timestamp than 3 and 4, so it was removed before them
+        recent = RecentEvents(size=10)
+        for _ in range(6): recent.append(make_event())
+        recent.forget([1, 2, 5], 3)
+
+        entries, complete = recent.since()
+        self.assertEqual(ids(entries), [6, 4, 3])
+        self.assertTrue(complete)
+
+    def test_forget_keeps_events_not_written_yet(self):
+        recent = RecentEvents(size=10)
+        for _ in range(4): recent.append(make_event())
+        # 4 was still queued when retention emptied the database
+        recent.forget([1, 2, 3], None)
+
+        entries, complete = recent.since()
+        self.assertEqual(ids(entries), [4])
+        self.assertTrue(complete)
+
+    def test_forget_beyond_kept(self):
+        recent = RecentEvents(size=5)
+        recent.load([make_row(id) for id in range(20, 10, -1)], 1, 20)
+        recent.forget(range(1, 18), 18)
+
+        entries, complete = recent.since(limit=10)
+        self.assertEqual(ids(entries), [20, 19, 18])
+        self.assertTrue(complete)
+
+    def test_forget_below_kept(self):
+        # Removing rows older than what's kept leaves the older ones still needing the database
+        recent = RecentEvents(size=5)
+        recent.load([make_row(id) for id in range(20, 10, -1)], 1, 20)
+        recent.forget(range(1, 6), 6)
+
+        entries, complete = recent.since(limit=10)
+        self.assertEqual(ids(entries), [20, 19, 18, 17, 16])
+        self.assertFalse(complete)
+
+    def test_wraps_around(self):
+        recent = RecentEvents(size=3)
+        for _ in range(7): recent.append(make_event())
+        entries, complete = recent.since(limit=3)
+        self.assertEqual(ids(entries), [7, 6, 5])
+        self.assertTrue(complete)
+        self.assertFalse(recent.since(limit=4)[1])
+
+    def test_hit_and_miss_counts(self):
+        recent = RecentEvents(size=3)
+        for _ in range(5): recent.append(make_event())
+        recent.since(limit=2)
+        recent.since(limit=5)
+        self.assertEqual((recent.hit_count, recent.miss_count), (1, 1))
+
+
+class RecentEventsDbTest(unittest.TestCase):
+    def setUp(self):
+        self.instance_path = tempfile.mkdtemp()
+        self.db = GarageDb(self.instance_path, RESOURCE_PATH)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.instance_path)
+
+    def record(self, recent: RecentEvents, count: int):
+        events = [make_event(str(i)) for i in range(count)]
+        for event in events: recent.append(event)
+        self.db.record_events(events)
+
+    def test_load_matches_database(self):
+        recent = RecentEvents(size=5)
+        recent.load(*self.db.read_recent_events(5))
+        self.record(recent, 8)
+
+        reloaded = RecentEvents(size=5)
+        reloaded.load(*self.db.read_recent_events(5))
+        self.assertEqual(reloaded.since(limit=5), recent.since(limit=5))
+        self.assertEqual(reloaded.last_id, 8)
+
+    def test_retention_with_clock_set_back(self):
+        recent = RecentEvents(size=10)
+        recent.load(*self.db.read_recent_events(10))
+        events = [HistoryEvent('test', None, 'SensorTrip', str(i), timestamp=timestamp)
+                  for i, timestamp in enumerate(['2000-01-01 00:00:00', '2099-01-01 00:00:00',
+                                                 '2099-01-01 00:00:01', '2000-01-02 00:00:00'])]
+        for event in events: recent.append(event)
+        self.db.record_events(events)
+
+        retention = RetentionEngine(self.db, logging.getLogger('RecentEventsDbTest'), 30, pause=0,
+                                    on_removed=recent.forget)
+        self.assertEqual(retention.run(), 2)
+
+        entries, complete = recent.since()
+        self.assertTrue(complete)
+        self.assertEqual(ids(entries), [3, 2])
+        self.assertEqual([entry['id'] for entry in self.db.query_history(None, 10)[0]], [3, 2])
+
+    def test_ids_not_reused_after_history_emptied(self):
+        recent = RecentEvents(size=5)
+        recent.load(*self.db.read_recent_events(5))
+        self.record(recent, 4)
+        with self.db.get_connection() as conn:
+            conn.execute('delete from entries')
+
+        rows, first_id, last_id = self.db.read_recent_events(5)
+        self.assertEqual((list(rows), first_id, last_id), ([], None, 4))
+
+        reloaded = RecentEvents(size=5)
+        reloaded.load(rows, first_id, last_id)
+        self.record(reloaded, 1)
+        self.assertEqual(ids(reloaded.since()[0]), [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
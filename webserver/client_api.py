@@ -1,40 +1,70 @@
 import zmq
 import json
 import logging
+import threading
+import time
+from common import metrics, protocol
+from common.protocol import StatusRecord, ProtocolError
 from common.struct import Struct
 
 SEND_TIMEOUT = 2 * 1000  # in milliseconds
 RECV_TIMEOUT = 3 * 1000  # in milliseconds
 
+IPC_CLIENT_SECONDS = metrics.registry.histogram('garagepi_ipc_client_seconds',
+                                                'Round trip time of requests to the backend', ['operation'])
+IPC_CLIENT_TIMEOUTS = metrics.registry.counter('garagepi_ipc_client_timeouts',
+                                               'Requests to the backend that timed out', ['operation', 'stage'])
+IPC_SOCKET_RECREATIONS = metrics.registry.counter('garagepi_ipc_socket_recreations',
+                                                  'Times a client socket was closed and opened again')
+IPC_POOL_TIMEOUTS = metrics.registry.counter('garagepi_ipc_pool_timeouts',
+                                             'Requests that gave up waiting for a pooled client')
+
 class GaragePiClient(object):
     """
     Client that connects with GaragePi backend to perform tasks
     """
 
-    def __init__(self, logger: logging.Logger, connect_port='5550'):
+    def __init__(self, logger: logging.Logger, connect_port='5550', context: zmq.Context=None, binary=True,
+                 connect_host='localhost', timeout=SEND_TIMEOUT):
+        """
+        :param logger: Logger for logging purposes
+        :param connect_port: Port the backend is listening on
+        :param context: Context to create the socket in. A private one is created if not given.
+        :param binary: Whether to use the binary message format if the backend supports it
+        :param connect_host: Host the backend is running on
+        :param timeout: Milliseconds to wait for a reply before giving up
+        """
         assert logger is not None
         self.__logger = logger
+        self.__timeout = timeout
 
-        self.__connect_addr = "tcp://localhost:%s" % connect_port
+        self.__connect_addr = "tcp://%s:%s" % (connect_host, connect_port)
         self.__logger.debug("Connect address: " + self.__connect_addr)
 
-        self.__context = zmq.Context()
-        self.__context.setsockopt(zmq.RCVTIMEO, RECV_TIMEOUT)
+        self.__context = context if context is not None else zmq.Context()
         self.__poller = zmq.Poller()
         self.__socket = None    # type: zmq.sugar.Socket
+        self.reconnect_count = 0
         self.__create_socket()
 
+        # The format is agreed with the backend on first use
+        self.__format = None if binary else protocol.FORMAT_JSON
+
 
     def __create_socket(self):
         if self.__socket is not None:
             self.close()
+            self.reconnect_count += 1
+            IPC_SOCKET_RECREATIONS.inc()
 
         self.__logger.debug("Creating new socket")
         self.__socket = self.__context.socket(zmq.DEALER)
+        self.__socket.setsockopt(zmq.RCVTIMEO, max(RECV_TIMEOUT, self.__timeout))
         self.__socket.connect(self.__connect_addr)
         self.__poller.register(self.__socket, zmq.POLLIN)
 
     def close(self):
+        if self.__socket is None: return
         self.__logger.debug("Closing out existing socket")
         self.__socket.setsockopt(zmq.LINGER, 0)
         self.__socket.close()
@@ -42,47 +72,266 @@ class GaragePiClient(object):
         self.__socket = None
 
     def __send_recv_msg(self, msg):
+        # Make sure the return is converted to string if necessary
+        ret_msg = self.__send_recv_bytes(msg)
+        if ret_msg is None: return None
+        return bytes.decode(ret_msg) if type(ret_msg) is bytes else ret_msg
+
+    def __send_recv_bytes(self, msg):
         # Make sure we're sending bytes instead of strings
         msg = list(map(lambda s: str.encode(s) if type(s) is str else s, msg))
-        self.__socket.send_multipart(msg)
-
-        events = dict(self.__poller.poll(SEND_TIMEOUT))
-        if events.get(self.__socket) == zmq.POLLIN:
-            try:
-                # Receive response and make sure the return is converted to string if necessary
-                ret_msg = self.__socket.recv_multipart()[0]
-                return bytes.decode(ret_msg) if type(ret_msg) is bytes else ret_msg
-            except zmq.error.Again:
-                # If the receive timed out then return None
-                self.__logger.warning("Receive operation timed out!")
+        operation = bytes.decode(msg[0])
+        with IPC_CLIENT_SECONDS.time(operation):
+            self.__socket.send_multipart(msg)
+
+            events = dict(self.__poller.poll(self.__timeout))
+            if events.get(self.__socket) == zmq.POLLIN:
+                try:
+                    return self.__socket.recv_multipart()[0]
+                except zmq.error.Again:
+                    # If the receive timed out then return None
+                    self.__logger.warning("Receive operation timed out!")
+                    IPC_CLIENT_TIMEOUTS.labels(operation, 'receive').inc()
+                    self.__create_socket()
+                    return None
+            else:
+                self.__logger.warning("Send operation timed out!")
+                IPC_CLIENT_TIMEOUTS.labels(operation, 'send').inc()
                 self.__create_socket()
                 return None
-        else:
-            self.__logger.warning("Send operation timed out!")
-            self.__create_socket()
-            return None
 
 
+    def __use_binary(self) -> bool:
+        if self.__format is None:
+            # Backends from before formats were negotiated don't answer, so fall back to JSON
+            self.__logger.debug("Requesting 'negotiate'")
+            reply_json = self.__send_recv_msg(['negotiate', json.dumps(
+                {'formats': [bytes.decode(name) for name in protocol.SUPPORTED_FORMATS]})])
+            chosen = json.loads(reply_json).get('format') if reply_json else None
+            self.__format = str.encode(chosen) if chosen else protocol.FORMAT_JSON
+            self.__logger.info("Using '%s' message format" % bytes.decode(self.__format))
+        return self.__format in protocol.BINARY_VERSIONS
+
+    def __send_recv_binary(self, operation: str, contents: bytes):
+        reply = self.__send_recv_bytes([operation, contents, self.__format])
+        if reply is None: return None
+        try:
+            return protocol.unpack_reply(reply)
+        except ProtocolError as e:
+            self.__logger.warning("'%s' failed: %s" % (operation, e))
+            return None
+
     def echo(self, message):
-        self.__logger.debug("Requesting 'echo' with message: {0}".format(message))
+        self.__logger.debug("Requesting 'echo' with message: %s", message)
+        if self.__use_binary():
+            reply = self.__send_recv_binary('echo', protocol.pack_strings(message))
+            if reply is None: return None
+            return protocol.unpack_strings(reply, 1)[0]
         msg_json = json.dumps({'message': message})
         msg = ['echo', msg_json]
         reply_json = self.__send_recv_msg(msg)
         if reply_json is None: return None
         return json.loads(reply_json)['message']
 
-    def get_status(self):
+    def get_status(self) -> StatusRecord:
         self.__logger.debug("Requesting 'get_status'")
+        if self.__use_binary():
+            reply = self.__send_recv_binary('get_status', b'')
+            if reply is None: return None
+            return StatusRecord.unpack(reply, protocol.BINARY_VERSIONS[self.__format])
         msg = ['get_status', '{}']
         reply_json = self.__send_recv_msg(msg)
         if reply_json is None: return None
+        reply = json.loads(reply_json)
+        if 'error' in reply:
+            self.__logger.warning("'get_status' failed: %s" % reply['error'])
+            return None
+        return StatusRecord.from_dict(reply)
+
+    def get_stats(self):
+        self.__logger.debug("Requesting 'get_stats'")
+        msg = ['get_stats', '{}']
+        reply_json = self.__send_recv_msg(msg)
+        if reply_json is None: return None
         return json.loads(reply_json)
 
-    def trigger_relay(self, user_agent: str, login: str):
+    def get_metrics(self):
+        """ Gets the backend's metrics as collected by common.metrics. """
+        self.__logger.debug("Requesting 'get_metrics'")
+        msg = ['get_metrics', '{}']
+        reply_json = self.__send_recv_msg(msg)
+        if reply_json is None: return None
+        return json.loads(reply_json)
+
+    def get_history(self, before: str=None, limit: int=100, door: str=None):
+        """
+        Gets a page of the backend's history, newest first.
+
+        :param before: Cursor returned with the previous page, or None for the first page
+        :param limit: Most rows to return
+        :param door: Only include rows for this door id
+        :return: Dict of the rows as 'entries' and the cursor for the next page as 'next'
+        """
+        self.__logger.debug("Requesting 'get_history'")
+        msg = ['get_history', json.dumps(dict(before=before, limit=limit, door=door))]
+        reply_json = self.__send_recv_msg(msg)
+        if reply_json is None: return None
+        reply = json.loads(reply_json)
+        if 'error' in reply:
+            self.__logger.warning("'get_history' failed: %s" % reply['error'])
+            return None
+        return reply
+
+    def get_recent_events(self, after: int=None, limit: int=100):
+        """
+        Gets the newest history events from the backend's memory, newest first.
+
+        :param after: Only include events with ids above this one, such as the 'last' from an earlier reply
+        :param limit: Most events to return
+        :return: Dict of the events as 'entries', the newest id as 'last', and 'complete', which is False
+                 if older events were asked for than the backend keeps, so the database has to be read instead
+        """
+        self.__logger.debug("Requesting 'get_recent_events'")
+        return self.__send_recv_json(['get_recent_events', json.dumps(dict(after=after, limit=limit))])
+
+    def trigger_relay(self, user_agent: str, login: str, door: str=None):
+        """
+        :param door: Id of the door to move. The backend's default door if not given.
+        """
         self.__logger.debug("Requesting 'trigger_relay'")
-        data = Struct(user_agent=user_agent, login=login)
+        if self.__use_binary():
+            if protocol.BINARY_VERSIONS[self.__format] < 2:
+                if door: raise ProtocolError('Backend is too old to pick a door')
+                contents = protocol.pack_strings(user_agent, login)
+            else:
+                contents = protocol.pack_strings(user_agent, login, door)
+            reply = self.__send_recv_binary('trigger_relay', contents)
+            if reply is None: return None
+            return {}
+        data = Struct(user_agent=user_agent, login=login, door=door)
         msg_json = data.to_json_bytes()
         msg = ['trigger_relay', msg_json]
         reply_json = self.__send_recv_msg(msg)
         if reply_json is None: return None
         return json.loads(reply_json)
+
+    def run_relay_program(self, user_agent: str, login: str, steps, door: str=None):
+        """
+        Starts a relay program on the backend, which runs it on its own timers.
+
+        :param steps: Each step is protocol.RELAY_PULSE or a number of seconds to wait
+        :param door: Id of the door to move. The backend's default door if not given.
+        :return: The job as a dict, with 'merged' True if it was a duplicate of one just started
+        """
+        self.__logger.debug("Requesting 'run_relay_program'")
+        msg = ['run_relay_program', json.dumps(dict(user_agent=user_agent, login=login, steps=steps, door=door))]
+        return self.__send_recv_json(msg)
+
+    def get_job(self, job_id: int):
+        """ Gets a relay job started with run_relay_program as a dict. """
+        self.__logger.debug("Requesting 'get_job'")
+        return self.__send_recv_json(['get_job', json.dumps(dict(id=job_id))])
+
+    def __send_recv_json(self, msg):
+        operation = msg[0]
+        reply_json = self.__send_recv_msg(msg)
+        if reply_json is None: return None
+        reply = json.loads(reply_json)
+        if 'error' in reply:
+            self.__logger.warning("'%s' failed: %s" % (operation, reply['error']))
+            return None
+        return reply
+
+
+class ClientPoolTimeout(Exception):
+    """ Raised when no pooled client becomes available in time. """
+    pass
+
+
+class GaragePiClientPool(object):
+    """
+    Process-wide pool of connected clients that share a single ZMQ context.
+
+    Sockets aren't thread safe so each client is checked out by one request
+    at a time and returned when the request is done.
+    """
+
+    def __init__(self, logger: logging.Logger, connect_port='5550', max_size=4, wait_timeout=SEND_TIMEOUT / 1000,
+                 connect_host='localhost', timeout=SEND_TIMEOUT):
+        """
+        :param logger: Logger for logging purposes
+        :param connect_port: Port the backend is listening on
+        :param max_size: Most clients (and therefore sockets) the pool will create
+        :param wait_timeout: Seconds to wait for a client when all of them are checked out
+        :param connect_host: Host the backend is running on
+        :param timeout: Milliseconds each client waits for a reply
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__connect_port = connect_port
+        self.__connect_host = connect_host
+        self.__timeout = timeout
+        self.__max_size = max_size
+        self.__wait_timeout = wait_timeout
+
+        self.__context = zmq.Context()
+        self.__condition = threading.Condition()
+        self.__clients = []     # type: list[GaragePiClient]
+        self.__idle = []        # type: list[GaragePiClient]
+
+        self.checkout_count = 0
+        self.wait_count = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeout_count = 0
+
+    def checkout(self) -> GaragePiClient:
+        """ Takes a client out of the pool, creating one if the pool isn't full yet. """
+        with self.__condition:
+            self.checkout_count += 1
+            if not self.__idle and len(self.__clients) < self.__max_size:
+                client = GaragePiClient(self.__logger, self.__connect_port, self.__context,
+                                        connect_host=self.__connect_host, timeout=self.__timeout)
+                self.__clients.append(client)
+                return client
+
+            if not self.__idle:
+                self.wait_count += 1
+                start = time.monotonic()
+                available = self.__condition.wait_for(lambda: self.__idle, self.__wait_timeout)
+                waited = time.monotonic() - start
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+                if not available:
+                    self.timeout_count += 1
+                    IPC_POOL_TIMEOUTS.inc()
+                    raise ClientPoolTimeout("No client available after %.1f seconds" % waited)
+
+            # Most recently used client is the most likely to have a warm connection
+            return self.__idle.pop()
+
+    def checkin(self, client: GaragePiClient):
+        """ Returns a client to the pool so another request can use it. """
+        with self.__condition:
+            self.__idle.append(client)
+            self.__condition.notify()
+
+    def stats(self) -> dict:
+        with self.__condition:
+            return dict(size=len(self.__clients),
+                        idle=len(self.__idle),
+                        max_size=self.__max_size,
+                        checkout_count=self.checkout_count,
+                        wait_count=self.wait_count,
+                        wait_time=self.wait_time,
+                        max_wait_time=self.max_wait_time,
+                        timeout_count=self.timeout_count,
+                        reconnect_count=sum(c.reconnect_count for c in self.__clients))
+
+    def close(self):
+        with self.__condition:
+            for client in self.__clients:
+                client.close()
+            self.__clients = []
+            self.__idle = []
+        self.__context.term()
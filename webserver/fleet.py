@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from common import metrics
+from common.db import GarageDb
+from webserver.client_api import GaragePiClientPool
+
+FLEET_NODE_SECONDS = metrics.registry.histogram('garagepi_fleet_node_seconds',
+                                                'Time taken by each backend in the fleet to answer', ['node', 'operation'])
+FLEET_NODE_FAILURES = metrics.registry.counter('garagepi_fleet_node_failures',
+                                               'Fleet requests that a backend failed or was too slow to answer',
+                                               ['node', 'operation'])
+
+
+class FleetNode(object):
+    """ One backend in the fleet along with the last status it reported. """
+
+    def __init__(self, logger: logging.Logger, name: str, host: str, port, pool_size: int, timeout: float):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.pool = GaragePiClientPool(logger, port, pool_size, timeout, connect_host=host, timeout=int(timeout * 1000))
+
+        self.lock = threading.Lock()
+        self.status = None          # type: dict
+        self.status_time = None     # time.time() the status was received
+        self.status_future = None   # request for the status that's still waiting on the backend
+        self.error = None
+
+    def call(self, operation: str, *args):
+        """ Makes a request with a pooled client. Returns None if the backend didn't answer. """
+        start = time.perf_counter()
+        client = self.pool.checkout()
+        try:
+            return getattr(client, operation)(*args)
+        finally:
+            self.pool.checkin(client)
+            FLEET_NODE_SECONDS.labels(self.name, operation).observe(time.perf_counter() - start)
+
+
+class Fleet(object):
+    """
+    Talks to several backends at once for a dashboard covering more than one site.
+
+    Requests go to every backend concurrently and are waited on for at most
+    the per-node timeout, so a page takes as long as the slowest backend that
+    answers rather than the sum of them all. A backend that doesn't answer in
+    time is shown with the last status it gave, and isn't waited on again
+    until it answers.
+    """
+
+    def __init__(self, logger: logging.Logger, backends, pool_size: int=2, timeout: float=1.0, status_ttl: float=1.0):
+        """
+        :param logger: Logger for logging purposes
+        :param backends: List of dicts with each backend's name, host and port
+        :param pool_size: Most connections to keep open to each backend
+        :param timeout: Seconds to wait for each backend
+        :param status_ttl: Seconds a backend's status is reused for before asking it again
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__timeout = timeout
+        self.__status_ttl = status_ttl
+        self.nodes = []     # type: list[FleetNode]
+        for backend in backends:
+            name = backend.get('name') or '%s:%s' % (backend.get('host', 'localhost'), backend['port'])
+            if any(node.name == name for node in self.nodes):
+                raise ValueError("Backend name '%s' is used more than once" % name)
+            self.nodes.append(FleetNode(logger, name, backend.get('host', 'localhost'), backend['port'],
+                                        pool_size, timeout))
+        # Enough threads for a history and a status request to every node at the same time
+        self.__executor = ThreadPoolExecutor(max(2 * len(self.nodes), 1), thread_name_prefix='Fleet')
+
+    def statuses(self) -> list:
+        """
+        Gets every backend's status. Each entry has the node's name, its status
+        (None if it has never answered), when that status was received, and
+        whether it's stale because the backend didn't answer this time.
+        """
+        now = time.time()
+        futures = {}
+        waiting = []
+        for node in self.nodes:
+            with node.lock:
+                if node.status_time is not None and now - node.status_time < self.__status_ttl:
+                    continue
+                # Share a request that's still in flight rather than piling more onto a slow backend
+                if node.status_future is None:
+                    node.status_future = self.__executor.submit(self.__refresh_status, node)
+                futures[node.name] = node.status_future
+                if node.error is None: waiting.append(node.status_future)
+        if waiting:
+            wait(waiting, self.__timeout)
+
+        result = []
+        for node in self.nodes:
+            with node.lock:
+                future = futures.get(node.name)
+                stale = future is not None and not (future.done() and node.error is None)
+                result.append(dict(name=node.name, status=node.status, updated=node.status_time,
+                                   stale=stale, error=node.error if stale else None))
+        return result
+
+    def __refresh_status(self, node: FleetNode):
+        try:
+            status = node.call('get_status')
+            error = None if status is not None else 'No answer'
+        except Exception as e:
+            self.__logger.warning("Unable to get status from '%s': %s", node.name, e)
+            status, error = None, str(e)
+        with node.lock:
+            node.status_future = None
+            node.error = error
+            if status is not None:
+                node.status = status.to_dict()
+                node.status_time = time.time()
+            else:
+                FLEET_NODE_FAILURES.labels(node.name, 'get_status').inc()
+
+    def history(self, before: str=None, limit: int=100) -> dict:
+        """
+        Merges a page of history from every backend into one timeline, newest first.
+
+        :param before: Cursor returned with the previous page, or None for the first page
+        :param limit: Most rows to return
+        :return: Dict of the rows as 'entries', each with its node's name, the cursor for
+                 the next page as 'next', and the names of backends that didn't answer as 'missing'
+        """
+        # The merged cursor holds each node's own cursor. Nodes without one have run out of history.
+        cursors = self.parse_cursor(before) if before else {node.name: None for node in self.nodes}
+        nodes = [node for node in self.nodes if node.name in cursors]
+        # Backends that aren't answering status requests are left out until they do, so
+        # requests for them don't tie up the threads other backends need
+        futures = {node.name: self.__executor.submit(node.call, 'get_history', cursors[node.name], limit)
+                   for node in nodes if node.error is None}
+        if futures:
+            wait(futures.values(), self.__timeout)
+
+        pages = {}
+        missing = []
+        for node in nodes:
+            future = futures.get(node.name)
+            page = None
+            if future is None:
+                pass
+            elif future.done() and future.exception() is None:
+                page = future.result()
+            elif future.done():
+                self.__logger.warning("Unable to get history from '%s': %s", node.name, future.exception())
+            if page is None:
+                FLEET_NODE_FAILURES.labels(node.name, 'get_history').inc()
+                missing.append(node.name)
+            else:
+                pages[node.name] = page
+
+        # Every page is newest first so the newest rows overall are the first few of each
+        merged = sorted(((entry['timestamp'], entry['id'], name, entry)
+                         for name, page in pages.items() for entry in page['entries']),
+                        key=lambda item: item[:3], reverse=True)[:limit]
+
+        # Each node carries on after the last of its rows that made it onto this page
+        last_taken = {}
+        for timestamp, id, name, entry in merged:
+            last_taken[name] = entry
+        next_cursors = {}
+        for node in nodes:
+            if node.name in missing:
+                # Try again from the same place next page
+                next_cursors[node.name] = cursors[node.name]
+                continue
+            page = pages[node.name]
+            entry = last_taken.get(node.name)
+            if entry is None:
+                if page['entries']: next_cursors[node.name] = cursors[node.name]
+            elif entry is not page['entries'][-1] or page['next']:
+                next_cursors[node.name] = GarageDb.make_cursor(entry)
+
+        entries = [dict(entry, node=name) for timestamp, id, name, entry in merged]
+        # Stop paging once the backends that answered have run out, even if some didn't answer
+        next = json.dumps(next_cursors) if merged and next_cursors else None
+        return dict(entries=entries, next=next, missing=missing)
+
+    @staticmethod
+    def parse_cursor(cursor: str) -> dict:
+        """ Reads a cursor from history() into each node's own cursor. Raises ValueError if it's malformed. """
+        cursors = json.loads(cursor)
+        if not isinstance(cursors, dict):
+            raise ValueError('Malformed fleet history cursor %r' % cursor)
+        for node_cursor in cursors.values():
+            if node_cursor is not None:
+                if not isinstance(node_cursor, str):
+                    raise ValueError('Malformed fleet history cursor %r' % cursor)
+                GarageDb.parse_cursor(node_cursor)
+        return cursors
+
+    def close(self):
+        self.__executor.shutdown(wait=False)
+        for node in self.nodes:
+            node.pool.close()
@@ -2,22 +2,27 @@ import logging
 from logging.handlers import RotatingFileHandler
 
 import os
-import sys
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-     render_template, flash, jsonify, has_request_context, send_from_directory, send_file
+     render_template, flash, jsonify, has_request_context, Response, make_response
 
-from common import constants
+from common import constants, metrics
+from common.log_queue import start_queue_logging
+from common.protocol import RELAY_PULSE
 from common.db import GarageDb
-from common.iftt import IftttEvent
-from common.telegram import TelegramNotification
-from webserver.client_api import GaragePiClient
+from common.doors import load_doors
+from webserver.client_api import GaragePiClient, GaragePiClientPool, ClientPoolTimeout
+from webserver.fleet import Fleet
+from webserver.http_cache import FragmentCache, gzip_response
+from webserver.status_stream import StatusRelay
 import time
 import csv
+import io
+import zlib
 
 # ------------- Setup ------------
 
-# Create our application
-app = Flask(__name__, instance_relative_config=True)
+# Create our application. The instance folder can be moved with GARAGEPI_INSTANCE_PATH, for example for load testing.
+app = Flask(__name__, instance_path=os.environ.get('GARAGEPI_INSTANCE_PATH'), instance_relative_config=True)
 
 # Set up logging
 app.logger_name = "WEBSRVR"
@@ -44,32 +49,62 @@ app.config.update(dict(
 ))
 
 # Load configuration
-resource_path = os.path.dirname(os.path.realpath(os.path.abspath(sys.argv[0]))) + os.sep + 'resource'
+resource_path = os.path.dirname(os.path.dirname(os.path.realpath(os.path.abspath(__file__)))) + os.sep + 'resource'
 default_cfg_file = os.path.join(resource_path, 'default_app.cfg')
 app.logger.debug('Loading default config file from \'%s\'' % default_cfg_file)
 app.config.from_pyfile(default_cfg_file)
 app.logger.debug('Looking for custom app config in \'%s\'' % os.path.join(app.instance_path, 'app.cfg'))
 app.config.from_pyfile('app.cfg')
 
+# From here on log files are written on a background thread, not by the request
+log_queue = start_queue_logging(app.logger, app.config['LOG_LEVEL'], app.config['LOG_RING_SIZE'])
+
+# Connected clients are shared by all requests in this process
+client_pool = GaragePiClientPool(app.logger, app.config['IPC_PORT'], app.config['IPC_POOL_SIZE'])
+
+# Relays status changes published by the backend to any open event streams, and
+# keeps the status and history versions used to answer repeat requests cheaply
+status_relay = StatusRelay(app.logger, app.config['STATUS_PUB_PORT'],
+                           version_max_age=app.config['PUBLISH_HEARTBEAT'] * 3,
+                           max_streams=app.config['STATUS_STREAM_LIMIT'])
+
+# Rendered parts of pages, kept until the history they show changes
+fragment_cache = FragmentCache()
+
+# Part of every ETag so nothing cached before the webserver was restarted or upgraded is reused
+etag_prefix = '%x' % int(time.time())
+
+# Pages only show door names and pickers when there's more than one door
+doors = load_doors(app.config)
+
+# Backends shown on the fleet pages. Just this Pi's unless others are listed.
+fleet = Fleet(app.logger,
+              app.config['BACKENDS'] or [dict(name='local', host='localhost', port=app.config['IPC_PORT'])],
+              app.config['FLEET_POOL_SIZE'], app.config['FLEET_TIMEOUT'], app.config['FLEET_STATUS_TTL'])
+
 
 # -------------- App Context Resources ----------------
 def get_api_client() -> GaragePiClient:
     """
-    Creates a new client api connector if there isn't one created
-    yet for the current application context.
+    Checks out a client api connector from the pool if there isn't
+    one checked out yet for the current application context.
     """
     if not hasattr(g, 'api_client'):
-        g.api_client = GaragePiClient(app.logger, app.config['IPC_PORT'])
+        g.api_client = client_pool.checkout()
     return g.api_client
 
 def get_db() -> GarageDb:
     """
-    Creates a new database connection if there is none yet for the
-    current application context.
+    Gets the database. It's shared by the whole process and keeps a
+    connection open for each thread that uses it.
     """
-    if not hasattr(g, 'sqlite_db'):
-        g.sqlite_db = GarageDb(app.instance_path, resource_path)
-    return g.sqlite_db
+    global garage_db
+    if garage_db is None:
+        garage_db = GarageDb(app.instance_path, resource_path,
+                             app.config['DB_CACHE_SIZE_KB'], app.config['DB_MMAP_SIZE_MB'])
+    return garage_db
+
+garage_db = None    # type: GarageDb
 
 
 @app.teardown_appcontext
@@ -77,14 +112,72 @@ def close_db(error):
     """Closes the database again at the end of the request."""
     app.logger.debug("Tearing down app context")
     if hasattr(g, 'api_client'):
-        app.logger.debug("Tearing down app context: closing api client")
-        g.api_client.close()
+        app.logger.debug("Tearing down app context: returning api client to pool")
+        client_pool.checkin(g.api_client)
+
+
+@app.errorhandler(ClientPoolTimeout)
+def client_pool_timeout(error):
+    app.logger.warning('Gave up waiting for an api client: %s', error)
+    return 'Backend is busy. Try again shortly.', 503
+
+
+# -------------- Metrics ----------------
+HTTP_REQUEST_SECONDS = metrics.registry.histogram('garagepi_http_request_seconds',
+                                                  'Time taken to handle each request, not counting streamed bodies',
+                                                  ['endpoint', 'method', 'status'])
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    start = g.get('request_start')
+    if start is not None:
+        HTTP_REQUEST_SECONDS.labels(request.endpoint or 'unknown', request.method,
+                                    response.status_code).observe(time.perf_counter() - start)
+    return response
+
+@app.after_request
+def compress_response(response):
+    # Registered after the timer so it runs first and is included in the request time
+    return gzip_response(response, request.accept_encodings['gzip'] > 0)
+
+
+# -------------- Conditional Requests ----------------
+def conditional_response(version: str, build, page: bool=False):
+    """
+    Answers with 304 Not Modified if the browser already has this version of the
+    response, otherwise with build()'s response tagged with the version so the
+    browser can ask next time. Nothing is tagged if the version isn't known.
+
+    :param version: Version of the data the response shows, from the status relay
+    :param build: Callable making the response. Only called if it's needed.
+    :param page: True for HTML pages, which also depend on being logged in and flashed messages
+    """
+    tag = None
+    if version is not None:
+        tag = '%s-%s' % (etag_prefix, version)
+        if page:
+            # Flashed messages are only shown once so a page with any can't be reused
+            tag = None if '_flashes' in session else '%s-%d' % (tag, bool(session.get('logged_in')))
+
+    if tag is not None and request.if_none_match.contains_weak(tag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(build())
+    if tag is not None:
+        response.set_etag(tag, weak=True)
+        # The browser keeps it but asks each time, since versions can change at any moment
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 # -------------- Routes ----------------
 @app.route('/')
 def show_control():
     app.logger.debug('Received request for /')
-    return render_template('garage_control.html')
+    return render_template('garage_control.html', doors=doors)
 
 @app.route('/trigger', methods=['POST'])
 def trigger_openclose():
@@ -92,12 +185,7 @@ def trigger_openclose():
     if not session.get('logged_in'):
         app.logger.warning('Refusing to trigger relay because not logged in!')
         abort(401)
-    app.logger.debug('Triggering relay')
-    get_api_client().trigger_relay(request.headers.get('User-Agent') if has_request_context() else 'SERVER',
-                                   app.config['USERNAME']);
-    app.logger.debug('Relay triggered')
-    flash('Relay successfully triggered')
-    return redirect(url_for('show_control'))
+    return start_relay_program([RELAY_PULSE])
 
 @app.route('/crack', methods=['POST'])
 def trigger_crack():
@@ -105,42 +193,206 @@ def trigger_crack():
     if not session.get('logged_in'):
         app.logger.warning('Refusing to trigger relay because not logged in!')
         abort(401)
-    app.logger.debug('Triggering relay')
-    get_api_client().trigger_relay(request.headers.get('User-Agent') if has_request_context() else 'SERVER',
-                                   app.config['USERNAME']);
-    app.logger.debug('Relay triggered')
-    flash('Relay successfully triggered')
-    crack_delay = app.config['CRACK_DELAY']
-    time.sleep(crack_delay)
-    app.logger.debug('Triggering relay')
-    get_api_client().trigger_relay(request.headers.get('User-Agent') if has_request_context() else 'SERVER',
-                                   app.config['USERNAME']);
-    app.logger.debug('Relay triggered')
-    flash('Relay successfully triggered')
+    # The backend waits between the pulses so the request doesn't have to
+    return start_relay_program([RELAY_PULSE, app.config['CRACK_DELAY'], RELAY_PULSE])
+
+def start_relay_program(steps):
+    """
+    Starts a relay program on the backend and returns without waiting for it.
+    Scripts asking for JSON get the job back to follow with /job/<id>.
+    """
+    app.logger.debug('Starting relay program %r', steps)
+    job = get_api_client().run_relay_program(request.headers.get('User-Agent') if has_request_context() else 'SERVER',
+                                             app.config['USERNAME'], steps, request.form.get('door'))
+    if job is None:
+        message = 'Unable to trigger relay'
+    elif job['merged']:
+        message = 'Relay was already triggered'
+    else:
+        message = 'Relay successfully triggered'
+    app.logger.debug(message)
+
+    if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+        if job is None: return jsonify(error=message), 503
+        return jsonify(job)
+    flash(message)
     return redirect(url_for('show_control'))
 
+@app.route('/job/<int:job_id>')
+def job_status(job_id):
+    """ Returns a relay job started by /trigger or /crack as JSON. """
+    if not session.get('logged_in'): abort(401)
+    job = get_api_client().get_job(job_id)
+    if job is None: abort(404)
+    return jsonify(job)
+
 @app.route('/query_status')
 def query_status() -> str:
-    status = get_api_client().get_status()
-    if status is None: return "{}"
-    return jsonify(status)
+    status_version, history_version, status_json = status_relay.versions()
+
+    def build():
+        # The relay has the status for this version unless it's only heard a heartbeat since it changed
+        if status_json is not None: return Response(status_json, mimetype='application/json')
+        status = get_api_client().get_status()
+        if status is None: return "{}"
+        return Response(status.to_json_bytes(), mimetype='application/json')
+
+    return conditional_response(status_version, build)
 
 
 def get_status():
     return get_api_client().get_status()
 
 
+@app.route('/status_stream')
+def status_stream():
+    # Send the latest known status right away so the page doesn't wait for the next change
+    initial_status = status_relay.latest
+    if initial_status is None:
+        status = get_api_client().get_status()
+        if status is not None: initial_status = status.to_json_bytes()
+    return Response(status_relay.events(initial_status), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def read_recent_events(after: int=None, limit: int=100):
+    """
+    Gets the newest events from the backend's memory, newest first.
+    Returns None if the backend doesn't keep everything asked for, so the database has to be read instead.
+    """
+    reply = get_api_client().get_recent_events(after, limit)
+    if reply is None or not reply['complete']: return None
+    return reply['entries']
+
 @app.route('/history')
 def show_history():
-    db = get_db()
-    entries = db.read_history()
-    return render_template('history.html', entries=entries)
+    # The version is read before the history so a row added in between is newer than the tag, never older
+    status_version, history_version, status_json = status_relay.versions()
+
+    def render_history_table():
+        entries = read_recent_events(limit=500)
+        if entries is None:
+            entries = get_db().read_history()
+        else:
+            # The table shows local time, which the backend works out once for each event
+            for entry in entries:
+                entry['timestamp'] = entry['local_timestamp']
+        return render_template('history_table.html', entries=entries, doors=doors)
+
+    def build():
+        history_table = fragment_cache.get('history', history_version, render_history_table)
+        return render_template('history.html', history_table=history_table)
+
+    return conditional_response(history_version, build, page=True)
 
 @app.route('/full_history')
 def show_full_history():
-    db = get_db()
-    entries = db.read_full_history()
-    return render_template('full_history.html', entries=entries)
+    # Rows are loaded a page at a time from /history_data as the user scrolls, so the page itself never changes
+    return conditional_response('full_history', lambda: render_template('full_history.html'), page=True)
+
+@app.route('/history_data')
+def history_data():
+    """
+    Returns a page of history as JSON. Pass the returned 'next' cursor
+    as 'before' to get the following page. Pass an event's id as 'after' to
+    get only the events added since.
+    """
+    before = request.args.get('before')
+    if before:
+        try:
+            GarageDb.parse_cursor(before)
+        except ValueError:
+            abort(400)
+    status_version, history_version, status_json = status_relay.versions()
+
+    def build():
+        limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+        after = request.args.get('after', type=int)
+        if not any(request.args.get(key) for key in ('before', 'event', 'login', 'since', 'until', 'door')):
+            # The newest page, and what's changed since it, are usually still in the backend's memory
+            entries = read_recent_events(after, limit)
+            if entries is not None:
+                for entry in entries:
+                    del entry['local_timestamp']
+                next_cursor = GarageDb.make_cursor(entries[-1]) if len(entries) == limit else None
+                return jsonify(entries=entries, next=next_cursor)
+        entries, next_cursor = get_db().query_history(request.args.get('before'),
+                                                      limit,
+                                                      request.args.get('event'),
+                                                      request.args.get('login'),
+                                                      request.args.get('since'),
+                                                      request.args.get('until'),
+                                                      request.args.get('door'),
+                                                      after)
+        return jsonify(entries=[dict(entry) for entry in entries], next=next_cursor)
+
+    return conditional_response(history_version, build)
+
+@app.route('/fleet')
+def show_fleet():
+    if not session.get('logged_in'): abort(401)
+    return render_template('fleet.html')
+
+@app.route('/fleet_status')
+def fleet_status():
+    """ Returns the status of every backend in the fleet, asking them all at once. """
+    if not session.get('logged_in'): abort(401)
+    return jsonify(nodes=fleet.statuses())
+
+@app.route('/fleet_history')
+def fleet_history():
+    """
+    Returns a page of history merged from every backend in the fleet, newest
+    first. Pass the returned 'next' cursor as 'before' to get the following page.
+    """
+    if not session.get('logged_in'): abort(401)
+    before = request.args.get('before')
+    if before:
+        try:
+            Fleet.parse_cursor(before)
+        except ValueError:
+            abort(400)
+    limit = max(1, min(request.args.get('limit', 100, type=int), 500))
+    return jsonify(fleet.history(before, limit))
+
+@app.route('/ipc_stats')
+def ipc_stats():
+    if not session.get('logged_in'): abort(401)
+    return jsonify(client_pool=client_pool.stats(), fragment_cache=fragment_cache.stats(),
+                   status_streams=status_relay.stats(),
+                   logging=log_queue.stats(), backend=get_api_client().get_stats())
+
+@app.route('/metrics')
+def show_metrics():
+    """ Returns this process's and the backend's metrics in the Prometheus text format. """
+    sources = [('webserver', metrics.registry.collect())]
+    backend_metrics = get_api_client().get_metrics()
+    if backend_metrics is not None:
+        sources.append(('backend', backend_metrics))
+    return Response(metrics.render(sources), mimetype='text/plain; version=0.0.4')
+
+@app.route('/history_rollups')
+def history_rollups():
+    """
+    Returns daily summaries of history that has been archived, newest first.
+    Pass the returned 'next' day as 'before' to get the following page.
+    """
+    status_version, history_version, status_json = status_relay.versions()
+
+    def build():
+        limit = max(1, min(request.args.get('limit', 30, type=int), 366))
+        rollups = get_db().read_rollups(request.args.get('before'), limit)
+        next_day = rollups[-1]['day'] if rollups and len(rollups) == limit else None
+        return jsonify(rollups=rollups, next=next_day)
+
+    return conditional_response(history_version, build)
+
+@app.route('/stats')
+def door_stats():
+    """ Returns door usage stats as JSON. These are kept as running totals so this doesn't scan history. """
+    # The stats are updated along with history so they share its version
+    status_version, history_version, status_json = status_relay.versions()
+    return conditional_response(history_version, lambda: jsonify(get_db().read_door_stats()))
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -160,18 +412,40 @@ def login():
 
 @app.route('/download')
 def download():
-    db = get_db()
-    entries = db.read_full_history()
+    """
+    Streams history as CSV, optionally gzipped (?gzip=1) and limited to
+    a local date range (?since=YYYY-MM-DD&until=YYYY-MM-DD).
+    """
+    entries = get_db().iter_history(request.args.get('since'), request.args.get('until'))
+    chunks = generate_csv(entries)
     filename = 'history.csv'
-    with open(os.path.join(app.instance_path, filename),'w', newline='') as csv_file:
-        wr = csv.writer(csv_file, quoting=csv.QUOTE_ALL)
-        wr.writerow(["Time","Event","Description"])
-        for row in entries:
-            wr.writerow(row)
-    try:
-        return send_from_directory(os.path.join(app.instance_path), filename, as_attachment=True, attachment_filename=filename)
-    except:
-        abort(404)
+    mimetype = 'text/csv'
+    if request.args.get('gzip'):
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+def generate_csv(entries, chunk_size=16 * 1024):
+    """ Yields CSV text in chunks of roughly the given size. """
+    buffer = io.StringIO()
+    wr = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+    wr.writerow(["Time","Event","Description","Door"])
+    for row in entries:
+        wr.writerow([row['local_timestamp'], row['event'], row['description'], row['door']])
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)   # 31 selects the gzip container
+    for chunk in chunks:
+        data = compressor.compress(str.encode(chunk))
+        if data: yield data
+    yield compressor.flush()
 
 
 @app.route('/logout')
@@ -210,8 +484,16 @@ def test_ifttt():
     value3 = request.args.get('value3')
     app.logger.debug("Testing IFTTT with: %r %r %r %r" % (event_name, value1, value2, value3))
 
+    # Only needed here, so new webserver processes don't pay to import them
+    from common.iftt import IftttEvent
+
     event = IftttEvent(maker_key, request.args.get('event_name'), app.logger)
-    result = event.trigger(value1, value2, value3)
+    try:
+        result = event.trigger(value1, value2, value3)
+    except Exception as e:
+        # Show what went wrong, since that's what testing is for
+        app.logger.warning('IFTTT test failed: %s', e)
+        result = 'IFTTT trigger failed: %s' % e
 
     return 'Result: %r' % (result,)
 
@@ -223,6 +505,12 @@ def test_telegram():
     if not telegram_key: return 'No Telegram key provided!'
     app.logger.debug("Testing Telegram with %s and %s" % (telegram_key,telegram_chat_id))
 
+    from common.telegram import TelegramNotification
+
     event = TelegramNotification(telegram_key, telegram_chat_id, "Test notification from GaragePi", app.logger)
-    event.trigger()
+    try:
+        event.trigger()
+    except Exception as e:
+        app.logger.warning('Telegram test failed: %s', e)
+        flash('Telegram test failed: %s' % e)
     return redirect(url_for('show_control'))
\ No newline at end of file
@@ -0,0 +1,62 @@
+import threading
+import zlib
+
+# Only text is worth compressing, and small responses aren't worth the CPU
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/csv', 'text/plain', 'application/json', 'application/javascript')
+GZIP_MIN_SIZE = 500
+
+
+class FragmentCache(object):
+    """
+    Keeps rendered parts of pages for the version of the data they were
+    rendered from, so they're only rendered again once the data changes.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = {}     # key -> (version, fragment)
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def get(self, key: str, version: str, render) -> str:
+        """
+        Gets the fragment for the key, calling render() to make it if the cached
+        one is for another version. Nothing is cached if the version is None.
+        """
+        if version is not None:
+            with self.__lock:
+                cached_version, fragment = self.__entries.get(key, (None, None))
+                if cached_version == version:
+                    self.hit_count += 1
+                    return fragment
+                self.miss_count += 1
+        # Several requests can render the same version at once but they get the same result
+        fragment = render()
+        if version is not None:
+            with self.__lock:
+                self.__entries[key] = (version, fragment)
+        return fragment
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(entries=len(self.__entries), hit_count=self.hit_count, miss_count=self.miss_count)
+
+
+def gzip_response(response, accept_gzip: bool):
+    """
+    Compresses the response body in place if the client accepts gzip and the body
+    is text that's big enough to be worth it. Streamed responses are left alone.
+
+    :param accept_gzip: Whether the request's Accept-Encoding allows gzip
+    """
+    response.vary.add('Accept-Encoding')
+    if not accept_gzip or response.status_code != 200: return response
+    if response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers: return response
+    if response.mimetype not in COMPRESSIBLE_TYPES: return response
+
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE: return response
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)   # 31 selects the gzip container
+    response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
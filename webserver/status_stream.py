@@ -0,0 +1,167 @@
+import queue
+import threading
+import logging
+import time
+import zmq
+
+STATUS_TOPIC = b'status'
+VERSION_TOPIC = b'version'
+SUBSCRIBER_QUEUE_SIZE = 16
+
+
+class StatusRelay(object):
+    """
+    Subscribes to the backend's status publisher on a single background thread
+    and fans each update out to every connected event stream. It also keeps
+    the latest status and history versions the backend has published.
+
+    Each open stream holds one of the webserver's threads, so only max_streams
+    are allowed at once. Later ones are told to poll /query_status instead.
+    """
+
+    def __init__(self, logger: logging.Logger, connect_port='5551', heartbeat=15.0, version_max_age=30.0,
+                 max_streams=4):
+        """
+        :param logger: Logger for logging purposes
+        :param connect_port: Port the backend publishes status changes on
+        :param heartbeat: Seconds between keep-alive comments sent to idle streams
+        :param version_max_age: Seconds without hearing from the backend before versions are no longer trusted
+        :param max_streams: Most event streams open at once
+        """
+        assert logger is not None
+        self.__logger = logger
+        self.__connect_addr = "tcp://localhost:%s" % connect_port
+        self.__heartbeat = heartbeat
+        self.__version_max_age = version_max_age
+        self.__max_streams = max_streams
+        self.rejected_count = 0
+
+        self.__lock = threading.Lock()
+        self.__subscribers = set()
+        self.__thread = None    # type: threading.Thread
+        self.__latest = None    # type: bytes
+        # (status version, history version, status JSON for that version or None, when it was received)
+        self.__versions = (None, None, None, 0.0)
+
+    @property
+    def latest(self) -> bytes:
+        """ The most recent status JSON received from the backend, or None if nothing has arrived yet. """
+        return self.__latest
+
+    def versions(self):
+        """
+        Gets the status version, the history version and the status JSON for that
+        status version if it's been received. The versions are None if the backend
+        hasn't been heard from recently, since updates may have been missed.
+        Starts listening to the backend on the first call.
+        """
+        self.start()
+        status_version, history_version, status_json, received = self.__versions
+        if time.monotonic() - received > self.__version_max_age:
+            return None, None, None
+        return status_version, history_version, status_json
+
+    def start(self):
+        with self.__lock:
+            self.__start()
+
+    def __start(self):
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='StatusRelay', daemon=True)
+            self.__thread.start()
+
+    def subscribe(self) -> queue.Queue:
+        """ Gets a queue of status updates, or None if max_streams are already open. """
+        with self.__lock:
+            self.__start()
+            if len(self.__subscribers) >= self.__max_streams:
+                self.rejected_count += 1
+                return None
+            q = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+            self.__subscribers.add(q)
+            self.__logger.debug("Status stream subscribed (%d active)", len(self.__subscribers))
+            return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self.__lock:
+            self.__subscribers.discard(q)
+            self.__logger.debug("Status stream unsubscribed (%d active)", len(self.__subscribers))
+
+    def events(self, initial_status: bytes=None):
+        """
+        Generator producing server-sent event frames for a single client.
+
+        :param initial_status: Status JSON to send immediately so the page doesn't wait for a change
+        """
+        q = self.subscribe()
+        if q is None:
+            # The page falls back to polling and tries the stream again later
+            self.__logger.info('Too many status streams open, sending the client back to polling')
+            yield 'retry: 30000\nevent: busy\ndata: {}\n\n'
+            return
+        try:
+            # Tell the browser how long to wait before reconnecting on its own
+            yield 'retry: 5000\n\n'
+            if initial_status is not None:
+                yield self.__format_event(initial_status)
+            while True:
+                try:
+                    status_json = q.get(timeout=self.__heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield self.__format_event(status_json)
+        finally:
+            self.unsubscribe(q)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(streams=len(self.__subscribers), max_streams=self.__max_streams,
+                        rejected_count=self.rejected_count)
+
+    @staticmethod
+    def __format_event(status_json: bytes) -> str:
+        return 'event: status\ndata: %s\n\n' % bytes.decode(status_json)
+
+    def __publish(self, status_json: bytes):
+        self.__latest = status_json
+        with self.__lock:
+            subscribers = list(self.__subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(status_json)
+            except queue.Full:
+                # A slow client only needs the newest status so drop the oldest one
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                q.put_nowait(status_json)
+
+    def __run(self):
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, STATUS_TOPIC)
+        socket.setsockopt(zmq.SUBSCRIBE, VERSION_TOPIC)
+        socket.connect(self.__connect_addr)
+        self.__logger.info("Status relay subscribed to " + self.__connect_addr)
+        try:
+            while True:
+                frames = socket.recv_multipart()
+                if frames[0] == STATUS_TOPIC:
+                    status_json, status_version, history_version = frames[1:]
+                    self.__versions = (status_version.decode(), history_version.decode(), status_json,
+                                       time.monotonic())
+                    self.__publish(status_json)
+                else:
+                    status_version, history_version = (version.decode() for version in frames[1:])
+                    # Keep the status JSON if it's still the current one
+                    status_json = self.__versions[2] if status_version == self.__versions[0] else None
+                    self.__versions = (status_version, history_version, status_json, time.monotonic())
+        except:
+            self.__logger.exception('Status relay stopped')
+            with self.__lock:
+                self.__thread = None
+        finally:
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.close()